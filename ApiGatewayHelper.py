@@ -3,21 +3,48 @@ import asyncio
 import io
 import json
 import logging
+import random
+import time
+import urllib.parse
 import websockets
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
 
 class ApiGatewayHelper:
-    """Encapsulates Amazon API Gateway websocket functions."""
-    def __init__(self, api_name, apig2_client):
+    """Encapsulates Amazon API Gateway websocket functions.
+
+    Independent create calls of the websocket API run concurrently in a pool of
+    max_workers threads. The REST API has a single resource chain, only its Lambda
+    permission runs next to it.
+    Throttled calls are retried up to max_attempts times with exponential backoff and
+    full jitter. Conflicts are only retried for the Lambda policy calls, which run in
+    parallel against the same function policy; elsewhere a conflict is a real error.
+    """
+
+    # error codes of throttled calls
+    RETRY_CODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling')
+    # error codes of a concurrent update of the same resource, see _call_with_retry
+    CONFLICT_CODES = ('ConflictException', 'ResourceConflictException')
+
+    def __init__(self, api_name, apig2_client, max_workers=4, max_attempts=6, retry_base=0.2, retry_cap=5):
         """
         :param api_name: The name of the websocket API.
         :param apig2_client: A Boto3 API Gateway V2 client.
+        :param max_workers: Max create calls running at the same time.
+        :param max_attempts: Attempts of a throttled call before giving up.
+        :param retry_base: Backoff of the first retry, in seconds.
+        :param retry_cap: Max backoff between retries, in seconds.
         """
         self.apig2_client = apig2_client
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self._sleep = time.sleep
         self.apig_v1_client = None
         self.api_name = api_name
         self.api_id = None
@@ -29,6 +56,61 @@ class ApiGatewayHelper:
 
     permission_policy_suffix = 'manage-connections'
 
+    def _call_with_retry(self, func, retry_conflicts=False, **kwargs):
+        """
+        Calls func(**kwargs), retrying throttled calls with exponential backoff and
+        full jitter. Other errors and the last throttling error are raised.
+
+        :param func: A Boto3 client method.
+        :param retry_conflicts: Retry conflicts too. Only for calls that run at the same
+                                time as other updates of the same resource; a conflict
+                                because the resource already exists is never retried.
+        :return: The response of func.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                return func(**kwargs)
+            except ClientError as err:
+                code = err.response.get('Error', {}).get('Code')
+                retry = code in self.RETRY_CODES or (
+                    retry_conflicts and code in self.CONFLICT_CODES and not self._already_exists(err))
+                if not retry or attempt == self.max_attempts - 1:
+                    raise
+                delay = random.uniform(0, min(self.retry_cap, self.retry_base * 2 ** attempt))
+                logger.warning("%s throttled by %s, retry %s in %.2f s.",
+                               getattr(func, '__name__', func), code, attempt + 1, delay)
+                self._sleep(delay)
+
+    @staticmethod
+    def _already_exists(err):
+        """ True when err reports that the resource, like a permission statement id, already exists """
+        return 'already exists' in err.response.get('Error', {}).get('Message', '')
+
+    @staticmethod
+    def _submit_all(executor, func, items):
+        """ submits func(item) for every item, returns a dict item -> future """
+        return {item: executor.submit(func, item) for item in items}
+
+    @staticmethod
+    def _wait_all(futures):
+        """
+        Waits for all the futures, so a failure does not leave calls running
+        behind. The first error is raised.
+
+        :param futures: dict item -> future, see _submit_all.
+        :return: dict item -> result.
+        """
+        results = {}
+        error = None
+        for item, future in futures.items():
+            try:
+                results[item] = future.result()
+            except Exception as err:
+                error = error or err
+        if error is not None:
+            raise error
+        return results
+
     def create_api(self, route_selection):
         """
         Creates a websocket API. The newly created API has no routes.
@@ -70,6 +152,9 @@ class ApiGatewayHelper:
         5. Adds a resource policy to the AWS Lambda function that grants permission
         to let Amazon API Gateway call the AWS Lambda function.
 
+        Steps 2 to 4 depend on each other and run one after the other. Only step 5
+        runs concurrently with them: it needs nothing but the API ID.
+
         :param apigateway_client: The Boto3 Amazon API Gateway client object.
         :param api_name: The name of the REST API.
         :param api_base_path: The base path part of the REST API URL.
@@ -83,7 +168,7 @@ class ApiGatewayHelper:
                 methods.
         """
         try:
-            response = apigateway_client.create_rest_api(name=api_name
+            response = self._call_with_retry(apigateway_client.create_rest_api, name=api_name
                 ,endpointConfiguration={
                         'types': ['REGIONAL']
                     }
@@ -94,8 +179,30 @@ class ApiGatewayHelper:
             logger.exception("Couldn't create REST API %s.", api_name)
             raise
 
+        source_arn = \
+            f'arn:aws:execute-api:{apigateway_client.meta.region_name}:' \
+            f'{account_id}:{api_id}/*/*/{api_base_path}'
+        # the permission only needs the API id, it is added while the resources are created
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            permission = executor.submit(
+                self._add_rest_permission, lambda_client, lambda_function_arn, source_arn)
+            try:
+                self._create_rest_resources(
+                    apigateway_client, api_id, api_base_path, api_stage, lambda_function_arn)
+            finally:
+                permission.result()
+
+        return api_id
+
+    def _create_rest_resources(
+            self, apigateway_client, api_id, api_base_path, api_stage, lambda_function_arn):
+        """
+        Creates the base path resource of a REST API with a method that passes all
+        HTTP verbs to the Lambda function, and deploys it. Each step depends on the
+        previous one, so they run in order.
+        """
         try:
-            response = apigateway_client.get_resources(restApiId=api_id)
+            response = self._call_with_retry(apigateway_client.get_resources, restApiId=api_id)
             root_id = next(item['id'] for item in response['items'] if item['path'] == '/')
             logger.info("Found root resource of the REST API with ID %s.", root_id)
         except ClientError:
@@ -103,7 +210,8 @@ class ApiGatewayHelper:
             raise
 
         try:
-            response = apigateway_client.create_resource(
+            response = self._call_with_retry(
+                apigateway_client.create_resource,
                 restApiId=api_id, parentId=root_id, pathPart=api_base_path)
             base_id = response['id']
             logger.info("Created base path %s with ID %s.", api_base_path, base_id)
@@ -112,7 +220,8 @@ class ApiGatewayHelper:
             raise
 
         try:
-            apigateway_client.put_method(
+            self._call_with_retry(
+                apigateway_client.put_method,
                 restApiId=api_id, resourceId=base_id, httpMethod='ANY',
                 authorizationType='NONE')
             logger.info("Created a method that accepts all HTTP verbs for the base "
@@ -126,7 +235,8 @@ class ApiGatewayHelper:
             f'lambda:path/2015-03-31/functions/{lambda_function_arn}/invocations'
         try:
             # NOTE: You must specify 'POST' for integrationHttpMethod or this will not work.
-            apigateway_client.put_integration(
+            self._call_with_retry(
+                apigateway_client.put_integration,
                 restApiId=api_id, resourceId=base_id, httpMethod='ANY', type='AWS_PROXY',
                 integrationHttpMethod='POST', uri=lambda_uri)
             logger.info(
@@ -138,31 +248,32 @@ class ApiGatewayHelper:
             raise
 
         try:
-            apigateway_client.create_deployment(restApiId=api_id, stageName=api_stage)
+            self._call_with_retry(
+                apigateway_client.create_deployment, restApiId=api_id, stageName=api_stage)
             logger.info("Deployed REST API %s.", api_id)
         except ClientError:
             logger.exception("Couldn't deploy REST API %s.", api_id)
             raise
 
-        source_arn = \
-            f'arn:aws:execute-api:{apigateway_client.meta.region_name}:' \
-            f'{account_id}:{api_id}/*/*/{api_base_path}'
+    def _add_rest_permission(self, lambda_client, lambda_function_arn, source_arn):
+        """ Grants API Gateway permission to invoke the Lambda function from the REST API. """
         try:
-            
-            lambda_client.add_permission(
+            self._call_with_retry(
+                lambda_client.add_permission, retry_conflicts=True,
                 FunctionName=lambda_function_arn
                 , StatementId=f'{self.api_name}-rest-invoke',
                 Action='lambda:InvokeFunction', Principal='apigateway.amazonaws.com',
                 SourceArn=source_arn)
             logger.info("Granted permission to let Amazon API Gateway invoke function %s "
                         "from %s.", lambda_function_arn, source_arn)
-        except ClientError:
+        except ClientError as err:
+            if self._already_exists(err):
+                logger.info("Permission to invoke %s from the REST API already exists.", lambda_function_arn)
+                return
             logger.exception("Couldn't add permission to let Amazon API Gateway invoke %s.",
                             lambda_function_arn)
             raise
 
-        return api_id
-
 
 
     def create_api_rest(self,api_name):
@@ -216,18 +327,12 @@ class ApiGatewayHelper:
                                     role.
             :param iam_resource: A Boto3 AWS Identity and Access Management (IAM) resource.
             """
-            self.api_arn = (f'arn:aws:execute-api:{self.apig2_client.meta.region_name}:'
-                            f'{account}:{self.api_id}/*')
+            self.api_arn = self._websocket_api_arn(account)
             policy = None
             try:
                 policy = iam_resource.create_policy(
                     PolicyName=f'{lambda_role_name}-{self.permission_policy_suffix}',
-                    PolicyDocument=json.dumps({
-                        'Version': '2012-10-17',
-                        'Statement': [{
-                            'Effect': 'Allow',
-                            'Action': ['execute-api:ManageConnections'],
-                            'Resource': self.api_arn}]}))
+                    PolicyDocument=json.dumps(self._connection_policy_document()))
                 policy.attach_role(RoleName=lambda_role_name)
                 logger.info(
                     "Created and attached policy %s to Lambda role.", policy.policy_name)
@@ -238,6 +343,18 @@ class ApiGatewayHelper:
                     "Couldn't create or attach policy to Lambda role %s.", lambda_role_name)
                 raise
 
+    def _websocket_api_arn(self, account):
+            return (f'arn:aws:execute-api:{self.apig2_client.meta.region_name}:'
+                    f'{account}:{self.api_id}/*')
+
+    def _connection_policy_document(self):
+            return {
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Effect': 'Allow',
+                    'Action': ['execute-api:ManageConnections'],
+                    'Resource': self.api_arn}]}
+
     def remove_connection_permissions(self, lambda_role):
             """
             Removes the connection permission policy from the AWS Lambda function's role
@@ -274,11 +391,49 @@ class ApiGatewayHelper:
             :param lambda_client: A Boto3 Lambda client.
             :return: The ID of the newly added route.
             """
-            integration_uri = (
-                f'arn:aws:apigateway:{self.apig2_client.meta.region_name}:lambda:'
-                f'path/2015-03-31/functions/{lambda_func["FunctionArn"]}/invocations')
+            integration_id = self.create_integration(lambda_func)
+            route_id = self.create_route(route_name, integration_id)
+            self.add_route_permission(route_name, lambda_func, lambda_client)
+            return route_id
+
+    def add_routes_and_integrations(self, route_names, lambda_func, lambda_client):
+            """
+            Same as add_route_and_integration for several routes, with the independent
+            calls running concurrently in up to max_workers threads:
+            the Lambda permissions of all the routes run while the integrations are
+            created, and the routes are created once their integrations exist.
+
+            :param route_names: The names of the new routes.
+            :param lambda_func: The Lambda function that handles the requests.
+            :param lambda_client: A Boto3 Lambda client.
+            :return: A dict with the ID of each new route by route name.
+            """
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                integrations = self._submit_all(
+                    executor, lambda route_name: self.create_integration(lambda_func), route_names)
+                permissions = self._submit_all(
+                    executor, lambda route_name: self.add_route_permission(route_name, lambda_func, lambda_client),
+                    route_names)
+                try:
+                    integration_ids = self._wait_all(integrations)
+                    route_ids = self._wait_all(self._submit_all(
+                        executor, lambda route_name: self.create_route(route_name, integration_ids[route_name]),
+                        route_names))
+                finally:
+                    self._wait_all(permissions)
+            return route_ids
+
+    def create_integration(self, lambda_func):
+            """
+            Creates an integration of the websocket API to a Lambda function.
+
+            :param lambda_func: The Lambda function that handles the requests.
+            :return: The ID of the new integration.
+            """
+            integration_uri = self._integration_uri(lambda_func)
             try:
-                response = self.apig2_client.create_integration(
+                response = self._call_with_retry(
+                    self.apig2_client.create_integration,
                     ApiId=self.api_id,
                     IntegrationType='AWS_PROXY',
                     IntegrationMethod='POST',
@@ -288,38 +443,283 @@ class ApiGatewayHelper:
                 logging.exception("Couldn't create integration to %s.", integration_uri)
                 raise
             else:
-                integration_id = response['IntegrationId']
+                return response['IntegrationId']
 
+    def create_route(self, route_name, integration_id):
+            """
+            Creates a route of the websocket API that targets an integration.
+
+            :param route_name: The name of the new route.
+            :param integration_id: The ID of the integration that handles the route.
+            :return: The ID of the new route.
+            """
             target = f'integrations/{integration_id}'
             try:
-                response = self.apig2_client.create_route(
+                response = self._call_with_retry(
+                    self.apig2_client.create_route,
                     ApiId=self.api_id, RouteKey=route_name, Target=target)
                 logger.info("Created route %s to %s.", route_name, target)
             except ClientError:
                 logger.exception("Couldn't create route %s to %s.", route_name, target)
                 raise
             else:
-                route_id = response['RouteId']
+                return response['RouteId']
 
+    def add_route_permission(self, route_name, lambda_func, lambda_client):
+            """
+            Adds permission to let API Gateway invoke the Lambda function from a route.
+            Concurrent updates of the function policy are retried; a statement that
+            already exists is kept.
+
+            :param route_name: The name of the route.
+            :param lambda_func: The Lambda function that handles the route.
+            :param lambda_client: A Boto3 Lambda client.
+            """
             source_arn = f'{self.api_arn}/{route_name}'
             try:
-                alpha_route = route_name[1:] if route_name[0] == '$' else route_name
-                lambda_client.add_permission(
+                self._call_with_retry(
+                    lambda_client.add_permission, retry_conflicts=True,
                     FunctionName=lambda_func['FunctionName'],
-                    StatementId=f'{self.api_name}-{alpha_route}-invoke',
+                    StatementId=self._permission_statement_id(route_name),
                     Action='lambda:InvokeFunction',
                     Principal='apigateway.amazonaws.com',
                     SourceArn=source_arn)
                 logger.info(
                     "Added permission to let API Gateway invoke Lambda function %s "
-                    "from the new route.", lambda_func['FunctionName'])
-            except ClientError:
+                    "from the route %s.", lambda_func['FunctionName'], route_name)
+            except ClientError as err:
+                if self._already_exists(err):
+                    logger.info("Permission to invoke %s from the route %s already exists.",
+                                lambda_func['FunctionName'], route_name)
+                    return
                 logger.exception(
                     "Couldn't add permission to AWS Lambda function %s.",
                     lambda_func['FunctionName'])
                 raise
 
-            return route_id
+    @staticmethod
+    def _paginate(client, operation, key, **kwargs):
+            """ all the items of a paginated list operation """
+            items = []
+            for page in client.get_paginator(operation).paginate(**kwargs):
+                items.extend(page.get(key, []))
+            return items
+
+    def _integration_uri(self, lambda_func):
+            return (f'arn:aws:apigateway:{self.apig2_client.meta.region_name}:lambda:'
+                    f'path/2015-03-31/functions/{lambda_func["FunctionArn"]}/invocations')
+
+    def _permission_statement_id(self, route_name):
+            alpha_route = route_name[1:] if route_name[0] == '$' else route_name
+            return f'{self.api_name}-{alpha_route}-invoke'
+
+    def read_websocket_state(self, lambda_func, lambda_client):
+            """
+            Reads the current state of the websocket API once: the API with this name,
+            its routes, integrations and stages, and the invoke permissions of the
+            Lambda function. Every list is read through its paginator.
+
+            :param lambda_func: The Lambda function that handles the requests.
+            :param lambda_client: A Boto3 Lambda client.
+            :return: A dict with api (None when it does not exist), routes by route key,
+                     integrations by ID, stages by name and permissions by statement ID.
+            """
+            state = {'api': None, 'routes': {}, 'integrations': {}, 'stages': {}, 'permissions': {}}
+            apis = self._paginate(self.apig2_client, 'get_apis', 'Items')
+            state['api'] = next((api for api in apis if api['Name'] == self.api_name), None)
+            if state['api'] is not None:
+                api_id = state['api']['ApiId']
+                state['routes'] = {route['RouteKey']: route for route in
+                                   self._paginate(self.apig2_client, 'get_routes', 'Items', ApiId=api_id)}
+                state['integrations'] = {integration['IntegrationId']: integration for integration in
+                                         self._paginate(self.apig2_client, 'get_integrations', 'Items', ApiId=api_id)}
+                state['stages'] = {stage['StageName']: stage for stage in
+                                   self._paginate(self.apig2_client, 'get_stages', 'Items', ApiId=api_id)}
+            try:
+                policy = json.loads(lambda_client.get_policy(FunctionName=lambda_func['FunctionName'])['Policy'])
+                state['permissions'] = {statement['Sid']: statement for statement in policy.get('Statement', [])}
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'ResourceNotFoundException':
+                    raise
+            return state
+
+    def plan_websocket_api(self, state, route_names, lambda_func, account, stage, prune=False):
+            """
+            Computes the changes that turn the current state into the desired one.
+            Routes already targeting an integration of the Lambda function, permissions
+            with the right source ARN and existing stages are left alone.
+
+            :param state: The current state, see read_websocket_state.
+            :param route_names: The desired routes.
+            :param lambda_func: The Lambda function that handles the requests.
+            :param account: The AWS account number of the account that owns the API.
+            :param stage: The desired stage.
+            :param prune: Also delete routes that are not desired.
+            :return: A list of changes. Each one is a dict with an `action` and its arguments.
+            """
+            plan = []
+            api = state['api']
+            if api is None:
+                plan.append({'action': 'create_api'})
+            integration_uri = self._integration_uri(lambda_func)
+            integration_ids = [integration_id for integration_id, integration in state['integrations'].items()
+                               if integration.get('IntegrationUri') == integration_uri]
+            routes = state['routes']
+            missing = [route_name for route_name in route_names if route_name not in routes]
+            wrong = [route_name for route_name in route_names if route_name in routes
+                     and routes[route_name].get('Target') not in
+                     [f'integrations/{integration_id}' for integration_id in integration_ids]]
+            if (missing or wrong) and not integration_ids:
+                plan.append({'action': 'create_integration'})
+            plan.extend({'action': 'create_route', 'route': route_name} for route_name in missing)
+            plan.extend({'action': 'update_route', 'route': route_name, 'route_id': routes[route_name]['RouteId']}
+                        for route_name in wrong)
+            if prune:
+                plan.extend({'action': 'delete_route', 'route': route_key, 'route_id': route['RouteId']}
+                            for route_key, route in routes.items() if route_key not in route_names)
+            api_id = api['ApiId'] if api is not None else None
+            for route_name in route_names:
+                statement = state['permissions'].get(self._permission_statement_id(route_name))
+                source_arn = (f'arn:aws:execute-api:{self.apig2_client.meta.region_name}:'
+                              f'{account}:{api_id}/*/{route_name}')
+                if statement is None:
+                    plan.append({'action': 'add_permission', 'route': route_name})
+                elif api_id is None or statement.get('Condition', {}).get('ArnLike', {}).get('AWS:SourceArn') != source_arn:
+                    plan.append({'action': 'replace_permission', 'route': route_name})
+            if stage not in state['stages']:
+                plan.append({'action': 'create_stage', 'stage': stage})
+            elif not state['stages'][stage].get('AutoDeploy'):
+                plan.append({'action': 'update_stage', 'stage': stage})
+            if api_id is not None:
+                self.api_id = api_id
+                self.api_endpoint = api['ApiEndpoint']
+                self._reuse_integration_id = integration_ids[0] if integration_ids else None
+            return plan
+
+    def reconcile_websocket_api(self, route_selection, route_names, lambda_func, lambda_client, account, stage,
+                                prune=False, dry_run=False):
+            """
+            Idempotent deploy of the websocket API. Reads the current state once,
+            computes the diff against the desired routes and applies only the changes,
+            so a redeploy of an API that is already correct makes no create calls.
+            Routes share one integration to the Lambda function. The independent changes
+            run concurrently like in add_routes_and_integrations.
+
+            :param route_selection: The route selection expression of a new API.
+            :param route_names: The desired routes.
+            :param lambda_func: The Lambda function that handles the requests.
+            :param lambda_client: A Boto3 Lambda client.
+            :param account: The AWS account number of the account that owns the API.
+            :param stage: The stage, created with auto deploy.
+            :param prune: Also delete routes that are not desired.
+            :param dry_run: Only compute the changes.
+            :return: The list of changes, see plan_websocket_api.
+            """
+            self._reuse_integration_id = None
+            state = self.read_websocket_state(lambda_func, lambda_client)
+            plan = self.plan_websocket_api(state, route_names, lambda_func, account, stage, prune=prune)
+            logger.info("Reconcile of websocket API %s: %s changes.", self.api_name, len(plan))
+            self.stage = stage
+            if dry_run or not plan:
+                return plan
+
+            actions = {}
+            for change in plan:
+                actions.setdefault(change['action'], []).append(change)
+            if 'create_api' in actions:
+                self.create_api(route_selection)
+            self.api_arn = self._websocket_api_arn(account)
+            integration_id = self._reuse_integration_id
+            if 'create_integration' in actions:
+                integration_id = self.create_integration(lambda_func)
+
+            def apply_route(change):
+                if change['action'] == 'create_route':
+                    return self.create_route(change['route'], integration_id)
+                if change['action'] == 'update_route':
+                    self._call_with_retry(self.apig2_client.update_route, ApiId=self.api_id,
+                                          RouteId=change['route_id'], Target=f'integrations/{integration_id}')
+                    logger.info("Updated route %s to integration %s.", change['route'], integration_id)
+                else:
+                    self._call_with_retry(self.apig2_client.delete_route, ApiId=self.api_id, RouteId=change['route_id'])
+                    logger.info("Deleted route %s.", change['route'])
+                return change['route_id']
+
+            def apply_permission(change):
+                if change['action'] == 'replace_permission':
+                    self._call_with_retry(lambda_client.remove_permission, retry_conflicts=True,
+                                          FunctionName=lambda_func['FunctionName'],
+                                          StatementId=self._permission_statement_id(change['route']))
+                self.add_route_permission(change['route'], lambda_func, lambda_client)
+
+            route_changes = actions.get('create_route', []) + actions.get('update_route', []) + actions.get('delete_route', [])
+            permission_changes = actions.get('add_permission', []) + actions.get('replace_permission', [])
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                routes = self._submit_all(executor, lambda index: apply_route(route_changes[index]),
+                                          range(len(route_changes)))
+                permissions = self._submit_all(executor, lambda index: apply_permission(permission_changes[index]),
+                                               range(len(permission_changes)))
+                try:
+                    self._wait_all(routes)
+                finally:
+                    self._wait_all(permissions)
+
+            for change in actions.get('create_stage', []):
+                self.deploy_api(change['stage'])
+            for change in actions.get('update_stage', []):
+                self._call_with_retry(self.apig2_client.update_stage, ApiId=self.api_id,
+                                      StageName=change['stage'], AutoDeploy=True)
+                logger.info("Enabled auto deploy of stage %s.", change['stage'])
+            return plan
+
+    def reconcile_connection_permissions(self, account, lambda_role_name, iam_resource):
+            """
+            Idempotent version of add_connection_permissions. The policy is created when
+            it does not exist, gets a new default version when it allows another API,
+            and is attached to the role when it is not.
+
+            :param account: The AWS account number of the account that owns the API.
+            :param lambda_role_name: The name of the role used by the AWS Lambda function.
+            :param iam_resource: A Boto3 AWS Identity and Access Management (IAM) resource.
+            :return: True when something changed.
+            """
+            iam_client = iam_resource.meta.client
+            self.api_arn = self._websocket_api_arn(account)
+            policy_name = f'{lambda_role_name}-{self.permission_policy_suffix}'
+            policy_arn = f'arn:{iam_client.meta.partition}:iam::{account}:policy/{policy_name}'
+            document = self._connection_policy_document()
+            try:
+                policy = iam_client.get_policy(PolicyArn=policy_arn)['Policy']
+            except ClientError as err:
+                if err.response['Error']['Code'] != 'NoSuchEntity':
+                    raise
+                self.add_connection_permissions(account, lambda_role_name, iam_resource)
+                return True
+
+            changed = False
+            version = iam_client.get_policy_version(
+                PolicyArn=policy_arn, VersionId=policy['DefaultVersionId'])['PolicyVersion']
+            current = version['Document']
+            if isinstance(current, str):
+                current = json.loads(urllib.parse.unquote(current))
+            if current != document:
+                versions = self._paginate(iam_client, 'list_policy_versions', 'Versions', PolicyArn=policy_arn)
+                old_versions = sorted((item for item in versions if not item['IsDefaultVersion']),
+                                      key=lambda item: item['CreateDate'])
+                # IAM keeps at most 5 versions of a policy
+                for item in old_versions[:max(0, len(versions) - 4)]:
+                    iam_client.delete_policy_version(PolicyArn=policy_arn, VersionId=item['VersionId'])
+                iam_client.create_policy_version(
+                    PolicyArn=policy_arn, PolicyDocument=json.dumps(document), SetAsDefault=True)
+                logger.info("Updated policy %s to allow %s.", policy_name, self.api_arn)
+                changed = True
+            attached = self._paginate(iam_client, 'list_attached_role_policies', 'AttachedPolicies',
+                                      RoleName=lambda_role_name)
+            if policy_arn not in [item['PolicyArn'] for item in attached]:
+                iam_client.attach_role_policy(RoleName=lambda_role_name, PolicyArn=policy_arn)
+                logger.info("Attached policy %s to role %s.", policy_name, lambda_role_name)
+                changed = True
+            return changed
 
     def add_integration_method(
                 self, resource_id, rest_method, lambda_func, service_endpoint_prefix, service_action,
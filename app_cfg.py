@@ -13,6 +13,8 @@ messages to other chat participants.
 import argparse
 import os
 import asyncio
+import base64
+import hashlib
 import io
 import json
 import logging
@@ -24,6 +26,8 @@ from ApiGatewayHelper import ApiGatewayHelper
 
 logger = logging.getLogger(__name__)
 
+WEBSOCKET_ROUTES = ['$connect', '$disconnect', 'sendmessage', 'subscribe', 'unsubscribe', 'resume', 'ping']
+
 def stack_deploy(stack_name, cf_resource):
     """
     Deploys prerequisite resources used by the `usage_demo` script. The resources are
@@ -91,8 +95,11 @@ def create_apirest(
 
 def create_lambda(
         api_gateway:ApiGatewayHelper, account, lambda_role_name, iam_resource, lambda_function_name,
-        lambda_client):
+        lambda_client, dry_run=False):
     """
+    Uploads the code of the Lambda function. The upload is skipped when the deployed
+    code has the same sha256.
+
     :param api_gateway: The API Gateway wrapper object.
     :param account: The AWS account number of the current account.
     :param lambda_role_name: The name of an existing role that is associated with
@@ -103,17 +110,25 @@ def create_lambda(
     :param lambda_function_name: The name of an existing Lambda function that can
                                  handle websocket requests.
     :param lambda_client: A Boto3 Lambda client.
+    :param dry_run: Don't upload the code.
     """
     lambda_file_name = 'lambda_websocket.py'
-    print(f"Updating Lambda function {lambda_function_name} with code file "
-          f"{lambda_file_name}.")
     buffer = io.BytesIO()
     with zipfile.ZipFile(buffer, 'w') as zipped:
         zipped.write(lambda_file_name)
-    buffer.seek(0)
+    code = buffer.getvalue()
     try:
+        lambda_func = lambda_client.get_function(FunctionName=lambda_function_name)['Configuration']
+        if lambda_func['CodeSha256'] == base64.b64encode(hashlib.sha256(code).digest()).decode('ascii'):
+            print(f"Lambda function {lambda_function_name} is up to date.")
+            return lambda_func
+        if dry_run:
+            print(f"Lambda function {lambda_function_name} would be updated with code file {lambda_file_name}.")
+            return lambda_func
+        print(f"Updating Lambda function {lambda_function_name} with code file "
+              f"{lambda_file_name}.")
         lambda_func = lambda_client.update_function_code(
-            FunctionName=lambda_function_name, ZipFile=buffer.read())
+            FunctionName=lambda_function_name, ZipFile=code)
     except ClientError:
         logger.exception("Couldn't update Lambda function %s.", lambda_function_name)
         raise
@@ -126,26 +141,40 @@ def create_api_websocket(api_gateway:ApiGatewayHelper
         , iam_resource
         , lambda_client
         , lambda_func
+        , dry_run=False
+        , prune=False
         ):
+    """
+    Creates or updates the websocket API. Only what differs from the deployed API
+    is changed, so running it again on a deployed API makes no changes.
 
-    print(f"Creating websocket API {api_gateway.api_name}.")
-    api_gateway.create_api('$request.body.action')
-
-    print("Adding permission to let the Lambda function send messages to "
+    :param dry_run: Only print the changes.
+    :param prune: Also delete routes that are not in WEBSOCKET_ROUTES.
+    """
+    print(f"Reconciling websocket API {api_gateway.api_name}.")
+    plan = api_gateway.reconcile_websocket_api(
+        '$request.body.action', WEBSOCKET_ROUTES, lambda_func, lambda_client, account,
+        api_gateway.stage, prune=prune, dry_run=dry_run)
+    for change in plan:
+        print(f"\t{change['action']} {change.get('route', change.get('stage', ''))}")
+    if not plan:
+        print("\tThe websocket API is up to date.")
+    if dry_run:
+        return
+
+    print("Checking permission to let the Lambda function send messages to "
           "websocket connections.")
-    api_gateway.add_connection_permissions(account, lambda_role_name, iam_resource)
-
-    print("Adding routes to the API and integrating with the Lambda function.")
-    for route in ['$connect', '$disconnect', 'sendmessage']:
-        api_gateway.add_route_and_integration(route, lambda_func, lambda_client)
+    api_gateway.reconcile_connection_permissions(account, lambda_role_name, iam_resource)
 
-    print("Deploying the API to stage test.")
-    chat_uri = api_gateway.deploy_api(api_gateway.stage)
+    chat_uri = f'{api_gateway.api_endpoint}/{api_gateway.stage}'
 
     print("Try it yourself! Connect a websocket client to the URI to start as chat.")
     print(f"\tChat URI: {chat_uri}")
     print("Send messages in this format:")
     print('\t{"space":"space_name", "action": "sendmessage", "msg": "YOUR MESSAGE HERE"}')
+    print("Follow a channel and publish to it:")
+    print('\t{"action": "subscribe", "channel": "channel_name"}')
+    print('\t{"channel":"channel_name", "action": "sendmessage", "msg": "YOUR MESSAGE HERE"}')
 
 
 def update_lambda(lambda_function_name,lambda_file_name,
@@ -259,6 +288,12 @@ def main():
     parser.add_argument(
         'action', choices=['deploy-stack','deploy-rest', 'deploy-lbd', 'lbd-update', 'chat', 'destroy-stack'],
         help="Indicates the action the script performs.")
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="With 'deploy-lbd', print the changes without applying them.")
+    parser.add_argument(
+        '--prune', action='store_true',
+        help="With 'deploy-lbd', also delete websocket routes that are not used anymore.")
     args = parser.parse_args()
 
     print('-'*88)
@@ -308,10 +343,10 @@ def main():
             account = session.client('sts').get_caller_identity().get('Account')
             lambda_func=create_lambda(
                 api_gateway, account, lambda_role_name, session.resource('iam'),
-                lambda_function_name, session.client('lambda'))
+                lambda_function_name, session.client('lambda'), dry_run=args.dry_run)
 
             create_api_websocket( api_gateway, account, lambda_role_name, session.resource('iam'),
-                 session.client('lambda'),lambda_func)
+                 session.client('lambda'),lambda_func, dry_run=args.dry_run, prune=args.prune)
 
             print("To see an automated demo of how to use the API from a "
                   "websocket client, run the script again with the 'chat' flag.")
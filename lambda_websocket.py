@@ -12,7 +12,10 @@
 """
 import logging
 import os
-from lib import SocketHandleConnections
+import time
+from contextlib import ExitStack
+from lib import SocketHandleConnections, AsyncSocketHandleConnections
+from lib.profiler import get_profiler, fanout_bucket
 
 
 logger = logging.getLogger()
@@ -37,9 +40,68 @@ def lambda_handler(event, context):
     if not debug_mode:
         logger.debug('context.invoked_function_arn: %s context.aws_request_id: %s', context.invoked_function_arn, context.aws_request_id)
     
+    if event.get('source')=='aws.events':
+        # scheduled by EventBridge
+        return reaper_handler(event=event,context=context)
+
+    if os.environ.get('async_handler','false').lower()=='true':
+        bl=AsyncSocketHandleConnections()
+    else:
+        bl=SocketHandleConnections()
+    profiler=get_profiler()
+    if profiler is None and not bl.memory.enabled:
+        return bl.lambda_handler(event=event,context=context)
+    return profiled_handler(profiler,bl,event,context)
+
+def profiled_handler(profiler,bl,event,context):
+    """
+    runs the handler under the CPU profiler and the memory tracker when they are enabled.
+    The collapsed stacks and the memory peaks per stage are labeled with the route and
+    the fan-out size bucket, see lib.profiler and lib.memory_tracker.
+
+    :param profiler: A SamplingProfiler or None.
+    :param bl: The SocketHandleConnections that handles the event.
+    :param event: The lambda event.
+    :param context: Context around the request.
+    :return: The response of the handler.
+    """
+    name=getattr(context,'aws_request_id',None) or str(int(time.time()*1000))
+    with ExitStack() as stack:
+        profile=stack.enter_context(profiler.profile(name)) if profiler is not None else None
+        stack.enter_context(bl.memory.tracing())
+        try:
+            return bl.lambda_handler(event=event,context=context)
+        finally:
+            labels={"route": bl.route_key, "fanout": fanout_bucket(bl.fanout_size)}
+            if profile is not None:
+                profile.labels.update(labels)
+            bl.memory.report(**labels)
+
+def reaper_handler(event, context):
+    """
+    removes stale connections. Schedule it with EventBridge.
+    Age and chunk size are read from environment keys reaper_max_age_seconds
+    and reaper_chunk_size, and can be overridden in the event. With reaper_idle_seconds
+    connections that did not ping for that long are removed too; it must be larger
+    than last_seen_flush_seconds plus ping_interval_seconds, see LastSeenBuffer.
+    Processed queue message ids older than processed_retention_seconds (event or
+    environment) are removed as well.
+
+    :param event: The scheduled event.
+    :param context: Context around the request.
+    :return: A response dict with the status code and the number of removed rows.
+    """
+    max_age_seconds=int(event.get('max_age_seconds', os.environ.get('reaper_max_age_seconds', 7200)))
+    chunk_size=int(event.get('chunk_size', os.environ.get('reaper_chunk_size', 1000)))
+    idle_seconds=event.get('idle_seconds', os.environ.get('reaper_idle_seconds'))
+    idle_seconds=int(idle_seconds) if idle_seconds is not None else None
+    retention=event.get('processed_retention_seconds')
+    retention=int(retention) if retention is not None else None
+
     bl=SocketHandleConnections()
-    ret= bl.lambda_handler(event=event,context=context)
-    return ret    
+    deleted=bl.handle_reap(max_age_seconds=max_age_seconds,chunk_size=chunk_size,context=context
+                           ,idle_seconds=idle_seconds,processed_retention_seconds=retention)
+    return {'statusCode': 200, 'deleted': deleted}
 
 def test_lambda():
     """test lambda. We use an event dict for this.
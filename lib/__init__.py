@@ -1,10 +1,35 @@
 # Import specific modules
-from .socket_handle_connections import *  # or specific classes/functions you need
+# db helpers first: socket_handle_connections imports DBHelper from this package
+from .circuit_breaker import *
 from .db_helper import *
-from .di_db_helper import *
 from .db_helper_postgress import *
+from .db_helper_memory import *
+from .db_helper_sharded import *
+from .async_db_helper import *
+from .async_db_helper_postgress import *
+from .async_db_helper_memory import *
+from .di_db_helper import *
+from .idempotency import *
+from .codec import *
+from .fanout_queue import *
+from .blob_store import *
+from .route_registry import *
+from .profiler import *
+from .memory_tracker import *
+from .last_seen import *
+from .socket_handle_connections import *  # or specific classes/functions you need
+from .async_socket_handle_connections import *
 
 
 
 # Define __all__ to specify what should be exposed
-__all__ = ["DBHelper","DIDBHelper","DBHelperPostgress", "SocketHandleConnections"]
+__all__ = ["DBHelper","DIDBHelper","DBHelperPostgress","DBHelperMemory", "SocketHandleConnections"
+           ,"DBHelperShardedPostgress","HashRing"
+           ,"AsyncDBHelper","AsyncDBHelperPostgress","AsyncDBHelperMemory","AsyncSocketHandleConnections"
+           ,"IdempotencyGuard","IdempotencyStore","DBIdempotencyStore","MemoryIdempotencyStore"
+           ,"FanoutQueue","SQSFanoutQueue","MemoryFanoutQueue"
+           ,"BlobStore","S3BlobStore","LocalBlobStore"
+           ,"Codec","JsonCodec","OrjsonCodec","Compression","GzipCompression","DeflateCompression"
+           ,"CircuitBreaker","CircuitOpenError"
+           ,"RouteRegistry","RouteRequest","Route"
+           ,"SamplingProfiler","Profile","MemoryTracker","LastSeenBuffer"]
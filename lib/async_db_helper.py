@@ -0,0 +1,123 @@
+import contextlib
+
+
+class AsyncDBHelper:
+    """
+    Async counterpart of DBHelper. Same methods and arguments, every method is a
+    coroutine. shared_conn is a connection of the implementation driver.
+    """
+
+    def __init__(self,connection_data:dict=None):
+        raise NotImplementedError
+
+    @classmethod
+    def start_invocation(cls):
+        """ called at the start of every lambda invocation to reset per invocation state """
+        pass
+
+    async def connect(self):
+        """ returns a connection. The caller must release it with close() """
+        raise NotImplementedError
+
+    async def close(self, conn):
+        """ releases a connection returned by connect() """
+        raise NotImplementedError
+
+    @contextlib.asynccontextmanager
+    async def unit_of_work(self,read_only=False):
+        """ async DBHelper.unit_of_work: one connection and one transaction for a block of
+        calls, committed when the block ends. Helpers without connections yield None. """
+        yield None
+
+    async def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        """ insert a new connection. endpoint is the management API url of the socket, https://domain/stage.
+        compression is the frame compression accepted by the client, None for plain text frames """
+        raise NotImplementedError
+
+    async def update_connection(self, participant_id,socket_id,shared_conn=None):
+        """ update a connection. This case not exist. Always is creation and deletion  """
+        raise NotImplementedError
+
+    async def delete_connection_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ delete all connections by participant. """
+        raise NotImplementedError
+
+    async def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ delete connection by socket. """
+        raise NotImplementedError
+
+    async def select_connections_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ select connections by participant.
+
+        Returns:
+            list: list of connections available for user
+        """
+        raise NotImplementedError
+
+    async def select_connections_by_space(self, space,shared_conn=None):
+        """ select connections by space. """
+        raise NotImplementedError
+
+    async def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ select connections by socket_id. """
+        raise NotImplementedError
+
+    async def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        """ delete one chunk of connections created before cutoff or idle since idle_cutoff, only in space when given. """
+        raise NotImplementedError
+
+    async def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        """ writes the last keepalive time of many sockets (dict socket_id -> datetime) in one statement, only in space when given. """
+        raise NotImplementedError
+
+    async def insert_subscription(self, channel,socket_id,shared_conn=None):
+        """ subscribe a socket to a channel. """
+        raise NotImplementedError
+
+    async def delete_subscription(self, channel,socket_id,shared_conn=None):
+        """ unsubscribe a socket from a channel. """
+        raise NotImplementedError
+
+    async def select_connections_by_channel(self, channel,shared_conn=None):
+        """ select sockets subscribed to a channel. """
+        raise NotImplementedError
+
+    async def select_connection_count_by_space(self, space,shared_conn=None):
+        """ number of connections in a space. """
+        raise NotImplementedError
+
+    async def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ number of connections of a participant in a space. """
+        raise NotImplementedError
+
+    async def select_connection_counts(self, shared_conn=None):
+        """ connection counters of all spaces with connections """
+        raise NotImplementedError
+
+    async def select_connection_spaces(self, shared_conn=None):
+        """ spaces that have rows in client_connections """
+        raise NotImplementedError
+
+    async def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        """ record a message id as processed, or claim it with done False. """
+        raise NotImplementedError
+
+    async def select_processed_message(self, message_id,shared_conn=None):
+        """ check if a message id was already processed. """
+        raise NotImplementedError
+
+    async def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        """ delete one chunk of message ids processed before cutoff. """
+        raise NotImplementedError
+
+    async def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        """ append a message to the buffer of a participant, returns its sequence number. """
+        raise NotImplementedError
+
+    async def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        """ buffered messages after after_seq that did not expire, in sequence order. """
+        raise NotImplementedError
+
+    async def delete_expired_messages(self, limit=1000,shared_conn=None):
+        """ delete one chunk of expired buffered messages. """
+        raise NotImplementedError
@@ -0,0 +1,86 @@
+from .async_db_helper import AsyncDBHelper
+from .db_helper_memory import DBHelperMemory
+
+
+class AsyncDBHelperMemory(AsyncDBHelper):
+    """
+    Async access to the in-memory store. Shares its tables with DBHelperMemory,
+    so sync and async code see the same connections in tests.
+    """
+
+    def __init__(self,connection_data:dict=None):
+        self.db=DBHelperMemory(connection_data)
+
+    async def connect(self):
+        return None
+
+    async def close(self, conn):
+        pass
+
+    async def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        return self.db.insert_connection(participant_id=participant_id,socket_id=socket_id,space=space,endpoint=endpoint
+                                         ,compression=compression)
+
+    async def update_connection(self, participant_id,socket_id,shared_conn=None):
+        pass
+
+    async def delete_connection_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        return self.db.delete_connection_by_participant(participant_id=participant_id,space=space)
+
+    async def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        return self.db.delete_connection_by_socket(socket_id=socket_id,space=space)
+
+    async def select_connections_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        return self.db.select_connections_by_participant(participant_id=participant_id,space=space)
+
+    async def select_connections_by_space(self, space,shared_conn=None):
+        return self.db.select_connections_by_space(space=space)
+
+    async def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        return self.db.select_connection_by_socket(socket_id=socket_id,space=space)
+
+    async def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        return self.db.delete_connections_before(cutoff=cutoff,limit=limit,idle_cutoff=idle_cutoff,space=space)
+
+    async def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        return self.db.update_last_seen(last_seen=last_seen,space=space)
+
+    async def insert_subscription(self, channel,socket_id,shared_conn=None):
+        return self.db.insert_subscription(channel=channel,socket_id=socket_id)
+
+    async def delete_subscription(self, channel,socket_id,shared_conn=None):
+        return self.db.delete_subscription(channel=channel,socket_id=socket_id)
+
+    async def select_connections_by_channel(self, channel,shared_conn=None):
+        return self.db.select_connections_by_channel(channel=channel)
+
+    async def select_connection_count_by_space(self, space,shared_conn=None):
+        return self.db.select_connection_count_by_space(space=space)
+
+    async def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        return self.db.select_connection_count_by_participant(participant_id=participant_id,space=space)
+
+    async def select_connection_counts(self, shared_conn=None):
+        return self.db.select_connection_counts()
+
+    async def select_connection_spaces(self, shared_conn=None):
+        return self.db.select_connection_spaces()
+
+    async def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        return self.db.insert_processed_message(message_id=message_id,done=done)
+
+    async def select_processed_message(self, message_id,shared_conn=None):
+        return self.db.select_processed_message(message_id=message_id)
+
+    async def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        return self.db.delete_processed_messages_before(cutoff=cutoff,limit=limit)
+
+    async def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        return self.db.insert_buffered_message(participant_id=participant_id,space=space,message=message
+                                               ,ttl_seconds=ttl_seconds,max_messages=max_messages)
+
+    async def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        return self.db.select_buffered_messages(participant_id=participant_id,space=space,after_seq=after_seq,limit=limit)
+
+    async def delete_expired_messages(self, limit=1000,shared_conn=None):
+        return self.db.delete_expired_messages(limit=limit)
@@ -0,0 +1,343 @@
+import asyncio
+import contextlib
+import logging
+import os
+from collections import Counter
+from .async_db_helper import AsyncDBHelper
+from .db_helper_postgress import DBHelperPostgress
+from .circuit_breaker import CircuitBreaker
+
+try:
+    import asyncpg
+except ImportError:  # optional, only needed when this helper is selected
+    asyncpg = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDBHelperPostgress(AsyncDBHelper):
+    """
+    Async helper on asyncpg with a connection pool. Configuration is the same as
+    DBHelperPostgress (DDBB_CONFIG) plus DDBB_POOL_MIN_SIZE and DDBB_POOL_MAX_SIZE.
+    The pool is created on first use and shared by every instance using the same
+    database and event loop, so it lives as long as the lambda container.
+    """
+
+    _pools = {}     # (dsn key, loop) -> pool
+
+    def __init__(self,connection_data:dict=None):
+        self.log = logging.getLogger(__name__)
+        cfg=DBHelperPostgress(connection_data)
+        self.host       =cfg.host
+        self.port       =cfg.port
+        self.database   =cfg.database
+        self.user       =cfg.user
+        self.password   =cfg.password
+        # pooled connections are reused, so the statement cache is on unless switched off
+        self.prepare_statements=cfg.prepare_statements is not False
+        self.connect_timeout=cfg.connect_timeout
+        self.statement_timeout=cfg.statement_timeout
+        self.breaker_failures=cfg.breaker_failures
+        self.breaker_reset_timeout=cfg.breaker_reset_timeout
+        self.min_size=int(os.environ.get('DDBB_POOL_MIN_SIZE', 1))
+        self.max_size=int(os.environ.get('DDBB_POOL_MAX_SIZE', 10))
+
+    async def get_pool(self):
+        """ returns the pool of this database in the running loop, creating it if necessary """
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is not installed. Install it to use AsyncDBHelperPostgress")
+        loop=asyncio.get_running_loop()
+        key=(self.host,self.port,self.database,self.user,loop)
+        pool=AsyncDBHelperPostgress._pools.get(key)
+        if pool is None:
+            # behind PgBouncer in transaction mode the statement cache must be off
+            pool=await asyncpg.create_pool(
+                host=self.host,
+                port=self.port,
+                database=self.database,
+                user=self.user,
+                password=self.password,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                statement_cache_size=100 if self.prepare_statements else 0,
+                timeout=self.connect_timeout,
+                command_timeout=self.statement_timeout/1000 if self.statement_timeout>0 else None)
+            # another task may have created it while we were waiting
+            pool=AsyncDBHelperPostgress._pools.setdefault(key,pool)
+        return pool
+
+    def get_breaker(self):
+        """ circuit breaker of the database, the same one DBHelperPostgress uses """
+        return CircuitBreaker.get_breaker(f"{self.host}:{self.port}/{self.database}"
+                                          ,failure_threshold=self.breaker_failures
+                                          ,reset_timeout=self.breaker_reset_timeout)
+
+    async def connect(self):
+        """ acquires a pooled connection. Raises CircuitOpenError without waiting for
+        the pool while the breaker is open """
+        breaker=self.get_breaker()
+        breaker.before_call()
+        try:
+            pool=await self.get_pool()
+            conn=await pool.acquire()
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return conn
+
+    async def close(self, conn):
+        pool=await self.get_pool()
+        await pool.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def unit_of_work(self,read_only=False):
+        """ one pooled connection and one transaction for a block of calls. Pass the yielded
+        connection as shared_conn; it is committed when the block ends and rolled back if it raises """
+        conn=await self.connect()
+        try:
+            async with conn.transaction(readonly=read_only):
+                yield conn
+        finally:
+            await self.close(conn)
+
+    async def _run(self, shared_conn, work):
+        """ runs work(conn) in a transaction, on shared_conn or on a pooled connection """
+        if shared_conn is not None:
+            return await work(shared_conn)
+        conn=await self.connect()
+        try:
+            async with conn.transaction():
+                return await work(conn)
+        finally:
+            await self.close(conn)
+
+    async def _update_connection_counts(self,conn,rows,delta):
+        """ apply a change to the connection counters inside the caller transaction. """
+        if not rows:
+            return
+        by_participant=Counter((str(row[0]),str(row[1])) for row in rows)
+        by_space=Counter()
+        for (participant_id,space),count in by_participant.items():
+            by_space[space]+=count
+        keys=sorted(by_participant)
+        await conn.execute(
+            """INSERT INTO participant_connection_counts(participant_id,space,connections)
+                select * from unnest($1::varchar[],$2::varchar[],$3::integer[])
+                ON CONFLICT (participant_id,space)
+                DO UPDATE SET connections=participant_connection_counts.connections+EXCLUDED.connections;""",
+            [key[0] for key in keys],[key[1] for key in keys],[by_participant[key]*delta for key in keys])
+        spaces=sorted(by_space)
+        await conn.execute(
+            """INSERT INTO space_connection_counts(space,connections)
+                select * from unnest($1::varchar[],$2::integer[])
+                ON CONFLICT (space)
+                DO UPDATE SET connections=space_connection_counts.connections+EXCLUDED.connections;""",
+            spaces,[by_space[space]*delta for space in spaces])
+
+    async def _connections_deleted(self,conn,rows):
+        if not rows:
+            return
+        await self._update_connection_counts(conn,[(row['participant_id'],row['space']) for row in rows],delta=-1)
+        await conn.execute("""delete from channel_subscriptions where socket_id = ANY($1::varchar[]);""",
+                           [row['socket_id'] for row in rows])
+
+    async def _delete_returning(self,sql,params,shared_conn):
+        async def work(conn):
+            rows=await conn.fetch(sql,*params)
+            await self._connections_deleted(conn,rows)
+            return len(rows)
+        return await self._run(shared_conn,work)
+
+    async def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        """ insert a new connection  """
+        async def work(conn):
+            await conn.execute("""INSERT INTO client_connections(participant_id,socket_id,space,endpoint,compression)
+                VALUES($1,$2,$3,$4,$5);""",str(participant_id),socket_id,space,endpoint,compression)
+            await self._update_connection_counts(conn,[(str(participant_id),space)],delta=1)
+        await self._run(shared_conn,work)
+        return None
+
+    async def update_connection(self, participant_id,socket_id,shared_conn=None):
+        pass
+
+    async def delete_connection_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ delete all connections by participant. """
+        return await self._delete_returning(
+            """delete from client_connections where participant_id =$1 and space=$2
+                returning participant_id,space,socket_id;""",(str(participant_id),space),shared_conn)
+
+    async def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ delete connection by socket. Pass space to limit the delete to one partition """
+        if space is None:
+            return await self._delete_returning(
+                """delete from client_connections where socket_id =$1
+                    returning participant_id,space,socket_id;""",(socket_id,),shared_conn)
+        return await self._delete_returning(
+            """delete from client_connections where socket_id =$1 and space=$2
+                returning participant_id,space,socket_id;""",(socket_id,str(space)),shared_conn)
+
+    async def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        """ delete one chunk of connections created before cutoff or idle since idle_cutoff.
+        Pass space to limit the delete to one partition """
+        condition="connected < $1"
+        params=[cutoff,int(limit)]
+        if idle_cutoff is not None:
+            condition="(connected < $1 or last_seen < $3)"
+            params.append(idle_cutoff)
+        space_condition=""
+        if space is not None:
+            space_condition=f"space=${len(params)+1} and "
+            params.append(str(space))
+        return await self._delete_returning(
+            f"""delete from client_connections where {space_condition}socket_id in (
+                    select socket_id from client_connections where {space_condition}{condition}
+                    limit $2 for update skip locked)
+                returning participant_id,space,socket_id;""",tuple(params),shared_conn)
+
+    async def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        """ writes the last keepalive time of many sockets (dict socket_id -> datetime) in one statement.
+        Pass space to limit the update to one partition """
+        if not last_seen:
+            return 0
+        # sorted so concurrent batches lock the rows in the same order
+        sockets=sorted(last_seen)
+        params=(sockets,[last_seen[socket_id] for socket_id in sockets])
+        space_condition=""
+        if space is not None:
+            space_condition="c.space=$3 and "
+            params=params+(str(space),)
+        async def work(conn):
+            status=await conn.execute(
+                f"""update client_connections c set last_seen=v.last_seen
+                    from unnest($1::varchar[],$2::timestamptz[]) as v(socket_id,last_seen)
+                    where {space_condition}c.socket_id=v.socket_id and (c.last_seen is null or c.last_seen<v.last_seen);""",
+                *params)
+            return int(status.split()[-1])
+        return await self._run(shared_conn,work)
+
+    async def _fetch(self,sql,params,shared_conn):
+        async def work(conn):
+            return await conn.fetch(sql,*params)
+        return await self._run(shared_conn,work)
+
+    async def select_connections_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ select connections by participant. """
+        rows=await self._fetch("""select participant_id,socket_id,endpoint,compression from client_connections
+            where participant_id =$1 AND space=$2;""",(str(participant_id),str(space)),shared_conn)
+        return [{"participant_id": row[0], "socket_id":row[1], "endpoint":row[2], "compression":row[3]} for row in rows]
+
+    async def select_connections_by_space(self, space,shared_conn=None):
+        """ select connections by space. """
+        rows=await self._fetch("""select participant_id,socket_id,endpoint,compression from client_connections where space =$1;""",
+                               (str(space),),shared_conn)
+        return [{"participant_id": row[0], "socket_id":row[1], "endpoint":row[2], "compression":row[3]} for row in rows]
+
+    async def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ select connections by socket_id. """
+        if space is None:
+            rows=await self._fetch("""select participant_id,socket_id,endpoint,space,compression from client_connections where socket_id =$1;""",
+                                   (str(socket_id),),shared_conn)
+        else:
+            rows=await self._fetch("""select participant_id,socket_id,endpoint,space,compression from client_connections
+                where socket_id =$1 and space=$2;""",(str(socket_id),str(space)),shared_conn)
+        if not rows:
+            return None
+        return {"participant_id": rows[0][0], "socket_id":rows[0][1], "endpoint":rows[0][2], "space":rows[0][3], "compression":rows[0][4]}
+
+    async def insert_subscription(self, channel,socket_id,shared_conn=None):
+        """ subscribe a socket to a channel. """
+        rows=await self._fetch("""INSERT INTO channel_subscriptions(channel,socket_id) VALUES($1,$2)
+            ON CONFLICT (channel,socket_id) DO NOTHING returning channel;""",(str(channel),socket_id),shared_conn)
+        return len(rows)>0
+
+    async def delete_subscription(self, channel,socket_id,shared_conn=None):
+        """ unsubscribe a socket from a channel. """
+        rows=await self._fetch("""delete from channel_subscriptions where channel =$1 and socket_id=$2
+            returning channel;""",(str(channel),socket_id),shared_conn)
+        return len(rows)
+
+    async def select_connections_by_channel(self, channel,shared_conn=None):
+        """ select sockets subscribed to a channel. """
+        rows=await self._fetch("""select s.channel,s.socket_id,c.endpoint,c.compression from channel_subscriptions s
+            left join client_connections c on c.socket_id=s.socket_id where s.channel =$1;""",(str(channel),),shared_conn)
+        return [{"channel": row[0], "socket_id": row[1], "endpoint": row[2], "compression": row[3]} for row in rows]
+
+    async def select_connection_count_by_space(self, space,shared_conn=None):
+        """ number of connections in a space. """
+        rows=await self._fetch("""select connections from space_connection_counts where space =$1;""",
+                               (str(space),),shared_conn)
+        return max(rows[0][0],0) if rows else 0
+
+    async def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ number of connections of a participant in a space. """
+        rows=await self._fetch("""select connections from participant_connection_counts
+            where participant_id =$1 and space=$2;""",(str(participant_id),str(space)),shared_conn)
+        return max(rows[0][0],0) if rows else 0
+
+    async def select_connection_counts(self, shared_conn=None):
+        """ connection counters of all spaces with connections """
+        rows=await self._fetch("""select space,connections from space_connection_counts
+            where connections>0 order by space;""",(),shared_conn)
+        return [{"space": row[0], "connections": row[1]} for row in rows]
+
+    async def select_connection_spaces(self, shared_conn=None):
+        """ spaces that have rows in client_connections, see DBHelperPostgress """
+        rows=await self._fetch("""with recursive spaces as (
+                (select space from client_connections order by space limit 1)
+                union all
+                select (select c.space from client_connections c where c.space > s.space order by c.space limit 1)
+                from spaces s where s.space is not null)
+            select space from spaces where space is not null;""",(),shared_conn)
+        return [row[0] for row in rows]
+
+    async def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        """ record a message id as processed, or claim it with done False. """
+        rows=await self._fetch("""INSERT INTO processed_messages(message_id,done) VALUES($1,$2)
+            ON CONFLICT (message_id) DO UPDATE SET processed=now(),done=EXCLUDED.done
+            WHERE processed_messages.done=false returning message_id;""",(str(message_id),bool(done)),shared_conn)
+        return len(rows)>0
+
+    async def select_processed_message(self, message_id,shared_conn=None):
+        """ check if a message id was already processed. """
+        rows=await self._fetch("""select 1 from processed_messages where message_id =$1 and done;""",
+                               (str(message_id),),shared_conn)
+        return len(rows)>0
+
+    async def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        """ delete one chunk of message ids processed before cutoff. """
+        rows=await self._fetch("""delete from processed_messages where message_id in (
+                select message_id from processed_messages where processed < $1
+                limit $2 for update skip locked) returning message_id;""",(cutoff,int(limit)),shared_conn)
+        return len(rows)
+
+    async def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        """ append a message to the buffer of a participant, returns its sequence number. """
+        rows=await self._fetch("""WITH next AS (
+                INSERT INTO participant_message_seqs(participant_id,space,last_seq) VALUES($1,$2,1)
+                ON CONFLICT (participant_id,space)
+                DO UPDATE SET last_seq=participant_message_seqs.last_seq+1
+                returning last_seq),
+            stored AS (
+                INSERT INTO participant_messages(participant_id,space,seq,message,expires)
+                select $1,$2,last_seq,$3,now()+make_interval(secs => $4) from next),
+            trimmed AS (
+                delete from participant_messages
+                where participant_id=$1 and space=$2 and seq <= (select last_seq from next)-$5)
+            select last_seq from next;""",(str(participant_id),str(space),message,float(ttl_seconds),int(max_messages)),shared_conn)
+        return rows[0][0]
+
+    async def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        """ buffered messages after after_seq that did not expire, in sequence order. """
+        rows=await self._fetch("""select seq,message from participant_messages
+            where participant_id =$1 and space=$2 and seq>$3 and expires>now()
+            order by seq limit $4;""",(str(participant_id),str(space),int(after_seq),int(limit)),shared_conn)
+        return [{"seq": row[0], "message": row[1]} for row in rows]
+
+    async def delete_expired_messages(self, limit=1000,shared_conn=None):
+        """ delete one chunk of expired buffered messages. """
+        rows=await self._fetch("""delete from participant_messages where (participant_id,space,seq) in (
+                select participant_id,space,seq from participant_messages where expires < now()
+                limit $1 for update skip locked) returning seq;""",(int(limit),),shared_conn)
+        return len(rows)
@@ -0,0 +1,235 @@
+"""
+Async variant of SocketHandleConnections. Select it in lambda_websocket with the
+environment key async_handler=true and the DB helper with async_db_handler.
+"""
+import asyncio
+import contextlib
+import functools
+import logging
+import sys
+from botocore.exceptions import ClientError
+from lib.di_db_helper import DIDBHelper
+from lib.circuit_breaker import CircuitOpenError
+from lib.socket_handle_connections import SocketHandleConnections
+
+
+logger = logging.getLogger()
+
+
+class AsyncSocketHandleConnections(SocketHandleConnections):
+    """
+    Handles messages with the async DB helper. Posts to the recipients run
+    concurrently in a thread pool (boto3 is blocking) and gone sockets are
+    deleted once the posts are done. CircuitOpenError of the async helper is
+    raised to lambda_handler, which answers 503.
+
+    The routes in ASYNC_ROUTES run in an asyncpg unit of work instead of the
+    psycopg2 one: their writes and the processed mark of a queue message commit
+    together, and the deliveries run after the commit like in the sync handler.
+    The other routes use the sync helper.
+    """
+
+    # container wide loop. asyncpg pools are bound to the loop that created them
+    _loop = None
+    # routes whose writes go through the async helper
+    ASYNC_ROUTES = frozenset(('sendmessage',))
+
+    @classmethod
+    def get_event_loop(cls):
+        if cls._loop is None or cls._loop.is_closed():
+            cls._loop = asyncio.new_event_loop()
+        return cls._loop
+
+    def get_async_db_handler(self):
+        return DIDBHelper.get_instance().resolve_async()
+
+    @contextlib.contextmanager
+    def run_async_context(self,context):
+        """ enters an async context manager in the container loop, so the sync code of the
+        block runs inside it. The loop is not running between the steps """
+        loop=self.get_event_loop()
+        value=loop.run_until_complete(context.__aenter__())
+        try:
+            yield value
+        except BaseException:
+            if not loop.run_until_complete(context.__aexit__(*sys.exc_info())):
+                raise
+        else:
+            loop.run_until_complete(context.__aexit__(None,None,None))
+
+    def unit_of_work(self,route,request):
+        """ asyncpg unit of work for ASYNC_ROUTES, no psycopg2 connection is opened """
+        if route.route_key not in self.ASYNC_ROUTES:
+            return super().unit_of_work(route,request)
+        return self.run_async_context(self.get_async_db_handler().unit_of_work(
+            read_only=route.read_only and request.caller_type!="SQS"))
+
+    def claim_message(self,guard,route):
+        """ claim of the queue message with the async helper, in its unit of work """
+        if route.route_key not in self.ASYNC_ROUTES:
+            return super().claim_message(guard,route)
+        if self.message_id is None:
+            return True
+        if guard.is_cached(self.message_id):
+            return False
+        claimed=self.get_event_loop().run_until_complete(self.get_async_db_handler().insert_processed_message(
+            message_id=self.message_id,done=False,shared_conn=self.shared_conn))
+        if not claimed:
+            guard.remember(self.message_id)
+        return claimed
+
+    def complete_message(self,guard,route):
+        """ completion of the queue message with the async helper """
+        if route.route_key not in self.ASYNC_ROUTES:
+            return super().complete_message(guard,route)
+        if self.message_id is None:
+            return
+        self.get_event_loop().run_until_complete(self.get_async_db_handler().insert_processed_message(
+            message_id=self.message_id,done=True,shared_conn=self.shared_conn))
+
+    async def after_commit_async(self,work):
+        """ after_commit for coroutines. work() is awaited now when there is no unit of work """
+        if self._after_commit is None:
+            await work()
+        else:
+            self.after_commit(lambda: self.get_event_loop().run_until_complete(work()))
+
+    def handle_message(self,event_body, apig_management_client):
+        """ runs handle_message_async in the container loop """
+        return self.get_event_loop().run_until_complete(
+            self.handle_message_async(event_body=event_body,apig_management_client=apig_management_client))
+
+    async def handle_message_async(self,event_body, apig_management_client):
+        """
+        Same contract as SocketHandleConnections.handle_message.
+
+        :param event_body: dict with `msg` and either `channel` or `participant_id` and `space`.
+        :param apig_management_client: A Boto3 API Gateway Management API client.
+        :return: An HTTP status code.
+        """
+        channel = event_body.get('channel')
+        participant_id = event_body.get('participant_id')
+        space = event_body.get('space')
+        db=self.get_async_db_handler()
+
+        with self.memory.stage("payload"):
+            try:
+                content=self.encode_content(event_body['msg'])
+            except Exception:
+                logger.exception("Couldn't offload the payload for participant %s channel %s.", participant_id, channel)
+                return 503
+            if content is None:
+                return 413
+
+            seq=None
+            if channel is None:
+                seq=await self.buffer_message_async(db=db,participant_id=participant_id,space=space,content=content)
+
+        # recipients are read on a pooled connection of their own, not in the unit of work
+        with self.memory.stage("lookup"):
+            try:
+                if channel is not None:
+                    connections = await db.select_connections_by_channel(channel=str(channel))
+                else:
+                    connections = await db.select_connections_by_participant(participant_id=str(participant_id),space=space)
+            except CircuitOpenError:
+                raise
+            except Exception as ex:
+                logger.exception("handle_message_async() Couldn't find connections for participant %s channel %s %s", participant_id, channel, str(ex))
+                return 404
+            targets={}  # (endpoint, compression) -> sockets
+            for conn in connections:
+                if conn.get("socket_id"):
+                    targets.setdefault((conn.get("endpoint"),conn.get("compression")),[]).append(conn.get("socket_id"))
+            del connections
+
+        if len(targets)==0:
+            if seq is not None:
+                logger.info("No sockets for %s, message %s buffered.", participant_id, seq)
+                return 202
+            logger.exception("There are no sockets available.")
+            return 404
+        self.fanout_size=sum(len(sockets) for sockets in targets.values())
+
+        with self.memory.stage("payload"):
+            message = self.build_message(event_body=event_body,content=content,seq=seq)
+            # compressed once per compression
+            frames={compression: self.compress_message(message,compression) for _,compression in targets}
+        space=None if channel is not None else space
+
+        # one concurrent delivery batch per endpoint and compression, once the buffered message is committed
+        async def deliver():
+            with self.memory.stage("delivery"):
+                await asyncio.gather(*(
+                    self.post_to_sockets_async(sockets=self.scatter(sockets=sockets,message=message,space=space,endpoint=endpoint
+                                                                    ,compression=compression)
+                                               ,message=frames[compression]
+                                               ,apig_management_client=self.get_management_client(endpoint) if endpoint else apig_management_client
+                                               ,db=db,space=space)
+                    for (endpoint,compression),sockets in targets.items()))
+        await self.after_commit_async(deliver)
+        return 200
+
+    async def buffer_message_async(self,db,participant_id,space,content):
+        """ SocketHandleConnections.buffer_message with the async DB helper """
+        max_messages,ttl_seconds=self.get_buffer_config()
+        if max_messages<=0 or participant_id is None:
+            return None
+        try:
+            return await db.insert_buffered_message(participant_id=str(participant_id),space=space or self.space
+                                                    ,message=content.decode('utf-8')
+                                                    ,ttl_seconds=ttl_seconds,max_messages=max_messages
+                                                    ,shared_conn=self.shared_conn)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            logger.exception("Couldn't buffer message for %s.", participant_id)
+            return None
+
+    def handle_fanout_chunk(self,event_body,apig_management_client):
+        """ delivers one chunk enqueued by scatter with concurrent posts """
+        self.fanout_size=len(event_body['sockets'])
+        if event_body.get('endpoint'):
+            apig_management_client=self.get_management_client(event_body['endpoint'])
+        message=self.compress_message(event_body['message'].encode('utf-8'),event_body.get('compression'))
+        self.after_commit(lambda: self.get_event_loop().run_until_complete(self.post_to_sockets_async(
+            sockets=event_body['sockets'],message=message,apig_management_client=apig_management_client
+            ,db=self.get_async_db_handler(),space=event_body.get('space'))))
+        return 200
+
+    async def post_to_sockets_async(self,sockets,message,apig_management_client,db,space=None):
+        """
+        Posts the message to every socket concurrently. Gone sockets are removed
+        afterwards in one short transaction of their own.
+
+        :param sockets: list of websocket connection IDs.
+        :param message: The message to send.
+        :param apig_management_client: A Boto3 API Gateway Management API client.
+        :param db: async DB helper used to remove gone sockets.
+        :param space: Space of the sockets if they all share one.
+        """
+        loop=asyncio.get_running_loop()
+        executor=self.get_executor()
+
+        async def post(socket_id):
+            try:
+                await loop.run_in_executor(executor, functools.partial(
+                    apig_management_client.post_to_connection, Data=message, ConnectionId=socket_id))
+                logger.debug("Posted message to connection %s.", socket_id)
+            except apig_management_client.exceptions.GoneException:
+                logger.info("Connection %s is gone, removing.", socket_id)
+                gone.append(socket_id)
+            except ClientError as ex:
+                logger.exception("Couldn't post to connection %s. Error: %s", socket_id,str(ex))
+
+        gone=[]
+        await asyncio.gather(*(post(socket_id) for socket_id in sockets))
+        if not gone:
+            return
+        try:
+            async with db.unit_of_work() as shared_conn:
+                # sorted so concurrent batches lock the rows in the same order
+                for socket_id in sorted(gone):
+                    await db.delete_connection_by_socket(socket_id=socket_id,space=space,shared_conn=shared_conn)
+        except Exception:
+            logger.exception("Couldn't remove %s gone connections.", len(gone))
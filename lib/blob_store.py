@@ -0,0 +1,106 @@
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+import boto3
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    Store for payloads too large for a websocket frame. A payload is stored once under
+    the sha256 of its content and recipients get a reference with its url.
+    """
+
+    def put(self, data, content_type='application/json'):
+        """ stores data (bytes) once and returns its reference dict: url, bytes and sha256 """
+        digest = hashlib.sha256(data).hexdigest()
+        self._put(digest, data, content_type)
+        return {"url": self.url(digest), "bytes": len(data), "sha256": digest}
+
+    def _put(self, key, data, content_type):
+        raise NotImplementedError
+
+    def get(self, key):
+        """ content stored under key """
+        raise NotImplementedError
+
+    def url(self, key):
+        """ url the clients download key from """
+        raise NotImplementedError
+
+
+class S3BlobStore(BlobStore):
+    """Stores the payloads in an S3 bucket (env blob_store_bucket). Clients download them
+    with presigned urls valid for url_expires seconds (env blob_url_expires, default 3600)."""
+
+    def __init__(self, bucket, prefix='payloads/', url_expires=3600, client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expires = url_expires
+        self.client = client if client is not None else boto3.client('s3')
+
+    def _put(self, key, data, content_type):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix+key, Body=data, ContentType=content_type)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.prefix+key)['Body'].read()
+
+    def url(self, key):
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.prefix+key}
+                                                  , ExpiresIn=self.url_expires)
+
+
+class LocalBlobStore(BlobStore):
+    """Keeps the payloads in a local directory (env blob_store_dir). For tests and local runs,
+    urls are file urls unless base_url is given."""
+
+    def __init__(self, directory, base_url=None):
+        self.directory = Path(directory)
+        self.base_url = base_url
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return self.directory / key
+
+    def _put(self, key, data, content_type):
+        path = self._path(key)
+        with self._lock:
+            if path.exists():
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+
+    def get(self, key):
+        return self._path(key).read_bytes()
+
+    def url(self, key):
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{key}"
+        return self._path(key).resolve().as_uri()
+
+
+_stores = {}
+
+
+def get_blob_store():
+    """ returns the configured blob store or None when offload is not configured.
+    Environment key blob_store_bucket selects S3, blob_store_dir a local directory """
+    bucket = os.environ.get('blob_store_bucket')
+    directory = os.environ.get('blob_store_dir')
+    if bucket:
+        key = ('s3', bucket)
+        if key not in _stores:
+            _stores[key] = S3BlobStore(bucket, url_expires=int(os.environ.get('blob_url_expires', 3600)))
+    elif directory:
+        key = ('local', directory)
+        if key not in _stores:
+            _stores[key] = LocalBlobStore(directory, base_url=os.environ.get('blob_base_url'))
+    else:
+        return None
+    return _stores[key]
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the protected resource while the breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a database. After failure_threshold consecutive failures it
+    opens and calls fail fast with CircuitOpenError. After reset_timeout seconds it
+    becomes half-open and lets one probe call through: a success closes it, a
+    failure opens it again. One breaker is shared by all helpers of a database, see
+    get_breaker. State changes are written to the log as CloudWatch embedded metrics.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    # metric value of each state
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.probe_in_flight = False
+        self.rejected = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_breaker(cls, name, failure_threshold=5, reset_timeout=30):
+        """Returns the shared breaker of this name, creating it if necessary."""
+        with cls._breakers_lock:
+            if name not in cls._breakers:
+                cls._breakers[name] = cls(name, failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+            return cls._breakers[name]
+
+    def before_call(self):
+        """ call before using the resource. Raises CircuitOpenError when the call must not be done """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic()-self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit {self.name} is open")
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.probe_in_flight = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.opened += 1
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        logger.warning("Circuit %s changed from %s to %s.", self.name, self.state, state)
+        self.state = state
+        self.emit_metrics()
+
+    def metrics(self):
+        """ current state and counters of the breaker """
+        return {"circuit": self.name, "state": self.state, "failures": self.failures,
+                "opened": self.opened, "rejected": self.rejected}
+
+    def emit_metrics(self):
+        """ writes the breaker state as a CloudWatch embedded metric format log line.
+        Namespace from environment key metrics_namespace """
+        namespace = os.environ.get("metrics_namespace", "WebsocketApp")
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time()*1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [["circuit"]],
+                    "Metrics": [{"Name": "CircuitState"}, {"Name": "CircuitRejected", "Unit": "Count"}]}]},
+            "circuit": self.name,
+            "state": self.state,
+            "CircuitState": self.STATE_VALUES[self.state],
+            "CircuitRejected": self.rejected}
+        # print, not logger: EMF must be the whole log line
+        print(json.dumps(record))
@@ -0,0 +1,125 @@
+import gzip
+import json
+import logging
+import os
+import zlib
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used without it
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class Codec:
+    """
+    Encodes and decodes message payloads. dumps always returns bytes, so a payload is
+    encoded once and the same bytes are posted to every recipient.
+    """
+
+    name = None
+
+    def loads(self, data):
+        """ decodes str or bytes """
+        raise NotImplementedError
+
+    def dumps(self, obj) -> bytes:
+        """ encodes obj to utf-8 json bytes """
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """Standard library json."""
+
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonCodec(Codec):
+    """orjson, several times faster than the standard library and already returns bytes."""
+
+    name = "orjson"
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj)
+
+
+class Compression:
+    """
+    Compression of websocket frames, negotiated by each client at $connect. The
+    compressed frames are posted as binary frames.
+    """
+
+    name = None
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data) -> bytes:
+        raise NotImplementedError
+
+
+class GzipCompression(Compression):
+    """gzip, DecompressionStream('gzip') in the browser. mtime is fixed so equal frames are equal bytes."""
+
+    name = "gzip"
+
+    def compress(self, data) -> bytes:
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def decompress(self, data) -> bytes:
+        return gzip.decompress(data)
+
+
+class DeflateCompression(Compression):
+    """zlib stream, DecompressionStream('deflate') in the browser."""
+
+    name = "deflate"
+
+    def compress(self, data) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data) -> bytes:
+        return zlib.decompress(data)
+
+
+codecs = {"json": JsonCodec, "orjson": OrjsonCodec}
+compressions = {"gzip": GzipCompression, "deflate": DeflateCompression}
+_codec = None
+_compressions = {}
+
+
+def get_codec() -> Codec:
+    """ returns the container wide codec. Environment key json_codec selects it, by default
+    orjson when it is installed and json otherwise """
+    global _codec
+    if _codec is None:
+        name = os.environ.get('json_codec', 'orjson' if orjson is not None else 'json')
+        if name == 'orjson' and orjson is None:
+            logger.warning("orjson is not installed, using json codec.")
+            name = 'json'
+        _codec = codecs[name]()
+    return _codec
+
+
+def get_compression(name):
+    """ returns the container wide compression called name, None for None and unknown names.
+    Environment key compression_level sets the level, default 6 """
+    if name not in compressions:
+        return None
+    if name not in _compressions:
+        _compressions[name] = compressions[name](level=int(os.environ.get('compression_level', 6)))
+    return _compressions[name]
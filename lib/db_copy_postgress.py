@@ -0,0 +1,81 @@
+"""
+Moves client_connections between databases with COPY, for region failover or
+blue/green database swaps. Uses the database configured in the environment.
+
+    python -m lib.db_copy_postgress export connections.csv
+    python -m lib.db_copy_postgress import connections.csv
+    python -m lib.db_copy_postgress export connections.bin --format binary
+
+Use '-' as file name for stdout/stdin, so both sides can be piped:
+
+    python -m lib.db_copy_postgress export - | ENV_TYPE=DR python -m lib.db_copy_postgress import -
+"""
+import argparse
+import logging
+import os
+import sys
+from .db_helper_postgress import DBHelperPostgress
+
+
+logger = logging.getLogger(__name__)
+
+
+def export_connections(file_name,format="csv",db:DBHelperPostgress=None):
+    """ exports client_connections to a file
+
+    Args:
+        file_name (str): file to write, '-' for stdout
+        format (str, optional): 'csv' or 'binary'. Defaults to "csv".
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+
+    Returns:
+        int: exported rows
+    """
+    if db is None:
+        db=DBHelperPostgress()
+    if file_name=='-':
+        return db.export_connections(sys.stdout.buffer,format=format)
+    with open(file_name,'wb') as file:
+        return db.export_connections(file,format=format)
+
+
+def import_connections(file_name,format="csv",db:DBHelperPostgress=None):
+    """ imports client_connections from a file written by export_connections
+
+    Args:
+        file_name (str): file to read, '-' for stdin
+        format (str, optional): 'csv' or 'binary'. Defaults to "csv".
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+
+    Returns:
+        int: imported rows
+    """
+    if db is None:
+        db=DBHelperPostgress()
+    if file_name=='-':
+        return db.import_connections(sys.stdin.buffer,format=format)
+    with open(file_name,'rb') as file:
+        return db.import_connections(file,format=format)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import client_connections with COPY.")
+    parser.add_argument('action', choices=['export', 'import'], help="Indicates the action the script performs.")
+    parser.add_argument('file', help="file name, '-' for stdout/stdin")
+    parser.add_argument('--format', choices=sorted(DBHelperPostgress.COPY_FORMATS), default="csv")
+    args = parser.parse_args()
+
+    if args.action == 'export':
+        rows=export_connections(args.file,format=args.format)
+        logger.info("Exported %s connections.", rows)
+    elif args.action == 'import':
+        rows=import_connections(args.file,format=args.format)
+        logger.info("Imported %s connections.", rows)
+
+
+if __name__ == '__main__':
+    from .load_env import load_env
+    # logs go to stderr so stdout can carry the data
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s', stream=sys.stderr)
+    load_env(env_file_name="apigateway",env_type=os.environ.get('ENV_TYPE',"DEV"))
+    main()
@@ -1,3 +1,6 @@
+import contextlib
+
+
 
 class DBHelper:
     """
@@ -14,9 +17,22 @@ class DBHelper:
         """ Connect to the database server . Primarily to postgress"""
         raise NotImplementedError
 
+    @classmethod
+    def start_invocation(cls):
+        """ called at the start of every lambda invocation to reset per invocation state """
+        pass
+
+    @contextlib.contextmanager
+    def unit_of_work(self,read_only=False):
+        """ one connection and one transaction for a block of calls. Yields the
+        connection to pass as shared_conn, committed once when the block ends and
+        rolled back if it raises. Helpers without connections yield None. """
+        yield None
 
-    def insert_connection(self, participant_id,socket_id,space="PUBLIC",shared_conn=None):
-        """ insert a new connection  """
+
+    def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        """ insert a new connection. endpoint is the management API url of the socket, https://domain/stage.
+        compression is the frame compression accepted by the client, None for plain text frames """
         raise NotImplementedError
 
     def update_connection(self, participant_id,socket_id,shared_conn=None):
@@ -36,8 +52,9 @@ class DBHelper:
         
         
 
-    def delete_connection_by_socket(self, socket_id,shared_conn=None):
-        """ delete connection by socket. This is used by socket system """
+    def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ delete connection by socket. This is used by socket system.
+        space is optional, when given the query is limited to that space (partition pruning) """
         raise NotImplementedError
         
     def select_connections_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
@@ -61,8 +78,142 @@ class DBHelper:
         """ select connections by space. """
         raise NotImplementedError  
     
-    def select_connection_by_socket(self, socket_id,shared_conn=None):
-        """ select connections by socket_id. """
+    def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ select connections by socket_id. space is optional, when given the query is limited to that space """
+        raise NotImplementedError
+
+    def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        """ delete one chunk of connections created before cutoff. Used by the reaper.
+
+        Args:
+            cutoff (datetime): connections with connected < cutoff are deleted
+            idle_cutoff (datetime, optional): connections with last_seen < idle_cutoff are deleted too.
+                Connections that never sent a keepalive have no last_seen and are not idle. Defaults to None.
+            limit (int, optional): max rows deleted in this call. Defaults to 1000.
+            space (str, optional): only connections of this space (partition pruning). Defaults to None.
+
+        Returns:
+            int: deleted rows. Less than limit means there is nothing more to delete
+        """
+        raise NotImplementedError
+
+    def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        """ writes the last keepalive time of many sockets in one statement. A time older
+        than the stored one is ignored, so batches can be written in any order.
+
+        Args:
+            last_seen (dict): socket_id -> datetime
+            space (str, optional): space of every socket (partition pruning). Defaults to None.
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: updated rows
+        """
+        raise NotImplementedError
+
+    def insert_subscription(self, channel,socket_id,shared_conn=None):
+        """ subscribe a socket to a channel. Subscribing twice is not an error.
+
+        Returns:
+            bool: True if the subscription is new
+        """
+        raise NotImplementedError
+
+    def delete_subscription(self, channel,socket_id,shared_conn=None):
+        """ unsubscribe a socket from a channel. Subscriptions of deleted connections are removed with them. """
+        raise NotImplementedError
+
+    def select_connections_by_channel(self, channel,shared_conn=None):
+        """ select sockets subscribed to a channel.
+
+        Returns:
+            list: list of dicts with channel and socket_id
+        """
+        raise NotImplementedError
+
+    def select_connection_count_by_space(self, space,shared_conn=None):
+        """ number of connections in a space. Counters are kept up to date by
+        insert_connection and delete_connection_*, so this does not read client_connections.
+
+        Returns:
+            int: number of connections
+        """
+        raise NotImplementedError
+
+    def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ number of connections of a participant in a space. Read from the counters. """
+        raise NotImplementedError
+
+    def select_connection_counts(self, shared_conn=None):
+        """ connection counters of all spaces with connections
+
+        Returns:
+            list: list of dicts with space and connections
+        """
+        raise NotImplementedError
+
+    def select_connection_spaces(self, shared_conn=None):
+        """ spaces that have rows in client_connections, also those without a counter
+
+        Returns:
+            list: sorted list of spaces
+        """
+        raise NotImplementedError
+
+    def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        """ record a message id as processed. Used to skip redelivered queue messages.
+        With done False the id is claimed: it is recorded as in progress, and claiming
+        it again succeeds until it is recorded with done True.
+
+        Returns:
+            bool: True if the id was recorded or claimed now, False if it was already done
+        """
+        raise NotImplementedError
+
+    def select_processed_message(self, message_id,shared_conn=None):
+        """ check if a message id was already processed.
+
+        Returns:
+            bool: True if the message id is recorded as done
+        """
+        raise NotImplementedError
+
+    def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        """ delete one chunk of message ids processed before cutoff. Used by the reaper.
+
+        Args:
+            cutoff (datetime): ids with processed < cutoff are deleted
+            limit (int, optional): max rows deleted in this call. Defaults to 1000.
+
+        Returns:
+            int: deleted rows. Less than limit means there is nothing more to delete
+        """
+        raise NotImplementedError
+
+    def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        """ append a message to the buffer of a participant with the next sequence number.
+        Only the last max_messages of the participant are kept and each one expires after ttl_seconds.
+
+        Returns:
+            int: sequence number of the message
+        """
+        raise NotImplementedError
+
+    def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        """ messages of the participant buffer with sequence number greater than after_seq
+        that did not expire, in sequence order.
+
+        Returns:
+            list: list of dicts with seq and message
+        """
+        raise NotImplementedError
+
+    def delete_expired_messages(self, limit=1000,shared_conn=None):
+        """ delete one chunk of expired buffered messages.
+
+        Returns:
+            int: deleted rows. Less than limit means there is nothing more to delete
+        """
         raise NotImplementedError
     
 
@@ -0,0 +1,252 @@
+import logging
+import datetime as dt
+import threading
+from collections import Counter
+from .db_helper import DBHelper
+
+
+class DBHelperMemory(DBHelper):
+    """
+    In-memory store for socket connections. Data is kept at class level so every
+    instance returned by DIDBHelper.resolve() sees the same tables. Use it for tests
+    or local runs without a database.
+    """
+
+    _lock = threading.RLock()
+    _connections = {}           # socket_id -> row dict
+    _processed_messages = {}    # message_id -> processed datetime
+    _unfinished_messages = set()    # claimed message ids not done yet
+    _space_counts = Counter()           # space -> connections
+    _participant_counts = Counter()     # (participant_id, space) -> connections
+    _subscriptions = {}         # channel -> set of socket_id
+    _message_seqs = Counter()   # (participant_id, space) -> last sequence number
+    _message_buffers = {}       # (participant_id, space) -> list of buffered message dicts
+
+    def __init__(self,connection_data:dict=None):
+        self.log = logging.getLogger(__name__)
+
+    @classmethod
+    def reset(cls):
+        """ remove all data. Used by tests """
+        with cls._lock:
+            cls._connections.clear()
+            cls._processed_messages.clear()
+            cls._unfinished_messages.clear()
+            cls._space_counts.clear()
+            cls._participant_counts.clear()
+            cls._subscriptions.clear()
+            cls._message_seqs.clear()
+            cls._message_buffers.clear()
+
+    def _load_ddbb_config(self):
+        pass
+
+    def connect(self):
+        """ There is no server, nothing to connect """
+        return None
+
+    def _connection_get(self,shared_conn=None):
+        return False,shared_conn
+
+    def _connection_close(self,myconn:bool,shared_conn):
+        pass
+
+    def _update_connection_counts(self,rows,delta):
+        for row in rows:
+            self._participant_counts[(row["participant_id"],row["space"])]+=delta
+            self._space_counts[row["space"]]+=delta
+
+    def _delete_sockets(self,sockets):
+        rows=[self._connections.pop(socket_id) for socket_id in sockets]
+        self._update_connection_counts(rows,delta=-1)
+        for subscribers in self._subscriptions.values():
+            subscribers.difference_update(sockets)
+        return len(rows)
+
+    def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        """ insert a new connection  """
+        with self._lock:
+            if socket_id in self._connections:
+                raise ValueError(f"duplicate socket_id {socket_id}")
+            row={"participant_id": str(participant_id)
+                 , "socket_id": socket_id
+                 , "space": space
+                 , "endpoint": endpoint
+                 , "compression": compression
+                 , "connected": dt.datetime.now(dt.timezone.utc)}
+            self._connections[socket_id]=row
+            self._update_connection_counts([row],delta=1)
+        return None
+
+    def update_connection(self, participant_id,socket_id,shared_conn=None):
+        """ update a connection. This case not exist. Always is creation and deletion  """
+        pass
+
+    def delete_connection_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ delete all connections by participant. """
+        with self._lock:
+            sockets=[row["socket_id"] for row in self._connections.values()
+                     if row["participant_id"]==str(participant_id) and row["space"]==space]
+            return self._delete_sockets(sockets)
+
+    def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ delete connection by socket. """
+        with self._lock:
+            row=self._connections.get(socket_id)
+            if row is None or (space is not None and row["space"]!=str(space)):
+                return 0
+            return self._delete_sockets([socket_id])
+
+    def select_connections_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ select connections by participant. """
+        with self._lock:
+            return [{"participant_id": row["participant_id"], "socket_id": row["socket_id"], "endpoint": row["endpoint"]
+                     , "compression": row["compression"]}
+                    for row in self._connections.values()
+                    if row["participant_id"]==str(participant_id) and row["space"]==str(space)]
+
+    def select_connections_by_space(self, space,shared_conn=None):
+        """ select connections by space. """
+        with self._lock:
+            return [{"participant_id": row["participant_id"], "socket_id": row["socket_id"], "endpoint": row["endpoint"]
+                     , "compression": row["compression"]}
+                    for row in self._connections.values() if row["space"]==str(space)]
+
+    def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ select connections by socket_id. """
+        with self._lock:
+            row=self._connections.get(socket_id)
+        if row is None or (space is not None and row["space"]!=str(space)):
+            return None
+        return {"participant_id": row["participant_id"], "socket_id": row["socket_id"], "endpoint": row["endpoint"],
+                "space": row["space"], "compression": row["compression"]}
+
+    def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        """ delete one chunk of connections created before cutoff or idle since idle_cutoff. """
+        with self._lock:
+            sockets=[row["socket_id"] for row in self._connections.values()
+                     if (space is None or row["space"]==str(space))
+                     and (row["connected"]<cutoff
+                          or (idle_cutoff is not None and row.get("last_seen") is not None and row["last_seen"]<idle_cutoff))
+                     ][:int(limit)]
+            return self._delete_sockets(sockets)
+
+    def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        """ writes the last keepalive time of many sockets. """
+        updated=0
+        with self._lock:
+            for socket_id,seen in last_seen.items():
+                row=self._connections.get(socket_id)
+                if row is None or (space is not None and row["space"]!=str(space)):
+                    continue
+                if row.get("last_seen") is None or row["last_seen"]<seen:
+                    row["last_seen"]=seen
+                    updated+=1
+        return updated
+
+    def insert_subscription(self, channel,socket_id,shared_conn=None):
+        """ subscribe a socket to a channel. """
+        with self._lock:
+            subscribers=self._subscriptions.setdefault(str(channel),set())
+            if socket_id in subscribers:
+                return False
+            subscribers.add(socket_id)
+        return True
+
+    def delete_subscription(self, channel,socket_id,shared_conn=None):
+        """ unsubscribe a socket from a channel """
+        with self._lock:
+            subscribers=self._subscriptions.get(str(channel),set())
+            if socket_id not in subscribers:
+                return 0
+            subscribers.discard(socket_id)
+        return 1
+
+    def select_connections_by_channel(self, channel,shared_conn=None):
+        """ select sockets subscribed to a channel. """
+        with self._lock:
+            return [{"channel": str(channel), "socket_id": socket_id
+                     , "endpoint": self._connections.get(socket_id,{}).get("endpoint")
+                     , "compression": self._connections.get(socket_id,{}).get("compression")}
+                    for socket_id in self._subscriptions.get(str(channel),())]
+
+    def select_connection_count_by_space(self, space,shared_conn=None):
+        """ number of connections in a space. """
+        with self._lock:
+            return max(self._space_counts[str(space)],0)
+
+    def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ number of connections of a participant in a space. """
+        with self._lock:
+            return max(self._participant_counts[(str(participant_id),str(space))],0)
+
+    def select_connection_counts(self, shared_conn=None):
+        """ connection counters of all spaces with connections """
+        with self._lock:
+            return [{"space": space, "connections": count}
+                    for space,count in sorted(self._space_counts.items()) if count>0]
+
+    def select_connection_spaces(self, shared_conn=None):
+        """ spaces that have rows in client_connections """
+        with self._lock:
+            return sorted({row["space"] for row in self._connections.values()})
+
+    def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        """ record a message id as processed, or claim it with done False. """
+        message_id=str(message_id)
+        with self._lock:
+            if message_id in self._processed_messages and message_id not in self._unfinished_messages:
+                return False
+            self._processed_messages[message_id]=dt.datetime.now(dt.timezone.utc)
+            if done:
+                self._unfinished_messages.discard(message_id)
+            else:
+                self._unfinished_messages.add(message_id)
+        return True
+
+    def select_processed_message(self, message_id,shared_conn=None):
+        """ check if a message id was already processed. """
+        with self._lock:
+            return str(message_id) in self._processed_messages and str(message_id) not in self._unfinished_messages
+
+    def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        """ delete one chunk of message ids processed before cutoff. """
+        with self._lock:
+            message_ids=[message_id for message_id,processed in self._processed_messages.items()
+                         if processed<cutoff][:int(limit)]
+            for message_id in message_ids:
+                del self._processed_messages[message_id]
+                self._unfinished_messages.discard(message_id)
+        return len(message_ids)
+
+    def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        """ append a message to the buffer of a participant, returns its sequence number. """
+        key=(str(participant_id),str(space))
+        with self._lock:
+            self._message_seqs[key]+=1
+            seq=self._message_seqs[key]
+            buffer=self._message_buffers.setdefault(key,[])
+            buffer.append({"seq": seq, "message": message
+                           , "expires": dt.datetime.now(dt.timezone.utc)+dt.timedelta(seconds=ttl_seconds)})
+            del buffer[:max(len(buffer)-max_messages,0)]
+        return seq
+
+    def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        """ buffered messages after after_seq that did not expire, in sequence order. """
+        now=dt.datetime.now(dt.timezone.utc)
+        with self._lock:
+            buffer=self._message_buffers.get((str(participant_id),str(space)),[])
+            return [{"seq": row["seq"], "message": row["message"]} for row in buffer
+                    if row["seq"]>int(after_seq) and row["expires"]>now][:limit]
+
+    def delete_expired_messages(self, limit=1000,shared_conn=None):
+        """ delete one chunk of expired buffered messages. """
+        now=dt.datetime.now(dt.timezone.utc)
+        deleted=0
+        with self._lock:
+            for buffer in self._message_buffers.values():
+                expired=[row for row in buffer if row["expires"]<=now][:limit-deleted]
+                for row in expired:
+                    buffer.remove(row)
+                deleted+=len(expired)
+        return deleted
@@ -1,19 +1,98 @@
 
 
+import contextlib
 import json
 import logging
 import datetime as dt
 from pathlib import Path
 import uuid
+import re
+import threading
+import time
+import weakref
+from collections import Counter
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 import os
+from .circuit_breaker import CircuitBreaker
+
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_flag(value):
+    """ parses a true/false setting, None when it is not set """
+    if value is None:
+        return None
+    return str(value).lower() in ('true','1','yes')
+
+
+class ReplicaRouter:
+    """
+    Chooses the read replica for the next read. Replicas are used round robin;
+    a replica that failed to connect is skipped for retry_after seconds.
+    One router is shared by all helpers with the same replica list, so the
+    rotation and health survive between helper instances in the container.
+    """
+
+    _routers = {}
+    _routers_lock = threading.Lock()
+
+    def __init__(self, replicas, retry_after=30):
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        self._next = 0
+        self._down_until = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_router(cls, replicas, retry_after=30):
+        """Returns the shared router for this replica list, creating it if necessary."""
+        key = json.dumps(replicas, sort_keys=True)
+        with cls._routers_lock:
+            if key not in cls._routers:
+                cls._routers[key] = cls(replicas, retry_after=retry_after)
+            return cls._routers[key]
+
+    def candidates(self):
+        """ replica indexes to try, in order. Healthy replicas come first starting at
+        the round robin position, replicas marked down are tried last. """
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.replicas)
+        now = time.monotonic()
+        order = [(start + offset) % len(self.replicas) for offset in range(len(self.replicas))]
+        healthy = [index for index in order if self._down_until.get(index, 0) <= now]
+        return healthy + [index for index in order if index not in healthy]
+
+    def mark_down(self, index):
+        self._down_until[index] = time.monotonic() + self.retry_after
+
+    def mark_up(self, index):
+        self._down_until.pop(index, None)
 
 
 class DBHelperPostgress :
     """
-    Class to manage socket connections for users
+    Class to manage socket connections for users.
+
+    Reads (select_*) go to the read replicas when they are configured, writes
+    always go to the primary. With read_your_writes, reads done after a write
+    in the same invocation go to the primary too.
     """
 
+    # True once this invocation wrote to the primary. Reset by start_invocation. Shared
+    # by every thread of the container, not thread local: Lambda runs one invocation at
+    # a time, and the fan-out workers of an invocation must see the writes of its thread
+    _invocation_wrote = False
+    # per connection: statements seen, statements prepared and the lock guarding both
+    _prepared = weakref.WeakKeyDictionary()
+    _prepared_lock = threading.Lock()
+    # set when the server lost a prepared statement (PgBouncer transaction pooling)
+    _prepared_disabled = False
+
     def __init__(self,connection_data:dict=None):
         self.log = logging.getLogger(__name__) 
         self.host       =None
@@ -21,6 +100,15 @@ class DBHelperPostgress :
         self.database   =None
         self.user       =None
         self.password   =None       
+        self.replicas   =[]
+        self.read_your_writes=False
+        self.replica_connect_timeout=3
+        # None when not configured: off here, on for the asyncpg pool
+        self.prepare_statements=_parse_flag(os.environ.get('DDBB_PREPARE_STATEMENTS'))
+        self.connect_timeout=5
+        self.statement_timeout=0
+        self.breaker_failures=5
+        self.breaker_reset_timeout=30
         if connection_data is None:
             self._load_ddbb_config ()
         else:
@@ -29,6 +117,10 @@ class DBHelperPostgress :
             self.database   =connection_data['database']
             self.user       =connection_data['user']
             self.password   =connection_data['password']   
+            self._load_replica_config(connection_data)
+            self._load_timeout_config(connection_data)
+            if 'prepare_statements' in connection_data:
+                self.prepare_statements=_parse_flag(connection_data['prepare_statements'])
             
     def _load_ddbb_config(self):
         dbcfg=os.environ['DDBB_CONFIG']
@@ -39,6 +131,8 @@ class DBHelperPostgress :
             self.database   =dbcfg['database']
             self.user       =dbcfg['user']
             self.password   =dbcfg['password']             
+            self._load_replica_config(dbcfg)
+            self._load_timeout_config(dbcfg)
         
         elif dbcfg is None:        
             self.host       =os.environ['host']
@@ -51,32 +145,122 @@ class DBHelperPostgress :
             self.user       =os.environ['user']
             self.password   =os.environ['password']                           
 
+    def _load_replica_config(self,dbcfg:dict):
+        """ optional replica settings. Keys can be in the config dict or in environment.
+
+        replicas: list of DSN strings or dicts with host, port and optionally
+                  database, user and password (defaults are the primary ones).
+                  Environment key DDBB_REPLICAS as a json list.
+        read_your_writes: environment key DDBB_READ_YOUR_WRITES=true
+        replica_connect_timeout: seconds, environment key DDBB_REPLICA_CONNECT_TIMEOUT
+        """
+        replicas=dbcfg.get('replicas')
+        if replicas is None and os.environ.get('DDBB_REPLICAS'):
+            replicas=json.loads(os.environ['DDBB_REPLICAS'])
+        self.replicas=replicas or []
+        read_your_writes=dbcfg.get('read_your_writes', os.environ.get('DDBB_READ_YOUR_WRITES', False))
+        self.read_your_writes=str(read_your_writes).lower() in ('true','1','yes')
+        self.replica_connect_timeout=int(dbcfg.get('replica_connect_timeout'
+                                                    , os.environ.get('DDBB_REPLICA_CONNECT_TIMEOUT', 3)))
+
+    def _load_timeout_config(self,dbcfg:dict):
+        """ optional timeouts and circuit breaker settings. Keys can be in the config dict or in environment.
+
+        connect_timeout: seconds to wait for a connection, DDBB_CONNECT_TIMEOUT. Default 5
+        statement_timeout: milliseconds per statement, DDBB_STATEMENT_TIMEOUT. Default 0, no limit
+        breaker_failures: consecutive connect failures that open the breaker, DDBB_BREAKER_FAILURES. Default 5
+        breaker_reset_timeout: seconds before an open breaker probes again, DDBB_BREAKER_RESET_TIMEOUT. Default 30
+        """
+        self.connect_timeout=int(dbcfg.get('connect_timeout', os.environ.get('DDBB_CONNECT_TIMEOUT', 5)))
+        self.statement_timeout=int(dbcfg.get('statement_timeout', os.environ.get('DDBB_STATEMENT_TIMEOUT', 0)))
+        self.breaker_failures=int(dbcfg.get('breaker_failures', os.environ.get('DDBB_BREAKER_FAILURES', 5)))
+        self.breaker_reset_timeout=int(dbcfg.get('breaker_reset_timeout'
+                                                  , os.environ.get('DDBB_BREAKER_RESET_TIMEOUT', 30)))
+
+    def get_breaker(self):
+        """ circuit breaker of the primary, shared by every helper of this database """
+        return CircuitBreaker.get_breaker(f"{self.host}:{self.port}/{self.database}"
+                                          ,failure_threshold=self.breaker_failures
+                                          ,reset_timeout=self.breaker_reset_timeout)
+
+    def _session_options(self):
+        # statement_timeout is sent in the startup packet, no extra round trip
+        if self.statement_timeout>0:
+            return {"options": f"-c statement_timeout={self.statement_timeout}"}
+        return {}
+
+    @classmethod
+    def start_invocation(cls):
+        """ forget writes of the previous invocation. Called at the start of every lambda invocation """
+        DBHelperPostgress._invocation_wrote=False
+
     def connect(self):
-        """ Connect to the database server . Primarily to postgress"""
-        conn = psycopg2.connect(
-            host=self.host,
-            port=self.port,
-            database=self.database,
-            user=self.user,
-            password=self.password)
+        """ Connect to the database server . Primarily to postgress.
+        Raises CircuitOpenError without trying while the breaker is open """
+        breaker=self.get_breaker()
+        breaker.before_call()
+        try:
+            conn = psycopg2.connect(
+                host=self.host,
+                port=self.port,
+                database=self.database,
+                user=self.user,
+                password=self.password,
+                connect_timeout=self.connect_timeout,
+                **self._session_options())
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
         return conn
 
+    def _connect_to_replica(self,replica):
+        if isinstance(replica,str):
+            return psycopg2.connect(replica,connect_timeout=self.replica_connect_timeout,**self._session_options())
+        return psycopg2.connect(
+            host=replica['host'],
+            port=replica.get('port',self.port),
+            database=replica.get('database',self.database),
+            user=replica.get('user',self.user),
+            password=replica.get('password',self.password),
+            connect_timeout=self.replica_connect_timeout,
+            **self._session_options())
 
-    def insert_connection(self, participant_id,socket_id,space="PUBLIC",shared_conn=None):
-        """ insert a new connection  """
+    def connect_replica(self):
+        """ Connect to a read replica. Replicas that fail are skipped for a while;
+        if none is available the primary is used. """
+        if not self.replicas:
+            return self.connect()
+        router=ReplicaRouter.get_router(self.replicas)
+        for index in router.candidates():
+            try:
+                conn=self._connect_to_replica(self.replicas[index])
+                router.mark_up(index)
+                return conn
+            except psycopg2.OperationalError:
+                logger.warning("Read replica %s is not available.", index, exc_info=True)
+                router.mark_down(index)
+        logger.warning("No read replica available, reading from primary.")
+        return self.connect()
 
-        sql = """INSERT INTO client_connections(participant_id,socket_id,space)
-                VALUES(%s,%s,%s);"""
+
+    def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        """ insert a new connection. endpoint is the management API url of the socket, https://domain/stage.
+        compression is the frame compression accepted by the client, None for plain text frames """
+
+        sql = """INSERT INTO client_connections(participant_id,socket_id,space,endpoint,compression)
+                VALUES(%s,%s,%s,%s,%s);"""
         conn = None        
         myconn=False  
         id = None
         try:
             myconn,conn=self._connection_get(shared_conn=shared_conn)
             cur = conn.cursor()
-            cur.execute(sql, (participant_id,socket_id,space))
+            self._execute_prepared(cur,"ws_insert_connection",sql,(participant_id,socket_id,space,endpoint,compression))
             # get the generated id back
             #id = cur.fetchone()[0]
-            conn.commit()
+            self._update_connection_counts(cur,[(str(participant_id),space)],delta=1)
+            self._connection_commit(myconn=myconn,shared_conn=conn)
             cur.close()
             return id
         except:
@@ -91,7 +275,8 @@ class DBHelperPostgress :
     def delete_connection_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
         """ delete all connections by participant. This is used by system to close connections when a logout is requested """
 
-        sql = """delete from client_connections where participant_id =%s and space=%s;"""
+        sql = """delete from client_connections where participant_id =%s and space=%s
+                returning participant_id,space,socket_id;"""
         conn = None        
         myconn=False
         deleted_rows=0
@@ -101,7 +286,8 @@ class DBHelperPostgress :
             cur = conn.cursor()
             cur.execute(sql, (str(participant_id),space,))
             deleted_rows=cur.rowcount
-            conn.commit()
+            self._connections_deleted(cur,cur.fetchall())
+            self._connection_commit(myconn=myconn,shared_conn=conn)
             cur.close()            
         except:
             raise
@@ -109,14 +295,97 @@ class DBHelperPostgress :
             self._connection_close(myconn=myconn,shared_conn=conn)
         return deleted_rows
     
-    def _connection_get(self,shared_conn=None):
+    def _connection_get(self,shared_conn=None,read_only=False):
         
+        # myconn is True when the connection was opened here and must be closed here
         if shared_conn is not None:
-            return True,shared_conn            
+            return False,shared_conn            
+        elif read_only and self.replicas and not (self.read_your_writes and DBHelperPostgress._invocation_wrote):
+            conn=self.connect_replica()
+            return True,conn
         else:
+            if not read_only:
+                DBHelperPostgress._invocation_wrote=True
             conn=self.connect()   
-            return False,conn 
+            return True,conn 
         
+    def _execute_prepared(self,cur,name,sql,params):
+        """ executes one of the hot statements as a server side prepared statement.
+        Off unless DDBB_PREPARE_STATEMENTS=true: the helper opens a connection per
+        call, and on a connection used once PREPARE + EXECUTE is one round trip more
+        than the plain statement. When on, a statement runs as plain sql the first
+        time it is seen in a connection and is prepared the second time, so only
+        reused connections (unit_of_work, long lived shared connections) prepare.
+        Threads sharing a connection take its lock, so two of them never PREPARE
+        the same name.
+
+        Behind PgBouncer in transaction mode the session that prepared the statement
+        may not be the one running it. The first time that happens prepared statements
+        are switched off for the container and, if the transaction had no previous
+        work, the statement is run again as plain sql.
+
+        Args:
+            cur (cursor): cursor
+            name (str): name of the prepared statement
+            sql (str): statement with %s placeholders
+            params (tuple): parameters
+        """
+        if not self.prepare_statements or DBHelperPostgress._prepared_disabled:
+            cur.execute(sql, params)
+            return
+        conn=cur.connection
+        with self._prepared_lock:
+            state=self._prepared.get(conn)
+            if state is None:
+                state=self._prepared[conn]={"seen": set(), "prepared": set(), "lock": threading.Lock()}
+        with state["lock"]:
+            if name not in state["seen"]:
+                state["seen"].add(name)
+                cur.execute(sql, params)
+                return
+            was_idle=conn.get_transaction_status()==psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            try:
+                if name not in state["prepared"]:
+                    counter=iter(range(1,len(params)+1))
+                    server_sql=re.sub(r'%s',lambda match: f'${next(counter)}',sql.strip().rstrip(';'))
+                    cur.execute(f"PREPARE {name} AS {server_sql}")
+                    state["prepared"].add(name)
+                placeholders=",".join(["%s"]*len(params))
+                cur.execute(f"EXECUTE {name}({placeholders})", params)
+            except (psycopg2.errors.InvalidSqlStatementName,psycopg2.errors.DuplicatePreparedStatement):
+                logger.warning("Prepared statement %s lost by the server, using plain statements.", name, exc_info=True)
+                DBHelperPostgress._prepared_disabled=True
+                state["prepared"].clear()
+                if not was_idle:
+                    raise
+                conn.rollback()
+                cur.execute(sql, params)
+
+    def _connection_commit(self,myconn:bool,shared_conn):
+        # a shared connection is committed by its owner, see unit_of_work
+        if myconn is True:
+            shared_conn.commit()
+
+    @contextlib.contextmanager
+    def unit_of_work(self,read_only=False):
+        """ checks out one connection for a block of calls, typically a whole invocation.
+        Pass the yielded connection as shared_conn to every call; the methods do not
+        commit a shared connection, the block is committed once when it ends and
+        rolled back if it raises.
+
+        Args:
+            read_only (bool, optional): the block only reads, use a read replica. Defaults to False.
+        """
+        myconn,conn=self._connection_get(read_only=read_only)
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+
     def _connection_close(self,myconn:bool,shared_conn):
         
         if myconn is True and shared_conn is not None:
@@ -125,10 +394,19 @@ class DBHelperPostgress :
         
         
 
-    def delete_connection_by_socket(self, socket_id,shared_conn=None):
-        """ delete connection by socket. This is used by socket system """
+    def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ delete connection by socket. This is used by socket system.
+        Pass space when it is known so a partitioned table only touches one partition. """
 
-        sql = """delete from client_connections where socket_id =%s;"""
+        sql = """delete from client_connections where socket_id =%s
+                returning participant_id,space,socket_id;"""
+        params=(socket_id,)
+        statement="ws_delete_connection_by_socket"
+        if space is not None:
+            sql = """delete from client_connections where socket_id =%s and space=%s
+                returning participant_id,space,socket_id;"""
+            params=(socket_id,str(space))
+            statement="ws_delete_connection_by_socket_space"
         conn = None        
         myconn=False
         deleted_rows=0
@@ -136,9 +414,10 @@ class DBHelperPostgress :
         try:
             myconn,conn=self._connection_get(shared_conn=shared_conn)
             cur = conn.cursor()
-            cur.execute(sql, (socket_id,))
+            self._execute_prepared(cur,statement,sql,params)
             deleted_rows=cur.rowcount
-            conn.commit()
+            self._connections_deleted(cur,cur.fetchall())
+            self._connection_commit(myconn=myconn,shared_conn=conn)
             cur.close()
             
         except:
@@ -162,19 +441,19 @@ class DBHelperPostgress :
             list: list of connections available for user
         """       
         
-        sql = """select participant_id,socket_id from client_connections where participant_id =%s AND space=%s;"""
+        sql = """select participant_id,socket_id,endpoint,compression from client_connections where participant_id =%s AND space=%s;"""
         conn = None       
         myconn=False
         _rows=0
         connections=[]
         try:
-            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
             cur = conn.cursor()       
-            cur.execute(sql, (str(participant_id),str(space)))
+            self._execute_prepared(cur,"ws_select_connections_by_participant",sql,(str(participant_id),str(space)))
             _rows=cur.rowcount
             rows = cur.fetchall()
             for row in rows:
-                connection={"participant_id": row[0], "socket_id":row[1]}
+                connection={"participant_id": row[0], "socket_id":row[1], "endpoint":row[2], "compression":row[3]}
                 connections.append(connection)
             
             cur.close()
@@ -189,46 +468,50 @@ class DBHelperPostgress :
     def select_connections_by_space(self, space,shared_conn=None):
         """ select connections by space. """
 
-        sql = """select participant_id,socket_id,connected from client_connections where space =%s;"""
+        sql = """select participant_id,socket_id,endpoint,compression from client_connections where space =%s;"""
         conn = None        
         myconn=False
         _rows=0
         connections=[]
   
         try:
-            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
             cur = conn.cursor()
             cur.execute(sql, (str(space),))
             _rows=cur.rowcount
             rows = cur.fetchall()
             for row in rows:
-                connection={"participant_id": row[0], "socket_id":row[1]}
+                connection={"participant_id": row[0], "socket_id":row[1], "endpoint":row[2], "compression":row[3]}
                 connections.append(connection)
-            connection={"participant_id": row[0], "socket_id":row[1]}
             cur.close()
 
         except:
             raise
         finally:
             self._connection_close(myconn=myconn,shared_conn=conn)
-        return connection    
+        return connections    
     
-    def select_connection_by_socket(self, socket_id,shared_conn=None):
-        """ select connections by socket_id. """
+    def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        """ select connections by socket_id. Pass space when it is known so a partitioned table only touches one partition. """
 
-        sql = """select participant_id,socket_id,connected from client_connections where socket_id =%s;"""
+        sql = """select participant_id,socket_id,endpoint,space,compression from client_connections where socket_id =%s;"""
+        params=(str(socket_id),)
+        if space is not None:
+            sql = """select participant_id,socket_id,endpoint,space,compression from client_connections where socket_id =%s and space=%s;"""
+            params=(str(socket_id),str(space))
         conn = None        
         myconn=False
         _rows=0
         connection=None
   
         try:
-            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
             cur = conn.cursor()
-            cur.execute(sql, (str(socket_id),))
+            cur.execute(sql, params)
             _rows=cur.rowcount
             row = cur.fetchone()
-            connection={"participant_id": row[0], "socket_id":row[1]}
+            if row is not None:
+                connection={"participant_id": row[0], "socket_id":row[1], "endpoint":row[2], "space":row[3], "compression":row[4]}
             cur.close()
             
         except:
@@ -236,9 +519,597 @@ class DBHelperPostgress :
         finally:
             self._connection_close(myconn=myconn,shared_conn=conn)
         return connection
-    
 
+    def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        """ delete one chunk of connections created before cutoff. Used by the reaper.
+        Each chunk is its own short transaction and locked rows are skipped, so
+        connects and disconnects running at the same time are not blocked.
+
+        Args:
+            cutoff (datetime): connections with connected < cutoff are deleted
+            limit (int, optional): max rows deleted in this call. Defaults to 1000.
+            idle_cutoff (datetime, optional): connections with last_seen < idle_cutoff are deleted too. Defaults to None.
+            space (str, optional): only this space, so a partitioned table only touches one partition. Defaults to None.
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: deleted rows. Less than limit means there is nothing more to delete
+        """
+
+        condition="connected < %s"
+        params=[cutoff]
+        if idle_cutoff is not None:
+            # each condition uses its own index
+            condition="(connected < %s or last_seen < %s)"
+            params.append(idle_cutoff)
+        space_condition=""
+        if space is not None:
+            space_condition="space=%s and "
+            params=[str(space)]+[str(space)]+params
+        sql = f"""delete from client_connections where {space_condition}socket_id in (
+                    select socket_id from client_connections where {space_condition}{condition}
+                    limit %s for update skip locked)
+                returning participant_id,space,socket_id;"""
+        params=tuple(params)+(int(limit),)
+        conn = None
+        myconn=False
+        deleted_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            deleted_rows=cur.rowcount
+            self._connections_deleted(cur,cur.fetchall())
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return deleted_rows
+
+    def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        """ writes the last keepalive time of many sockets in one multi-row UPDATE.
+        A time older than the stored one is ignored, so batches can be written in any order.
+
+        Args:
+            last_seen (dict): socket_id -> datetime
+            space (str, optional): space of every socket, so a partitioned table only touches one partition. Defaults to None.
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: updated rows
+        """
+
+        sql = """update client_connections c set last_seen=v.last_seen
+                from unnest(%s::varchar[],%s::timestamptz[]) as v(socket_id,last_seen)
+                where c.socket_id=v.socket_id and (c.last_seen is null or c.last_seen<v.last_seen);"""
+        if not last_seen:
+            return 0
+        # sorted so concurrent batches lock the rows in the same order
+        sockets=sorted(last_seen)
+        params=(sockets,[last_seen[socket_id] for socket_id in sockets])
+        if space is not None:
+            sql = """update client_connections c set last_seen=v.last_seen
+                    from unnest(%s::varchar[],%s::timestamptz[]) as v(socket_id,last_seen)
+                    where c.space=%s and c.socket_id=v.socket_id and (c.last_seen is null or c.last_seen<v.last_seen);"""
+            params=params+(str(space),)
+        conn = None
+        myconn=False
+        updated_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            updated_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return updated_rows
+
+    def _update_connection_counts(self,cur,rows,delta):
+        """ apply a change to the connection counters inside the caller transaction.
+
+        Args:
+            cur (cursor): cursor of the transaction that inserted or deleted the connections
+            rows (list): (participant_id, space) of every inserted or deleted connection
+            delta (int): 1 for inserts, -1 for deletes
+        """
+        if not rows:
+            return
+        by_participant=Counter((str(row[0]),str(row[1])) for row in rows)
+        by_space=Counter()
+        for (participant_id,space),count in by_participant.items():
+            by_space[space]+=count
+        # sorted keys so concurrent transactions lock counter rows in the same order
+        psycopg2.extras.execute_values(cur,
+            """INSERT INTO participant_connection_counts(participant_id,space,connections) VALUES %s
+                ON CONFLICT (participant_id,space)
+                DO UPDATE SET connections=participant_connection_counts.connections+EXCLUDED.connections;""",
+            [(participant_id,space,count*delta) for (participant_id,space),count in sorted(by_participant.items())])
+        psycopg2.extras.execute_values(cur,
+            """INSERT INTO space_connection_counts(space,connections) VALUES %s
+                ON CONFLICT (space)
+                DO UPDATE SET connections=space_connection_counts.connections+EXCLUDED.connections;""",
+            [(space,count*delta) for space,count in sorted(by_space.items())])
+
+    def _connections_deleted(self,cur,rows):
+        """ keeps counters and subscriptions in line with deleted connections, inside the caller transaction.
+
+        Args:
+            cur (cursor): cursor of the transaction that deleted the connections
+            rows (list): (participant_id, space, socket_id) of every deleted connection
+        """
+        if not rows:
+            return
+        self._update_connection_counts(cur,rows,delta=-1)
+        cur.execute("""delete from channel_subscriptions where socket_id = ANY(%s);""",
+                    ([row[2] for row in rows],))
+
+    def insert_subscription(self, channel,socket_id,shared_conn=None):
+        """ subscribe a socket to a channel. Subscribing twice is not an error.
+
+        Returns:
+            bool: True if the subscription is new
+        """
+
+        sql = """INSERT INTO channel_subscriptions(channel,socket_id)
+                VALUES(%s,%s) ON CONFLICT (channel,socket_id) DO NOTHING;"""
+        conn = None
+        myconn=False
+        inserted_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, (str(channel),socket_id))
+            inserted_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return inserted_rows>0
+
+    def delete_subscription(self, channel,socket_id,shared_conn=None):
+        """ unsubscribe a socket from a channel
+
+        Returns:
+            int: deleted rows
+        """
+
+        sql = """delete from channel_subscriptions where channel =%s and socket_id=%s;"""
+        conn = None
+        myconn=False
+        deleted_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, (str(channel),socket_id))
+            deleted_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return deleted_rows
+
+    def select_connections_by_channel(self, channel,shared_conn=None):
+        """ select sockets subscribed to a channel. Uses the channel_subscriptions primary key.
+
+        Returns:
+            list: list of dicts with channel, socket_id, endpoint and compression
+        """
+
+        sql = """select s.channel,s.socket_id,c.endpoint,c.compression from channel_subscriptions s
+                left join client_connections c on c.socket_id=s.socket_id where s.channel =%s;"""
+        conn = None
+        myconn=False
+        connections=[]
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
+            cur = conn.cursor()
+            cur.execute(sql, (str(channel),))
+            for row in cur.fetchall():
+                connections.append({"channel": row[0], "socket_id": row[1], "endpoint": row[2], "compression": row[3]})
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return connections
+
+    def select_connection_count_by_space(self, space,shared_conn=None):
+        """ number of connections in a space. Reads the counter, not client_connections. """
+
+        sql = """select connections from space_connection_counts where space =%s;"""
+        conn = None
+        myconn=False
+        row=None
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
+            cur = conn.cursor()
+            cur.execute(sql, (str(space),))
+            row = cur.fetchone()
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return 0 if row is None else max(row[0],0)
+
+    def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        """ number of connections of a participant in a space. Reads the counter, not client_connections. """
+
+        sql = """select connections from participant_connection_counts where participant_id =%s and space=%s;"""
+        conn = None
+        myconn=False
+        row=None
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
+            cur = conn.cursor()
+            cur.execute(sql, (str(participant_id),str(space)))
+            row = cur.fetchone()
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return 0 if row is None else max(row[0],0)
+
+    def select_connection_counts(self, shared_conn=None):
+        """ connection counters of all spaces with connections
+
+        Returns:
+            list: list of dicts with space and connections
+        """
+
+        sql = """select space,connections from space_connection_counts where connections>0 order by space;"""
+        conn = None
+        myconn=False
+        counts=[]
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
+            cur = conn.cursor()
+            cur.execute(sql)
+            for row in cur.fetchall():
+                counts.append({"space": row[0], "connections": row[1]})
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return counts
+
+    COPY_FORMATS = {"csv": "FORMAT csv, HEADER", "binary": "FORMAT binary"}
+    # columns of client_connections in export files. Listed by name, the file does not
+    # depend on the column order of the source or target table (ALTER TABLE ADD COLUMN
+    # appends, so databases migrated differently may disagree)
+    COPY_COLUMNS = "participant_id,socket_id,space,connected,endpoint,compression,last_seen"
+
+    def export_connections(self, file,format="csv",shared_conn=None):
+        """ writes every row of client_connections to file with COPY. Rows are streamed,
+        memory use does not depend on the table size.
+
+        Args:
+            file (file): binary file object open for writing
+            format (str, optional): 'csv' or 'binary'. Defaults to "csv".
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: exported rows
+        """
+        if format not in self.COPY_FORMATS:
+            raise ValueError(f"Unknown copy format: {format}")
+        # COPY (SELECT ...) also works when client_connections is partitioned
+        sql = f"""COPY (select {self.COPY_COLUMNS} from client_connections) TO STDOUT WITH ({self.COPY_FORMATS[format]});"""
+        conn = None
+        myconn=False
+        exported_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.copy_expert(sql, file)
+            exported_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return exported_rows
+
+    def import_connections(self, file,format="csv",shared_conn=None):
+        """ loads rows written by export_connections. Rows are streamed with COPY into a
+        temporary table and moved to client_connections in one statement; sockets that
+        already exist are kept. Connection counters are updated in the same transaction.
+
+        Args:
+            file (file): binary file object open for reading
+            format (str, optional): 'csv' or 'binary'. Defaults to "csv".
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: imported rows
+        """
+        if format not in self.COPY_FORMATS:
+            raise ValueError(f"Unknown copy format: {format}")
+        sql_stage = """CREATE TEMP TABLE client_connections_import
+                (LIKE client_connections INCLUDING DEFAULTS) ON COMMIT DROP;"""
+        sql_copy = f"""COPY client_connections_import ({self.COPY_COLUMNS}) FROM STDIN WITH ({self.COPY_FORMATS[format]});"""
+        sql_move = f"""WITH inserted AS (
+                    INSERT INTO client_connections ({self.COPY_COLUMNS})
+                    select {self.COPY_COLUMNS} from client_connections_import
+                    ON CONFLICT DO NOTHING
+                    returning participant_id,space),
+                participants AS (
+                    INSERT INTO participant_connection_counts(participant_id,space,connections)
+                    select participant_id,space,count(*) from inserted group by participant_id,space
+                    ON CONFLICT (participant_id,space)
+                    DO UPDATE SET connections=participant_connection_counts.connections+EXCLUDED.connections),
+                spaces AS (
+                    INSERT INTO space_connection_counts(space,connections)
+                    select space,count(*) from inserted group by space
+                    ON CONFLICT (space)
+                    DO UPDATE SET connections=space_connection_counts.connections+EXCLUDED.connections)
+                select count(*) from inserted;"""
+        conn = None
+        myconn=False
+        imported_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql_stage)
+            cur.copy_expert(sql_copy, file)
+            cur.execute(sql_move)
+            imported_rows=cur.fetchone()[0]
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return imported_rows
+
+    def select_connection_spaces(self, shared_conn=None):
+        """ spaces that have rows in client_connections, also those without a counter
+        row, e.g. after counters were lost. Walks client_connections_space_idx with
+        one index probe per space instead of reading the whole index.
+
+        Returns:
+            list: sorted list of spaces
+        """
+
+        sql = """with recursive spaces as (
+                (select space from client_connections order by space limit 1)
+                union all
+                select (select c.space from client_connections c where c.space > s.space order by c.space limit 1)
+                from spaces s where s.space is not null)
+            select space from spaces where space is not null;"""
+        conn = None
+        myconn=False
+        spaces=[]
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn,read_only=True)
+            cur = conn.cursor()
+            cur.execute(sql)
+            spaces=[row[0] for row in cur.fetchall()]
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+
+        return spaces
+
+    def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        """ record a message id as processed. Used to skip redelivered queue messages.
+        With done False the id is claimed: recorded as in progress, and claimed again
+        by a redelivery until it is recorded with done True.
+
+        Args:
+            message_id (str): id of the message, for SQS the record messageId
+            done (bool, optional): the message was completely handled. Defaults to True.
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            bool: True if the id was recorded or claimed now, False if it was already done
+        """
+
+        # the update only matches an unfinished claim, a done row counts as no row
+        sql = """INSERT INTO processed_messages(message_id,done) VALUES(%s,%s)
+                ON CONFLICT (message_id) DO UPDATE SET processed=now(),done=EXCLUDED.done
+                WHERE processed_messages.done=false;"""
+        conn = None
+        myconn=False
+        inserted_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, (str(message_id),bool(done)))
+            inserted_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return inserted_rows>0
+
+    def select_processed_message(self, message_id,shared_conn=None):
+        """ check if a message id was already processed. """
+
+        sql = """select 1 from processed_messages where message_id =%s and done;"""
+        conn = None
+        myconn=False
+        row=None
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, (str(message_id),))
+            row = cur.fetchone()
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return row is not None
+
+    def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        """ delete one chunk of message ids processed before cutoff. Used by the reaper,
+        so processed_messages does not grow forever.
+
+        Args:
+            cutoff (datetime): ids with processed < cutoff are deleted
+            limit (int, optional): max rows deleted in this call. Defaults to 1000.
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: deleted rows. Less than limit means there is nothing more to delete
+        """
+
+        sql = """delete from processed_messages where message_id in (
+                    select message_id from processed_messages where processed < %s
+                    limit %s for update skip locked);"""
+        conn = None
+        myconn=False
+        deleted_rows=0
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, (cutoff,int(limit)))
+            deleted_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return deleted_rows
+
+    def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        """ append a message to the buffer of a participant with the next sequence number.
+        The sequence counter, the message and the trim of old messages are one statement.
+
+        Args:
+            participant_id (str): participant
+            space (str): space
+            message (str): encoded message
+            ttl_seconds (int, optional): seconds the message is kept. Defaults to 300.
+            max_messages (int, optional): messages kept per participant. Defaults to 100.
+            shared_conn (_type_, optional): shared connection. Defaults to None.
+
+        Returns:
+            int: sequence number of the message
+        """
+
+        sql = """WITH next AS (
+                INSERT INTO participant_message_seqs(participant_id,space,last_seq) VALUES(%s,%s,1)
+                ON CONFLICT (participant_id,space)
+                DO UPDATE SET last_seq=participant_message_seqs.last_seq+1
+                returning last_seq),
+            stored AS (
+                INSERT INTO participant_messages(participant_id,space,seq,message,expires)
+                select %s,%s,last_seq,%s,now()+make_interval(secs => %s) from next),
+            trimmed AS (
+                delete from participant_messages
+                where participant_id=%s and space=%s and seq <= (select last_seq from next)-%s)
+            select last_seq from next;"""
+        participant_id=str(participant_id)
+        space=str(space)
+        conn = None
+        myconn=False
+        seq=None
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            self._execute_prepared(cur,"ws_insert_buffered_message",sql
+                                   ,(participant_id,space,participant_id,space,message,int(ttl_seconds)
+                                     ,participant_id,space,int(max_messages)))
+            seq=cur.fetchone()[0]
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return seq
+
+    def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        """ messages of the participant buffer after after_seq that did not expire, in sequence
+        order. A range scan of the participant_messages primary key. Reads the primary, a
+        replica could miss messages buffered a moment ago.
+
+        Returns:
+            list: list of dicts with seq and message
+        """
+
+        sql = """select seq,message from participant_messages
+                where participant_id =%s and space=%s and seq>%s and expires>now()
+                order by seq limit %s;"""
+        conn = None
+        myconn=False
+        messages=[]
+
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            self._execute_prepared(cur,"ws_select_buffered_messages",sql
+                                   ,(str(participant_id),str(space),int(after_seq),int(limit)))
+            for row in cur.fetchall():
+                messages.append({"seq": row[0], "message": row[1]})
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return messages
+
+    def delete_expired_messages(self, limit=1000,shared_conn=None):
+        """ delete one chunk of expired buffered messages. Used by the reaper.
+
+        Returns:
+            int: deleted rows. Less than limit means there is nothing more to delete
+        """
+
+        sql = """delete from participant_messages where (participant_id,space,seq) in (
+                    select participant_id,space,seq from participant_messages where expires < now()
+                    limit %s for update skip locked);"""
+        conn = None
+        myconn=False
+        deleted_rows=0
 
+        try:
+            myconn,conn=self._connection_get(shared_conn=shared_conn)
+            cur = conn.cursor()
+            cur.execute(sql, (int(limit),))
+            deleted_rows=cur.rowcount
+            self._connection_commit(myconn=myconn,shared_conn=conn)
+            cur.close()
+        except:
+            raise
+        finally:
+            self._connection_close(myconn=myconn,shared_conn=conn)
+        return deleted_rows
 
 
 if __name__ == '__main__':
@@ -0,0 +1,299 @@
+import bisect
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from .db_helper import DBHelper
+from .db_helper_postgress import DBHelperPostgress
+
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """
+    Consistent hash ring of shard names. Each shard owns vnodes points of the ring and
+    a key belongs to the first point after its hash, so adding a shard only moves the
+    keys of the points it takes, about 1/N of them.
+    """
+
+    def __init__(self, names, vnodes=128):
+        if not names:
+            raise ValueError("A hash ring needs at least one shard")
+        self.names = list(names)
+        self.vnodes = vnodes
+        points = sorted((self._hash(f"{name}#{index}"), name) for name in self.names for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def get_shard(self, key):
+        """ name of the shard that owns key """
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardedUnitOfWork:
+    """
+    Connections of one unit of work of DBHelperShardedPostgress. The unit of work of a
+    shard is opened the first time the block uses it, so an invocation only connects
+    to the shards it touches. Each shard commits its own transaction when the block
+    ends: the commit is not atomic across shards.
+    """
+
+    def __init__(self, helper, read_only=False):
+        self.helper = helper
+        self.read_only = read_only
+        self.stack = contextlib.ExitStack()
+        self._conns = {}
+        self._locks = {name: threading.Lock() for name in helper.shards}
+
+    def get(self, name):
+        """ shared connection of shard name, opened on first use """
+        with self._locks[name]:
+            if name not in self._conns:
+                self._conns[name] = self.stack.enter_context(
+                    self.helper.shards[name].unit_of_work(read_only=self.read_only))
+            return self._conns[name]
+
+
+class DBHelperShardedPostgress(DBHelper):
+    """
+    Spreads the rows of each participant over several Postgres databases. Every
+    participant belongs to one shard, chosen by consistent hashing of participant_id,
+    so its connections, counters and buffered messages are written to one database.
+    Calls by socket, space or channel do not know the participant: they run on
+    every shard in parallel and the results are merged (scatter-gather).
+
+    Shards are configured as a json list in the environment key DDBB_SHARDS or in the
+    `shards` key of DDBB_CONFIG. Each item is a DBHelperPostgress connection dict with
+    an optional `name`; the default name is shard<position>. The ring hashes the names,
+    so new shards are appended and named shards can be listed in any order.
+
+    After adding a shard run lib.db_rebalance_postgress to move the participants that
+    changed shard. While it runs set rebalancing (DDBB_SHARD_REBALANCING=true): reads of
+    a participant are gathered from every shard so moved rows are found on either side.
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, connection_data:dict=None, shards:dict=None):
+        """
+        Args:
+            connection_data (dict, optional): config with a `shards` list. Defaults to the environment.
+            shards (dict, optional): name -> DB helper, used instead of the config. Any
+                                     DBHelper works, e.g. DBHelperMemory subclasses in tests.
+        """
+        self.log = logging.getLogger(__name__)
+        if shards is None:
+            shards = self._load_shards(connection_data if connection_data is not None else self._load_ddbb_config())
+        self.shards = dict(shards)
+        self.ring = HashRing(self.shards, vnodes=int(os.environ.get('DDBB_SHARD_VNODES', 128)))
+        rebalancing = (connection_data or {}).get('rebalancing', os.environ.get('DDBB_SHARD_REBALANCING', False))
+        self.rebalancing = str(rebalancing).lower() in ('true', '1', 'yes')
+
+    def _load_ddbb_config(self):
+        if os.environ.get('DDBB_SHARDS'):
+            return {"shards": json.loads(os.environ['DDBB_SHARDS'])}
+        return json.loads(os.environ['DDBB_CONFIG'])
+
+    @staticmethod
+    def _load_shards(dbcfg:dict):
+        shards = {}
+        for index, shard_cfg in enumerate(dbcfg['shards']):
+            name = shard_cfg.get('name', f"shard{index}")
+            if name in shards:
+                raise ValueError(f"duplicate shard name {name}")
+            shards[name] = DBHelperPostgress(connection_data=shard_cfg)
+        return shards
+
+    @classmethod
+    def get_executor(cls):
+        """ thread pool of the scatter-gather calls. Size from env DDBB_SHARD_CONCURRENCY """
+        if cls._executor is None:
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(max_workers=int(os.environ.get('DDBB_SHARD_CONCURRENCY', 8)))
+        return cls._executor
+
+    @classmethod
+    def start_invocation(cls):
+        DBHelperPostgress.start_invocation()
+
+    def connect(self, name=None):
+        """ connection to shard name, the first configured shard by default. It only
+        sees the rows of that shard: pick the shard of a participant with get_shard """
+        if name is None:
+            name = next(iter(self.shards))
+        return self.shards[name].connect()
+
+    def _connection_get(self, shared_conn=None, name=None):
+        """ (myconn, connection) of shard name. A ShardedUnitOfWork gives its connection
+        of the shard, otherwise a new one is opened and must be closed by the caller """
+        if shared_conn is not None:
+            return False, shared_conn.get(name if name is not None else next(iter(self.shards)))
+        return True, self.connect(name)
+
+    def _connection_close(self, myconn:bool, shared_conn):
+        if myconn is True and shared_conn is not None:
+            shared_conn.close()
+
+    def get_shard(self, participant_id):
+        """ name of the shard of a participant """
+        return self.ring.get_shard(str(participant_id))
+
+    @contextlib.contextmanager
+    def unit_of_work(self, read_only=False):
+        """ one transaction per shard touched by the block, see ShardedUnitOfWork """
+        uow = ShardedUnitOfWork(self, read_only=read_only)
+        with uow.stack:
+            yield uow
+
+    def _call(self, name, method, shared_conn, **kwargs):
+        conn = shared_conn.get(name) if shared_conn is not None else None
+        return getattr(self.shards[name], method)(shared_conn=conn, **kwargs)
+
+    def _scatter(self, method, shared_conn, names=None, **kwargs):
+        """ runs method on every shard (or names) in parallel. Waits for all of them
+        and raises the first error.
+
+        Returns:
+            list: results in shard order
+        """
+        names = list(self.shards) if names is None else list(names)
+        if len(names) == 1:
+            return [self._call(names[0], method, shared_conn, **kwargs)]
+        futures = [self.get_executor().submit(self._call, name, method, shared_conn, **kwargs) for name in names]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def _participant_call(self, method, participant_id, shared_conn, **kwargs):
+        return self._call(self.get_shard(participant_id), method, shared_conn, participant_id=participant_id, **kwargs)
+
+    def insert_connection(self, participant_id,socket_id,space="PUBLIC",endpoint=None,compression=None,shared_conn=None):
+        return self._participant_call("insert_connection", participant_id, shared_conn, socket_id=socket_id, space=space,
+                                      endpoint=endpoint, compression=compression)
+
+    def update_connection(self, participant_id,socket_id,shared_conn=None):
+        return self._participant_call("update_connection", participant_id, shared_conn, socket_id=socket_id)
+
+    def delete_connection_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        if self.rebalancing:
+            return sum(self._scatter("delete_connection_by_participant", shared_conn,
+                                     participant_id=participant_id, space=space))
+        return self._participant_call("delete_connection_by_participant", participant_id, shared_conn, space=space)
+
+    def delete_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        return sum(self._scatter("delete_connection_by_socket", shared_conn, socket_id=socket_id, space=space))
+
+    def select_connections_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        if self.rebalancing:
+            return self._merge_connections(self._scatter("select_connections_by_participant", shared_conn,
+                                                         participant_id=participant_id, space=space))
+        return self._participant_call("select_connections_by_participant", participant_id, shared_conn, space=space)
+
+    @staticmethod
+    def _merge_connections(results):
+        # a socket being moved can be on two shards for a moment
+        merged = {}
+        for connections in results:
+            for connection in connections:
+                merged.setdefault(connection["socket_id"], connection)
+        return list(merged.values())
+
+    def select_connections_by_space(self, space,shared_conn=None):
+        return self._merge_connections(self._scatter("select_connections_by_space", shared_conn, space=space))
+
+    def select_connection_by_socket(self, socket_id,space=None,shared_conn=None):
+        return self._socket_shard_connection(socket_id, space=space, shared_conn=shared_conn)[1]
+
+    def _socket_shard_connection(self, socket_id, space=None, shared_conn=None):
+        """ (shard name, connection) of a socket, (None, None) when no shard has it """
+        names = list(self.shards)
+        for name, connection in zip(names, self._scatter("select_connection_by_socket", shared_conn,
+                                                        socket_id=socket_id, space=space)):
+            if connection is not None:
+                return name, connection
+        return None, None
+
+    def delete_connections_before(self, cutoff,limit=1000,idle_cutoff=None,space=None,shared_conn=None):
+        """ deletes up to limit connections in every shard. Returns the total, which is
+        less than limit only when every shard is done """
+        return sum(self._scatter("delete_connections_before", shared_conn, cutoff=cutoff, limit=limit,
+                                 idle_cutoff=idle_cutoff, space=space))
+
+    def update_last_seen(self, last_seen,space=None,shared_conn=None):
+        """ every shard gets the whole batch, the sockets of other shards match no row """
+        return sum(self._scatter("update_last_seen", shared_conn, last_seen=last_seen, space=space))
+
+    def insert_subscription(self, channel,socket_id,shared_conn=None):
+        """ stored in the shard of the socket, next to the connection it is joined with """
+        name, _ = self._socket_shard_connection(socket_id, shared_conn=shared_conn)
+        if name is None:
+            name = self.ring.get_shard(socket_id)
+        return self._call(name, "insert_subscription", shared_conn, channel=channel, socket_id=socket_id)
+
+    def delete_subscription(self, channel,socket_id,shared_conn=None):
+        return sum(self._scatter("delete_subscription", shared_conn, channel=channel, socket_id=socket_id))
+
+    def select_connections_by_channel(self, channel,shared_conn=None):
+        return self._merge_connections(self._scatter("select_connections_by_channel", shared_conn, channel=channel))
+
+    def select_connection_count_by_space(self, space,shared_conn=None):
+        return sum(self._scatter("select_connection_count_by_space", shared_conn, space=space))
+
+    def select_connection_count_by_participant(self, participant_id,space="PUBLIC",shared_conn=None):
+        if self.rebalancing:
+            return sum(self._scatter("select_connection_count_by_participant", shared_conn,
+                                     participant_id=participant_id, space=space))
+        return self._participant_call("select_connection_count_by_participant", participant_id, shared_conn, space=space)
+
+    def select_connection_counts(self, shared_conn=None):
+        totals = {}
+        for counts in self._scatter("select_connection_counts", shared_conn):
+            for count in counts:
+                totals[count["space"]] = totals.get(count["space"], 0)+count["connections"]
+        return [{"space": space, "connections": connections} for space, connections in sorted(totals.items())]
+
+    def select_connection_spaces(self, shared_conn=None):
+        spaces = set()
+        for shard_spaces in self._scatter("select_connection_spaces", shared_conn):
+            spaces.update(shard_spaces)
+        return sorted(spaces)
+
+    def insert_processed_message(self, message_id,done=True,shared_conn=None):
+        return self._call(self.ring.get_shard(message_id), "insert_processed_message", shared_conn,
+                          message_id=message_id, done=done)
+
+    def select_processed_message(self, message_id,shared_conn=None):
+        return self._call(self.ring.get_shard(message_id), "select_processed_message", shared_conn,
+                          message_id=message_id)
+
+    def delete_processed_messages_before(self, cutoff,limit=1000,shared_conn=None):
+        """ deletes up to limit ids in every shard, see delete_connections_before """
+        return sum(self._scatter("delete_processed_messages_before", shared_conn, cutoff=cutoff, limit=limit))
+
+    def insert_buffered_message(self, participant_id,space,message,ttl_seconds=300,max_messages=100,shared_conn=None):
+        return self._participant_call("insert_buffered_message", participant_id, shared_conn, space=space,
+                                      message=message, ttl_seconds=ttl_seconds, max_messages=max_messages)
+
+    def select_buffered_messages(self, participant_id,space,after_seq=0,limit=100,shared_conn=None):
+        if self.rebalancing:
+            merged = {}
+            for messages in self._scatter("select_buffered_messages", shared_conn, participant_id=participant_id,
+                                          space=space, after_seq=after_seq, limit=limit):
+                for message in messages:
+                    merged.setdefault(message["seq"], message)
+            return [merged[seq] for seq in sorted(merged)][:limit]
+        return self._participant_call("select_buffered_messages", participant_id, shared_conn, space=space,
+                                      after_seq=after_seq, limit=limit)
+
+    def delete_expired_messages(self, limit=1000,shared_conn=None):
+        return sum(self._scatter("delete_expired_messages", shared_conn, limit=limit))
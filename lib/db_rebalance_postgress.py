@@ -0,0 +1,186 @@
+"""
+Moves participants to the shard that owns them after shards are added to
+DBHelperShardedPostgress. Uses the shards configured in the environment
+(DDBB_SHARDS), so add the new shard to the configuration, create its schema,
+deploy with DDBB_SHARD_REBALANCING=true and then run:
+
+    python -m lib.db_rebalance_postgress --dry-run
+    python -m lib.db_rebalance_postgress
+
+Each participant is copied to its new shard (connections, subscriptions of its
+sockets, sequence counter and buffered messages) and then deleted from the old
+one, one participant per transaction pair. Copies skip rows that already exist,
+so an interrupted run can be run again. Buffered messages whose sequence number
+is taken in the new shard are appended after the messages stored there. Turn
+rebalancing off when it is done.
+"""
+import argparse
+import logging
+import os
+import sys
+from .db_helper_postgress import DBHelperPostgress
+from .db_helper_sharded import DBHelperShardedPostgress
+
+
+logger = logging.getLogger(__name__)
+
+
+def misplaced_participants(sharded:DBHelperShardedPostgress,name):
+    """ participants stored in shard name that belong to another shard
+
+    Args:
+        sharded (DBHelperShardedPostgress): sharded helper with the new shard list
+        name (str): shard to scan
+
+    Returns:
+        list: (participant_id, space, owner shard name) tuples
+    """
+    sql = """select participant_id,space from client_connections
+            union select participant_id,space from participant_message_seqs;"""
+    shard=sharded.shards[name]
+    conn = None
+    myconn=False
+    misplaced=[]
+
+    try:
+        myconn,conn=shard._connection_get()
+        cur = conn.cursor()
+        cur.execute(sql)
+        for participant_id,space in cur.fetchall():
+            owner=sharded.get_shard(participant_id)
+            if owner!=name:
+                misplaced.append((participant_id,space,owner))
+        cur.close()
+    except:
+        raise
+    finally:
+        shard._connection_close(myconn=myconn,shared_conn=conn)
+    return misplaced
+
+
+def move_participant(source:DBHelperPostgress,target:DBHelperPostgress,participant_id,space):
+    """ copies the rows of a participant in a space to target and deletes them from source.
+    Counters of both shards are kept in line.
+
+    Returns:
+        int: connections moved
+    """
+    source_myconn,source_conn=source._connection_get()
+    target_myconn,target_conn=target._connection_get()
+    try:
+        source_cur=source_conn.cursor()
+        source_cur.execute("""select participant_id,socket_id,space,connected,endpoint,compression,last_seen
+                from client_connections where participant_id=%s and space=%s;""", (participant_id,space))
+        connections=source_cur.fetchall()
+        sockets=[row[1] for row in connections]
+        source_cur.execute("""select channel,socket_id from channel_subscriptions where socket_id = ANY(%s);""",
+                           (sockets,))
+        subscriptions=source_cur.fetchall()
+        source_cur.execute("""select last_seq from participant_message_seqs where participant_id=%s and space=%s;""",
+                           (participant_id,space))
+        seq_row=source_cur.fetchone()
+        source_cur.execute("""select seq,message,expires from participant_messages
+                where participant_id=%s and space=%s and expires>now() order by seq;""", (participant_id,space))
+        messages=source_cur.fetchall()
+
+        target_cur=target_conn.cursor()
+        inserted=[]
+        for row in connections:
+            target_cur.execute("""INSERT INTO client_connections(participant_id,socket_id,space,connected,endpoint,compression,last_seen)
+                    VALUES(%s,%s,%s,%s,%s,%s,%s) ON CONFLICT DO NOTHING
+                    returning participant_id,space;""", row)
+            inserted.extend(target_cur.fetchall())
+        target._update_connection_counts(target_cur,inserted,delta=1)
+        for row in subscriptions:
+            target_cur.execute("""INSERT INTO channel_subscriptions(channel,socket_id)
+                    VALUES(%s,%s) ON CONFLICT DO NOTHING;""", row)
+        if seq_row is not None:
+            # the participant may have buffered messages in the new shard already. The upsert
+            # locks the counter, messages buffered meanwhile wait for the copy
+            target_cur.execute("""INSERT INTO participant_message_seqs(participant_id,space,last_seq) VALUES(%s,%s,%s)
+                    ON CONFLICT (participant_id,space)
+                    DO UPDATE SET last_seq=greatest(participant_message_seqs.last_seq,EXCLUDED.last_seq);""",
+                               (participant_id,space,seq_row[0]))
+        target_cur.execute("""select seq,message,expires from participant_messages
+                where participant_id=%s and space=%s;""", (participant_id,space))
+        stored=target_cur.fetchall()
+        taken={row[0] for row in stored}
+        copied={(row[1],row[2]) for row in stored}
+        # rows copied by an interrupted run are skipped
+        messages=[row for row in messages if (row[1],row[2]) not in copied]
+        # messages buffered in the new shard since rebalancing started took some sequence
+        # numbers: the moved messages are appended after them, keeping their order
+        renumber=any(row[0] in taken for row in messages)
+        for seq,message,expires in messages:
+            if renumber:
+                target_cur.execute("""UPDATE participant_message_seqs SET last_seq=last_seq+1
+                        where participant_id=%s and space=%s returning last_seq;""", (participant_id,space))
+                seq=target_cur.fetchone()[0]
+            target_cur.execute("""INSERT INTO participant_messages(participant_id,space,seq,message,expires)
+                    VALUES(%s,%s,%s,%s,%s);""", (participant_id,space,seq,message,expires))
+        if renumber:
+            logger.warning("Renumbered %s buffered messages of participant %s space %s.", len(messages), participant_id, space)
+        target_conn.commit()
+        target_cur.close()
+
+        # deleted only once the copy is committed, a failure leaves both copies and the next run retries
+        source_cur.execute("""delete from client_connections where participant_id=%s and space=%s and socket_id = ANY(%s)
+                returning participant_id,space,socket_id;""", (participant_id,space,sockets))
+        source._connections_deleted(source_cur,source_cur.fetchall())
+        source_cur.execute("""delete from participant_messages where participant_id=%s and space=%s;""",
+                           (participant_id,space))
+        source_cur.execute("""delete from participant_message_seqs where participant_id=%s and space=%s;""",
+                           (participant_id,space))
+        source_conn.commit()
+        source_cur.close()
+    except:
+        source_conn.rollback()
+        target_conn.rollback()
+        raise
+    finally:
+        source._connection_close(myconn=source_myconn,shared_conn=source_conn)
+        target._connection_close(myconn=target_myconn,shared_conn=target_conn)
+    return len(connections)
+
+
+def rebalance(sharded:DBHelperShardedPostgress=None,dry_run=False):
+    """ moves every misplaced participant to its shard
+
+    Args:
+        sharded (DBHelperShardedPostgress, optional): helper with the new shard list. Defaults to a new one from environment.
+        dry_run (bool, optional): only count the participants to move. Defaults to False.
+
+    Returns:
+        dict: (source, target) -> participants moved, or to move with dry_run
+    """
+    if sharded is None:
+        sharded=DBHelperShardedPostgress()
+    moved={}
+    for name in sharded.shards:
+        for participant_id,space,owner in misplaced_participants(sharded,name):
+            if not dry_run:
+                connections=move_participant(sharded.shards[name],sharded.shards[owner],participant_id,space)
+                logger.debug("Moved participant %s space %s with %s connections from %s to %s."
+                             , participant_id, space, connections, name, owner)
+            moved[(name,owner)]=moved.get((name,owner),0)+1
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move participants to their shard after adding shards.")
+    parser.add_argument('--dry-run', action='store_true', help="only count the participants to move")
+    args = parser.parse_args()
+
+    moved=rebalance(dry_run=args.dry_run)
+    for (source,target),participants in sorted(moved.items()):
+        logger.info("%s %s participants from %s to %s.", "To move" if args.dry_run else "Moved"
+                    , participants, source, target)
+    if not moved:
+        logger.info("Every participant is in its shard.")
+
+
+if __name__ == '__main__':
+    from .load_env import load_env
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s', stream=sys.stderr)
+    load_env(env_file_name="apigateway",env_type=os.environ.get('ENV_TYPE',"DEV"))
+    main()
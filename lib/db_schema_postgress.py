@@ -0,0 +1,380 @@
+"""
+Schema used by DBHelperPostgress. Run this module to create the tables in the
+database configured in the environment.
+
+client_connections can be partitioned by space:
+    python -m lib.db_schema_postgress create --partition-by list
+    python -m lib.db_schema_postgress add-space-partition BIG_TENANT
+    python -m lib.db_schema_postgress vacuum-space BIG_TENANT
+    python -m lib.db_schema_postgress detach-space-partition BIG_TENANT
+
+With list partitioning every space lives in client_connections_default until
+it gets its own partition, which can then be vacuumed or detached alone.
+Hash partitioning spreads spaces over a fixed number of partitions.
+DBHelperPostgress always filters by space when it knows it, so those queries
+only touch one partition.
+"""
+import argparse
+import hashlib
+import logging
+import re
+from psycopg2 import sql as pgsql
+from .db_helper_postgress import DBHelperPostgress
+
+
+logger = logging.getLogger(__name__)
+
+CLIENT_CONNECTIONS_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS client_connections (
+    participant_id  varchar(64)  NOT NULL,
+    socket_id       varchar(128) NOT NULL,
+    space           varchar(64)  NOT NULL DEFAULT 'PUBLIC',
+    connected       timestamp with time zone NOT NULL DEFAULT now(),
+    endpoint        varchar(255),
+    compression     varchar(16),
+    last_seen       timestamp with time zone,
+    PRIMARY KEY (socket_id)
+);
+"""
+
+# The primary key of a partitioned table must include the partition key.
+CLIENT_CONNECTIONS_PARTITIONED_DDL = """
+CREATE TABLE IF NOT EXISTS client_connections (
+    participant_id  varchar(64)  NOT NULL,
+    socket_id       varchar(128) NOT NULL,
+    space           varchar(64)  NOT NULL DEFAULT 'PUBLIC',
+    connected       timestamp with time zone NOT NULL DEFAULT now(),
+    endpoint        varchar(255),
+    compression     varchar(16),
+    last_seen       timestamp with time zone,
+    PRIMARY KEY (space, socket_id)
+) PARTITION BY {method} (space);
+"""
+
+# Management API url (https://domain/stage) of the socket. Adds the column to
+# tables created before it existed.
+CLIENT_CONNECTIONS_ENDPOINT_DDL = """
+ALTER TABLE client_connections ADD COLUMN IF NOT EXISTS endpoint varchar(255);
+"""
+
+# Frame compression negotiated at $connect, NULL for plain text frames.
+CLIENT_CONNECTIONS_COMPRESSION_DDL = """
+ALTER TABLE client_connections ADD COLUMN IF NOT EXISTS compression varchar(16);
+"""
+
+# last keepalive of the socket, written in batches. The reaper removes idle sockets with the index.
+CLIENT_CONNECTIONS_LAST_SEEN_DDL = """
+ALTER TABLE client_connections ADD COLUMN IF NOT EXISTS last_seen timestamp with time zone;
+CREATE INDEX IF NOT EXISTS client_connections_last_seen_idx
+    ON client_connections (last_seen);
+"""
+
+# Lookups by socket only. The unpartitioned table uses its primary key.
+CLIENT_CONNECTIONS_SOCKET_INDEX_DDL = """
+CREATE INDEX IF NOT EXISTS client_connections_socket_idx
+    ON client_connections (socket_id);
+"""
+
+# Created on the parent, postgres creates them on every partition.
+CLIENT_CONNECTIONS_INDEXES_DDL = """
+CREATE INDEX IF NOT EXISTS client_connections_participant_idx
+    ON client_connections (participant_id, space);
+CREATE INDEX IF NOT EXISTS client_connections_space_idx
+    ON client_connections (space);
+CREATE INDEX IF NOT EXISTS client_connections_connected_idx
+    ON client_connections (connected);
+"""
+
+CLIENT_CONNECTIONS_DDL = CLIENT_CONNECTIONS_TABLE_DDL + CLIENT_CONNECTIONS_INDEXES_DDL
+
+PARTITION_DEFAULT = "client_connections_default"
+PARTITION_METHODS = ("list", "hash")
+
+CONNECTION_COUNTS_DDL = """
+CREATE TABLE IF NOT EXISTS space_connection_counts (
+    space       varchar(64) NOT NULL,
+    connections integer     NOT NULL DEFAULT 0,
+    PRIMARY KEY (space)
+);
+CREATE TABLE IF NOT EXISTS participant_connection_counts (
+    participant_id  varchar(64) NOT NULL,
+    space           varchar(64) NOT NULL,
+    connections     integer     NOT NULL DEFAULT 0,
+    PRIMARY KEY (participant_id, space)
+);
+"""
+
+# Recomputes the counters from client_connections. Run it once after adding the
+# counter tables to an existing database, or to repair them.
+REBUILD_CONNECTION_COUNTS_SQL = """
+LOCK TABLE client_connections IN SHARE MODE;
+TRUNCATE space_connection_counts, participant_connection_counts;
+INSERT INTO participant_connection_counts(participant_id, space, connections)
+    SELECT participant_id, space, count(*) FROM client_connections GROUP BY participant_id, space;
+INSERT INTO space_connection_counts(space, connections)
+    SELECT space, count(*) FROM client_connections GROUP BY space;
+"""
+
+# Channel -> socket index. The primary key starts with channel so publishing to a
+# channel is one index range scan. socket_id index is used to drop the
+# subscriptions of a closed connection.
+CHANNEL_SUBSCRIPTIONS_DDL = """
+CREATE TABLE IF NOT EXISTS channel_subscriptions (
+    channel     varchar(128) NOT NULL,
+    socket_id   varchar(128) NOT NULL,
+    subscribed  timestamp with time zone NOT NULL DEFAULT now(),
+    PRIMARY KEY (channel, socket_id)
+);
+CREATE INDEX IF NOT EXISTS channel_subscriptions_socket_idx
+    ON channel_subscriptions (socket_id);
+"""
+
+PROCESSED_MESSAGES_DDL = """
+CREATE TABLE IF NOT EXISTS processed_messages (
+    message_id  varchar(128) NOT NULL,
+    processed   timestamp with time zone NOT NULL DEFAULT now(),
+    done        boolean NOT NULL DEFAULT true,
+    PRIMARY KEY (message_id)
+);
+-- false while the deliveries of a claimed message run, see IdempotencyGuard
+ALTER TABLE processed_messages ADD COLUMN IF NOT EXISTS done boolean NOT NULL DEFAULT true;
+CREATE INDEX IF NOT EXISTS processed_messages_processed_idx
+    ON processed_messages (processed);
+"""
+
+# Offline message buffer. Reads are range scans of the primary key
+# (participant_id, space, seq); the expires index is used by the reaper.
+MESSAGE_BUFFER_DDL = """
+CREATE TABLE IF NOT EXISTS participant_message_seqs (
+    participant_id  varchar(64) NOT NULL,
+    space           varchar(64) NOT NULL,
+    last_seq        bigint      NOT NULL,
+    PRIMARY KEY (participant_id, space)
+);
+CREATE TABLE IF NOT EXISTS participant_messages (
+    participant_id  varchar(64) NOT NULL,
+    space           varchar(64) NOT NULL,
+    seq             bigint      NOT NULL,
+    message         text        NOT NULL,
+    expires         timestamp with time zone NOT NULL,
+    PRIMARY KEY (participant_id, space, seq)
+);
+CREATE INDEX IF NOT EXISTS participant_messages_expires_idx
+    ON participant_messages (expires);
+"""
+
+
+def partition_name(space):
+    """ name of the dedicated list partition of a space.
+    A short hash keeps names of spaces that only differ in symbols apart.
+
+    Args:
+        space (str): space
+
+    Returns:
+        str: table name
+    """
+    slug=re.sub(r'[^a-z0-9]+','_',str(space).lower()).strip('_')[:30]
+    digest=hashlib.md5(str(space).encode('utf-8')).hexdigest()[:8]
+    return f"client_connections_{slug}_{digest}"
+
+
+def client_connections_statements(partition_by=None,partitions=8):
+    """ DDL of client_connections
+
+    Args:
+        partition_by (str, optional): None, 'list' or 'hash'. Defaults to None, not partitioned.
+        partitions (int, optional): number of hash partitions. Defaults to 8.
+
+    Returns:
+        list: list of sql strings
+    """
+    if partition_by is None:
+        return [CLIENT_CONNECTIONS_DDL, CLIENT_CONNECTIONS_ENDPOINT_DDL, CLIENT_CONNECTIONS_COMPRESSION_DDL
+                , CLIENT_CONNECTIONS_LAST_SEEN_DDL]
+    if partition_by not in PARTITION_METHODS:
+        raise ValueError(f"Unknown partition method: {partition_by}")
+
+    statements=[CLIENT_CONNECTIONS_PARTITIONED_DDL.format(method=partition_by.upper())]
+    if partition_by=="list":
+        statements.append(f"CREATE TABLE IF NOT EXISTS {PARTITION_DEFAULT} PARTITION OF client_connections DEFAULT;")
+    else:
+        for remainder in range(partitions):
+            statements.append(
+                f"CREATE TABLE IF NOT EXISTS client_connections_h{remainder} PARTITION OF client_connections "
+                f"FOR VALUES WITH (MODULUS {partitions}, REMAINDER {remainder});")
+    statements.append(CLIENT_CONNECTIONS_INDEXES_DDL+CLIENT_CONNECTIONS_SOCKET_INDEX_DDL)
+    statements.append(CLIENT_CONNECTIONS_ENDPOINT_DDL)
+    statements.append(CLIENT_CONNECTIONS_COMPRESSION_DDL)
+    statements.append(CLIENT_CONNECTIONS_LAST_SEEN_DDL)
+    return statements
+
+
+def schema_statements(partition_by=None,partitions=8):
+    """ returns the DDL statements in creation order
+
+    Args:
+        partition_by (str, optional): partition method of client_connections, None, 'list' or 'hash'.
+        partitions (int, optional): number of hash partitions. Defaults to 8.
+
+    Returns:
+        list: list of sql strings
+    """
+    return client_connections_statements(partition_by=partition_by,partitions=partitions) \
+        + [CONNECTION_COUNTS_DDL, CHANNEL_SUBSCRIPTIONS_DDL, PROCESSED_MESSAGES_DDL, MESSAGE_BUFFER_DDL]
+
+
+def _execute(db,statements,autocommit=False):
+    """ runs the statements in one transaction, or one by one with autocommit (needed by VACUUM) """
+    if db is None:
+        db=DBHelperPostgress()
+    conn=None
+    try:
+        conn=db.connect()
+        conn.autocommit=autocommit
+        cur=conn.cursor()
+        for sql in statements:
+            cur.execute(sql)
+        if not autocommit:
+            conn.commit()
+        cur.close()
+    except:
+        raise
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def create_schema(db:DBHelperPostgress=None,partition_by=None,partitions=8):
+    """ creates the tables if they do not exist
+
+    Args:
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+        partition_by (str, optional): partition method of client_connections, None, 'list' or 'hash'.
+        partitions (int, optional): number of hash partitions. Defaults to 8.
+    """
+    _execute(db,schema_statements(partition_by=partition_by,partitions=partitions))
+    logger.info("Schema created.")
+
+
+def add_space_partition(space,db:DBHelperPostgress=None):
+    """ gives a space its own list partition and moves its rows out of the default partition.
+    Runs in one transaction; the default partition is detached while rows are moved.
+
+    Args:
+        space (str): space
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+    """
+    partition=pgsql.Identifier(partition_name(space))
+    default=pgsql.Identifier(PARTITION_DEFAULT)
+    value=pgsql.Literal(str(space))
+    statements=[
+        pgsql.SQL("ALTER TABLE client_connections DETACH PARTITION {};").format(default),
+        pgsql.SQL("CREATE TABLE {} PARTITION OF client_connections FOR VALUES IN ({});").format(partition,value),
+        pgsql.SQL("INSERT INTO client_connections SELECT * FROM {} WHERE space = {};").format(default,value),
+        pgsql.SQL("DELETE FROM {} WHERE space = {};").format(default,value),
+        pgsql.SQL("ALTER TABLE client_connections ATTACH PARTITION {} DEFAULT;").format(default),
+    ]
+    _execute(db,statements)
+    logger.info("Created partition %s for space %s.", partition_name(space), space)
+
+
+def detach_space_partition(space,db:DBHelperPostgress=None,drop=False):
+    """ detaches the list partition of a space. The table keeps its rows unless drop is True.
+
+    Args:
+        space (str): space
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+        drop (bool, optional): drop the detached table. Defaults to False.
+    """
+    partition=pgsql.Identifier(partition_name(space))
+    statements=[pgsql.SQL("ALTER TABLE client_connections DETACH PARTITION {};").format(partition)]
+    if drop:
+        statements.append(pgsql.SQL("DROP TABLE {};").format(partition))
+    _execute(db,statements)
+    logger.info("Detached partition %s of space %s.", partition_name(space), space)
+
+
+def vacuum_space_partition(space,db:DBHelperPostgress=None):
+    """ VACUUM ANALYZE of the partition that holds the space, without touching the others.
+
+    Args:
+        space (str): space
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+    """
+    if db is None:
+        db=DBHelperPostgress()
+    conn=None
+    partition=None
+    try:
+        conn=db.connect()
+        cur=conn.cursor()
+        cur.execute("select tableoid::regclass::text from client_connections where space=%s limit 1;",(str(space),))
+        row=cur.fetchone()
+        partition=row[0] if row is not None else partition_name(space)
+        cur.close()
+    except:
+        raise
+    finally:
+        if conn is not None:
+            conn.close()
+    # regclass text is already quoted when needed
+    _execute(db,[pgsql.SQL("VACUUM (ANALYZE) {};").format(pgsql.SQL(partition))],autocommit=True)
+    logger.info("Vacuumed %s.", partition)
+
+
+def rebuild_connection_counts(db:DBHelperPostgress=None):
+    """ recomputes space and participant counters from client_connections
+
+    Args:
+        db (DBHelperPostgress, optional): helper used to connect. Defaults to a new one from environment.
+    """
+    if db is None:
+        db=DBHelperPostgress()
+    conn=None
+    try:
+        conn=db.connect()
+        cur=conn.cursor()
+        cur.execute(REBUILD_CONNECTION_COUNTS_SQL)
+        conn.commit()
+        cur.close()
+        logger.info("Connection counters rebuilt.")
+    except:
+        raise
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and maintain the postgres schema of the websocket app.")
+    parser.add_argument(
+        'action', choices=['create', 'rebuild-counts', 'add-space-partition', 'detach-space-partition', 'vacuum-space'],
+        help="Indicates the action the script performs.")
+    parser.add_argument('space', nargs='?', help="space for the partition actions")
+    parser.add_argument('--partition-by', choices=PARTITION_METHODS, default=None,
+                        help="partition client_connections by space. Only used by create")
+    parser.add_argument('--partitions', type=int, default=8, help="number of hash partitions")
+    parser.add_argument('--drop', action='store_true', help="drop the table after detaching it")
+    args = parser.parse_args()
+
+    if args.action in ('add-space-partition', 'detach-space-partition', 'vacuum-space') and args.space is None:
+        parser.error(f"{args.action} needs a space")
+
+    if args.action == 'create':
+        create_schema(partition_by=args.partition_by,partitions=args.partitions)
+    elif args.action == 'rebuild-counts':
+        rebuild_connection_counts()
+    elif args.action == 'add-space-partition':
+        add_space_partition(args.space)
+    elif args.action == 'detach-space-partition':
+        detach_space_partition(args.space,drop=args.drop)
+    elif args.action == 'vacuum-space':
+        vacuum_space_partition(args.space)
+
+
+if __name__ == '__main__':
+    from .load_env import load_env
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    load_env(env_file_name="apigateway")
+    main()
@@ -1,45 +1,150 @@
+import logging
 import os
+import threading
 from .db_helper_postgress import DBHelperPostgress
+from .db_helper_memory import DBHelperMemory
+from .db_helper_sharded import DBHelperShardedPostgress
+from .async_db_helper_postgress import AsyncDBHelperPostgress
+from .async_db_helper_memory import AsyncDBHelperMemory
+
+
+logger = logging.getLogger(__name__)
+
+
+def _entry_points(group):
+    """ installed entry points of group. Empty when importlib.metadata is not available """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:  # python 3.7
+        try:
+            from importlib_metadata import entry_points
+        except ImportError:
+            return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
 
 
 class DIDBHelper:
-    """Static singleton pattern for database helper selection."""
-    
+    """
+    Static singleton container for database helper selection.
+
+    The helper classes are selected with the environment keys db_handler and
+    async_db_handler. Besides the built-in classes, third party packages can publish
+    helpers as entry points in the groups apigateway_websocket.db_helpers and
+    apigateway_websocket.async_db_helpers; the entry point name is the value to use in
+    db_handler. Entry points are only scanned when the name is not a built-in class.
+
+    Helpers live in a scope, environment key db_handler_scope:
+        singleton: one helper per container, the default. Pools and clients are built once.
+        invocation: one helper per lambda invocation, dropped by start_invocation.
+    """
+
+    SINGLETON = "singleton"
+    INVOCATION = "invocation"
+    ENTRY_POINT_GROUP = "apigateway_websocket.db_helpers"
+    ASYNC_ENTRY_POINT_GROUP = "apigateway_websocket.async_db_helpers"
+
     _instance = None  # Class-level variable to hold the singleton instance
+    _instance_lock = threading.Lock()
     db_helper_classes = {
         "DBHelperPostgress": DBHelperPostgress,
+        "DBHelperMemory": DBHelperMemory,
+        "DBHelperShardedPostgress": DBHelperShardedPostgress,
+    }
+    async_db_helper_classes = {
+        "AsyncDBHelperPostgress": AsyncDBHelperPostgress,
+        "AsyncDBHelperMemory": AsyncDBHelperMemory,
     }
 
     def __init__(self):
         """Private initializer to prevent instantiation outside of get_instance."""
         if DIDBHelper._instance is not None:
             raise RuntimeError("Use get_instance() to get the singleton instance")
-        
+
         # Automatically configure the instance based on environment variable
         class_name = os.getenv("db_handler", "DBHelperPostgress")
-        if class_name not in DIDBHelper.db_helper_classes:
-            raise ValueError(f"Unknown class: {class_name}")
-        
-        # Set the implementation based on the environment variable
-        self.implementation = DIDBHelper.db_helper_classes[class_name]
+        self.implementation = self._find_class(class_name, DIDBHelper.db_helper_classes, self.ENTRY_POINT_GROUP)
+
+        async_class_name = os.getenv("async_db_handler", "AsyncDBHelperPostgress")
+        self.async_implementation = self._find_class(async_class_name, DIDBHelper.async_db_helper_classes
+                                                     , self.ASYNC_ENTRY_POINT_GROUP)
+
+        self.scope = os.getenv("db_handler_scope", self.SINGLETON)
+        if self.scope not in (self.SINGLETON, self.INVOCATION):
+            raise ValueError(f"Unknown scope: {self.scope}")
+        self._helpers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _find_class(class_name, classes, group):
+        """ built-in class or entry point named class_name. Loaded entry points are cached in classes """
+        if class_name in classes:
+            return classes[class_name]
+        for entry_point in _entry_points(group):
+            if entry_point.name == class_name:
+                logger.info("Loading DB helper %s from entry point %s.", class_name, entry_point.value)
+                classes[class_name] = entry_point.load()
+                return classes[class_name]
+        raise ValueError(f"Unknown class: {class_name}")
+
+    @classmethod
+    def register(cls, class_name, helper_class, is_async=False):
+        """Registers a helper class under class_name, like an entry point would."""
+        classes = cls.async_db_helper_classes if is_async else cls.db_helper_classes
+        classes[class_name] = helper_class
 
     @classmethod
     def get_instance(cls):
-        """Returns the singleton instance, creating it if necessary."""
+        """Returns the singleton instance, creating it if necessary. Thread safe."""
         if cls._instance is None:
-            cls._instance = cls()
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
         return cls._instance
 
+    @classmethod
+    def reset(cls):
+        """Drops the singleton instance, the next get_instance reads the environment again."""
+        with cls._instance_lock:
+            cls._instance = None
+
+    def _helper(self, key, implementation):
+        helper = self._helpers.get(key)
+        if helper is None:
+            with self._lock:
+                helper = self._helpers.get(key)
+                if helper is None:
+                    helper = implementation()
+                    self._helpers[key] = helper
+        return helper
+
     def resolve(self):
-        """Creates and returns a new instance of the configured DB helper."""
-        return self.implementation()  # Create a new instance of the configured class
+        """Returns the configured DB helper of the current scope."""
+        return self._helper("sync", self.implementation)
+
+    def resolve_async(self):
+        """Returns the configured async DB helper of the current scope."""
+        return self._helper("async", self.async_implementation)
+
+    def start_invocation(self):
+        """Resets the per invocation state of the configured DB helper classes and
+        drops the helpers of the invocation scope. Third party helpers without a
+        start_invocation have no such state."""
+        for implementation in (self.implementation, self.async_implementation):
+            start_invocation = getattr(implementation, 'start_invocation', None)
+            if start_invocation is not None:
+                start_invocation()
+        if self.scope == self.INVOCATION:
+            with self._lock:
+                self._helpers.clear()
 
 # Usage
 if __name__ == '__main__':
     from .load_env import load_env
     load_env(env_file_name="apigateway")
 
-    # Get the singleton instance of DIDBHelper and resolve a new DB helper instance
+    # Get the singleton instance of DIDBHelper and resolve the DB helper
     db = DIDBHelper.get_instance().resolve()
     print(db)
-
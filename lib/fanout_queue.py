@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+import boto3
+from .codec import get_codec
+
+
+logger = logging.getLogger(__name__)
+
+
+class FanoutQueue:
+    """
+    Queue of fan-out work items. Each item is a sendmessage body with the sockets of
+    one chunk; parallel invocations consume the items and each one delivers its chunk.
+    """
+
+    def send_batch(self, items, delay_seconds=0):
+        """ enqueue a list of work items (dicts), visible to consumers after delay_seconds.
+        Returns the items that could not be enqueued """
+        raise NotImplementedError
+
+
+class SQSFanoutQueue(FanoutQueue):
+    """Sends the work items to the SQS queue that triggers the lambda (env fanout_queue_url)."""
+
+    # SendMessageBatch limits: 10 entries and 256 KiB for the whole batch
+    BATCH_SIZE = 10
+    BATCH_BYTES = 262144
+
+    def __init__(self, queue_url, client=None):
+        self.queue_url = queue_url
+        self.client = client if client is not None else boto3.client('sqs')
+
+    def send_batch(self, items, delay_seconds=0):
+        failed = []
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            encoded = get_codec().dumps(item)
+            body = encoded.decode('utf-8')
+            size = len(encoded)
+            if batch and (len(batch) == self.BATCH_SIZE or batch_bytes+size > self.BATCH_BYTES):
+                failed.extend(self._send(batch, delay_seconds))
+                batch, batch_bytes = [], 0
+            batch.append((item, body))
+            batch_bytes += size
+        if batch:
+            failed.extend(self._send(batch, delay_seconds))
+        return failed
+
+    def _send(self, batch, delay_seconds=0):
+        """ sends one SendMessageBatch request, returns the items that were not enqueued """
+        entries = [{'Id': str(index), 'MessageBody': body} for index, (item, body) in enumerate(batch)]
+        if delay_seconds:
+            for entry in entries:
+                entry['DelaySeconds'] = int(delay_seconds)
+        try:
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+        except Exception:
+            logger.exception("Couldn't enqueue %s fan-out items.", len(batch))
+            return [item for item, body in batch]
+        failed = [batch[int(entry['Id'])][0] for entry in response.get('Failed', [])]
+        if failed:
+            logger.warning("Couldn't enqueue %s fan-out items: %s", len(failed), response['Failed'])
+        return failed
+
+
+class MemoryFanoutQueue(FanoutQueue):
+    """Keeps the work items and their delays in lists. Only for tests, nothing consumes them."""
+
+    def __init__(self):
+        self.items = []
+        self.delays = []
+        self._lock = threading.Lock()
+
+    def send_batch(self, items, delay_seconds=0):
+        with self._lock:
+            self.items.extend(items)
+            self.delays.extend([delay_seconds]*len(items))
+        return []
+
+
+_queues = {}
+
+
+def get_fanout_queue():
+    """ returns the configured fan-out queue or None when fan-out is not configured.
+    Queues are kept for the life of the container so the sqs client is created once """
+    queue_url = os.environ.get('fanout_queue_url')
+    if not queue_url:
+        return None
+    if queue_url not in _queues:
+        _queues[queue_url] = SQSFanoutQueue(queue_url)
+    return _queues[queue_url]
@@ -0,0 +1,187 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from .di_db_helper import DIDBHelper
+
+
+logger = logging.getLogger(__name__)
+
+
+class IdempotencyStore:
+    """
+    Durable record of processed message ids. Implementations must survive a lambda
+    container restart so redeliveries arriving in a new container are detected.
+    """
+
+    def is_processed(self, message_id):
+        """ True if the message id was marked as processed """
+        raise NotImplementedError
+
+    def mark_processed(self, message_id):
+        """ mark the message id as processed """
+        raise NotImplementedError
+
+    def claim(self, message_id, shared_conn=None):
+        """ mark the message id as in progress in the transaction of shared_conn. A
+        claim that was never completed can be claimed again by a redelivery.
+
+        Returns:
+            bool: True if the message must be handled, False if it was already processed
+        """
+        raise NotImplementedError
+
+    def complete(self, message_id, shared_conn=None):
+        """ mark a claimed message id as processed """
+        raise NotImplementedError
+
+
+class DBIdempotencyStore(IdempotencyStore):
+    """Stores processed message ids in the active DBHelper backend (table processed_messages)."""
+
+    def get_db_handler(self):
+        return DIDBHelper.get_instance().resolve()
+
+    def is_processed(self, message_id):
+        return self.get_db_handler().select_processed_message(message_id=message_id)
+
+    def mark_processed(self, message_id):
+        self.get_db_handler().insert_processed_message(message_id=message_id)
+
+    def claim(self, message_id, shared_conn=None):
+        # the unique key makes check and mark one statement: a concurrent delivery
+        # waits for the first transaction and then finds the row
+        return self.get_db_handler().insert_processed_message(message_id=message_id, done=False,
+                                                              shared_conn=shared_conn)
+
+    def complete(self, message_id, shared_conn=None):
+        self.get_db_handler().insert_processed_message(message_id=message_id, done=True, shared_conn=shared_conn)
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """Keeps processed message ids in a set. Only for tests, it is lost with the container."""
+
+    def __init__(self):
+        self.message_ids = set()
+
+    def is_processed(self, message_id):
+        return message_id in self.message_ids
+
+    def mark_processed(self, message_id):
+        self.message_ids.add(message_id)
+
+    def claim(self, message_id, shared_conn=None):
+        return message_id not in self.message_ids
+
+    def complete(self, message_id, shared_conn=None):
+        self.message_ids.add(message_id)
+
+
+class IdempotencyGuard:
+    """
+    Detects duplicated messages by id. A bounded LRU cache in the container answers
+    most redeliveries without touching the durable store. On a cache miss, claim
+    marks the message as in progress inside the transaction of the invocation, so
+    the mark is rolled back with the changes of a failed invocation. The deliveries
+    run after that commit; complete marks the message done once they finished. A
+    redelivery of a message whose invocation died between the two (timeout, crash
+    in the middle of the fan-out) finds the claim unfinished and is handled again,
+    so the message is delivered at least once. Ids are cached once done, see remember.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, store:IdempotencyStore=None, max_size=None):
+        """
+        Args:
+            store (IdempotencyStore, optional): durable store. Defaults to DBIdempotencyStore.
+            max_size (int, optional): max ids kept in memory. Defaults to env idempotency_cache_size or 1024.
+        """
+        if store is None:
+            store = DBIdempotencyStore()
+        if max_size is None:
+            max_size = int(os.environ.get("idempotency_cache_size", 1024))
+        self.store = store
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """Returns the container wide guard, creating it if necessary."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def remember(self, message_id):
+        """ cache a processed message id. Call it once its mark is committed """
+        if message_id is None:
+            return
+        with self._lock:
+            self._cache[message_id] = True
+            self._cache.move_to_end(message_id)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def is_cached(self, message_id):
+        """ True if the container already saw the message processed, the store is not read """
+        with self._lock:
+            if message_id in self._cache:
+                self._cache.move_to_end(message_id)
+                return True
+        return False
+
+    def is_duplicate(self, message_id):
+        """ check if the message was already processed
+
+        Args:
+            message_id (str): message id. None is never a duplicate.
+
+        Returns:
+            bool: True if the message must be skipped
+        """
+        if message_id is None:
+            return False
+        if self.is_cached(message_id):
+            return True
+        if self.store.is_processed(message_id):
+            self.remember(message_id)
+            return True
+        return False
+
+    def claim(self, message_id, shared_conn=None):
+        """ check and mark the message in one step, in the transaction of shared_conn.
+        The id is not cached here: call remember after the commit.
+
+        Args:
+            message_id (str): message id. None is never a duplicate.
+            shared_conn (any, optional): connection of the unit of work. Defaults to None.
+
+        Returns:
+            bool: True if the message must be handled, False for a duplicate
+        """
+        if message_id is None:
+            return True
+        if self.is_cached(message_id):
+            return False
+        if not self.store.claim(message_id, shared_conn=shared_conn):
+            self.remember(message_id)
+            return False
+        return True
+
+    def complete(self, message_id, shared_conn=None):
+        """ mark a claimed message as done, in the transaction of shared_conn when given.
+        The id is not cached here: call remember after the commit """
+        if message_id is None:
+            return
+        self.store.complete(message_id, shared_conn=shared_conn)
+
+    def mark_processed(self, message_id):
+        """ record the message as processed in cache and store """
+        if message_id is None:
+            return
+        self.store.mark_processed(message_id)
+        self.remember(message_id)
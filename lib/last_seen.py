@@ -0,0 +1,115 @@
+import datetime as dt
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LastSeenBuffer:
+    """
+    Coalesces the last_seen updates of keepalive pings. Pings only record the time of
+    their socket in the container; the pending times are written as one multi-row
+    UPDATE when max_pending sockets are waiting or the oldest one waited flush_seconds.
+    A socket that pings several times before a flush is written once. Sockets are
+    grouped by space and each space is one UPDATE limited to its partition; sockets
+    whose space is unknown share one UPDATE over every partition.
+
+    Lambda runs no code between invocations, so the buffer is flushed when due at the
+    start of every invocation of the container, not only by pings. The database value
+    of a socket then lags its last ping by at most flush_seconds plus the time until
+    the container is invoked again. Pending times are lost if the container is
+    recycled before that; the next ping of the socket records it again, one ping
+    interval later.
+
+    last_seen is only used by the reaper, which removes sockets idle for more than
+    idle_seconds. A live socket looks idle for up to flush_seconds plus its ping
+    interval, so the reaper refuses an idle_seconds that is not larger than that;
+    leave at least one more ping interval of margin to cover a lost batch.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_pending=None, flush_seconds=None, clock=time.monotonic):
+        """
+        Args:
+            max_pending (int, optional): sockets that trigger a flush. Defaults to env last_seen_batch_size or 500.
+            flush_seconds (float, optional): max wait of a pending time. Defaults to env last_seen_flush_seconds or 60.
+            clock (callable, optional): monotonic clock, for tests.
+        """
+        if max_pending is None:
+            max_pending = int(os.environ.get("last_seen_batch_size", 500))
+        if flush_seconds is None:
+            flush_seconds = float(os.environ.get("last_seen_flush_seconds", 60))
+        self.max_pending = max_pending
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        self._pending = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """Returns the container wide buffer, creating it if necessary."""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    def touch(self, socket_id, seen=None, space=None):
+        """ records that socket_id, of space when known, was seen now or at seen (datetime) """
+        seen = seen or dt.datetime.now(dt.timezone.utc)
+        key = (space, socket_id)
+        with self._lock:
+            if not self._pending:
+                self._oldest = self.clock()
+            previous = self._pending.get(key)
+            if previous is None or previous < seen:
+                self._pending[key] = seen
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def should_flush(self):
+        """ True when a batch is full or the oldest pending time waited long enough """
+        with self._lock:
+            return bool(self._pending) and (len(self._pending) >= self.max_pending
+                                            or self.clock()-self._oldest >= self.flush_seconds)
+
+    def flush(self, db, shared_conn=None):
+        """ writes every pending time with one db.update_last_seen call per space. When a
+        write fails the times not written yet are kept for the next flush and the error
+        is raised.
+
+        Returns:
+            int: sockets written
+        """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            oldest, self._oldest = self._oldest, None
+        if not batch:
+            return 0
+        spaces = {}
+        for (space, socket_id), seen in batch.items():
+            spaces.setdefault(space, {})[socket_id] = seen
+        written = 0
+        try:
+            for space, last_seen in spaces.items():
+                db.update_last_seen(last_seen=last_seen, space=space, shared_conn=shared_conn)
+                written += len(last_seen)
+                for socket_id in last_seen:
+                    del batch[(space, socket_id)]
+        except Exception:
+            with self._lock:
+                for key, seen in batch.items():
+                    if key not in self._pending or self._pending[key] < seen:
+                        self._pending[key] = seen
+                self._oldest = oldest if self._oldest is None else min(oldest, self._oldest)
+            raise
+        logger.info("Flushed last_seen of %s sockets.", written)
+        return written
@@ -0,0 +1,109 @@
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryTracker:
+    """
+    Measures the peak memory allocated by each stage of an invocation with tracemalloc:
+    parse, lookup, payload and delivery. The peak of a stage is the highest allocation
+    above the memory in use when the stage started, so it is what the stage adds to
+    the footprint of the invocation. Stages run one after the other, they must not be
+    nested. A stage entered several times keeps its highest peak.
+
+    Enabled with the environment key memory_tracking=true, see get_memory_tracker.
+    tracemalloc slows python allocations down, it is a measurement mode.
+    """
+
+    STAGES = ("parse", "lookup", "payload", "delivery")
+
+    enabled = True
+
+    def __init__(self):
+        self.stages = {}
+        self._started = False
+
+    def start(self):
+        """ starts tracing unless it is already running, e.g. under pytest -X tracemalloc """
+        self.stages = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started = True
+
+    def stop(self):
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    @contextmanager
+    def tracing(self):
+        """ traces the with block, e.g. one invocation """
+        self.start()
+        try:
+            yield self
+        finally:
+            self.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """ measures the peak allocation of the with block as stage name """
+        if not tracemalloc.is_tracing():
+            yield
+            return
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]-base
+            self.stages[name] = max(self.stages.get(name, 0), peak)
+
+    def report(self, **labels):
+        """ writes the stage peaks as a CloudWatch embedded metric format log line.
+        Namespace from environment key metrics_namespace """
+        namespace = os.environ.get("metrics_namespace", "WebsocketApp")
+        dimensions = sorted(key for key, value in labels.items() if value is not None)
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time()*1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [dimensions],
+                    "Metrics": [{"Name": f"MemoryPeak_{stage}", "Unit": "Bytes"} for stage in self.stages]}]},
+            **{key: labels[key] for key in dimensions},
+            **{f"MemoryPeak_{stage}": peak for stage, peak in self.stages.items()}}
+        # print, not logger: EMF must be the whole log line
+        print(json.dumps(record))
+        return record
+
+
+class NullMemoryTracker(MemoryTracker):
+    """Tracker used when memory tracking is off. Stages cost nothing."""
+
+    enabled = False
+
+    def start(self):
+        pass
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def report(self, **labels):
+        return None
+
+
+_null_tracker = NullMemoryTracker()
+
+
+def get_memory_tracker():
+    """ a new MemoryTracker when environment key memory_tracking is true, otherwise the shared no-op tracker """
+    if os.environ.get("memory_tracking", "false").lower() == "true":
+        return MemoryTracker()
+    return _null_tracker
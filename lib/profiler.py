@@ -0,0 +1,148 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+def fanout_bucket(size):
+    """ label of a fan-out size: 0, 1-9, 10-99, 100-999, 1k-9k, 10k-99k... """
+    if not size:
+        return "0"
+    if size < 1000:
+        low = 10 ** (len(str(size))-1)
+        return f"{low}-{low*10-1}"
+    low = 10 ** (len(str(size))-1) // 1000
+    return f"{low}k-{low*10-1}k"
+
+
+class Profile:
+    """
+    Samples of one profiled invocation. Stacks are counted by their collapsed form,
+    outermost frame first, and prefixed with the labels when written.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.labels = {}
+        self.stacks = Counter()
+        self.samples = 0
+        self.seconds = 0
+
+    def collapsed(self):
+        """ lines in the collapsed stack format of flamegraph.pl and speedscope: `frame;frame;... count` """
+        prefix = ";".join(f"{key}:{value}" for key, value in self.labels.items() if value is not None)
+        return [f"{prefix};{stack} {count}" if prefix else f"{stack} {count}"
+                for stack, count in self.stacks.most_common()]
+
+
+class SamplingProfiler:
+    """
+    Sampling CPU profiler for lambda invocations. While an invocation runs, a thread
+    takes the python stack of the invoking thread and of the busy delivery threads
+    every interval seconds. Sampling adds no cost to the profiled code besides the
+    sampler thread, so it can run on real traffic.
+
+    Configured with environment keys:
+        profile_enabled: true profiles every invocation.
+        profile_sample_percent: percentage of invocations profiled when not enabled, default 0.
+        profile_interval_ms: sampling interval, default 5.
+        profile_output: tmp writes a file per invocation in profile_dir (default /tmp/profiles),
+                        log writes the collapsed lines to the log. Default tmp.
+    """
+
+    # frames of idle pool threads waiting for work
+    IDLE_FRAMES = {("thread.py", "_worker"), ("threading.py", "wait"), ("queue.py", "get")}
+
+    def __init__(self, interval=0.005, sample_percent=100, output="tmp", directory="/tmp/profiles"):
+        self.interval = interval
+        self.sample_percent = sample_percent
+        self.output = output
+        self.directory = Path(directory)
+
+    def should_profile(self):
+        return self.sample_percent >= 100 or random.uniform(0, 100) < self.sample_percent
+
+    @contextmanager
+    def profile(self, name):
+        """
+        Samples the code run inside the with block. Yields the Profile so the caller
+        can add labels; it is written when the block ends, also on errors.
+
+        :param name: name of the profile, e.g. the aws request id.
+        """
+        profile = Profile(name)
+        stop = threading.Event()
+        target = threading.get_ident()
+        sampler = threading.Thread(target=self._sample, args=(profile, target, stop),
+                                   name="profiler", daemon=True)
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            yield profile
+        finally:
+            stop.set()
+            sampler.join()
+            profile.seconds = time.perf_counter()-start
+            try:
+                self.write(profile)
+            except Exception:
+                logger.exception("Couldn't write profile %s.", name)
+
+    def _sample(self, profile, target, stop):
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if thread_id != target and self._is_idle(frame):
+                    continue
+                profile.stacks[self._collapse(frame, thread_id == target)] += 1
+            profile.samples += 1
+
+    def _is_idle(self, frame):
+        return (Path(frame.f_code.co_filename).name, frame.f_code.co_name) in self.IDLE_FRAMES
+
+    @staticmethod
+    def _collapse(frame, main):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{Path(code.co_filename).stem}:{code.co_name}")
+            frame = frame.f_back
+        frames.append("main" if main else "worker")
+        return ";".join(reversed(frames))
+
+    def write(self, profile):
+        """ writes the collapsed stacks to profile_dir or to the log, see profile_output """
+        logger.info("Profile %s: %s samples in %.3f s, labels %s.", profile.name, profile.samples, profile.seconds,
+                    profile.labels)
+        lines = profile.collapsed()
+        if self.output == "log":
+            for line in lines:
+                logger.info("PROFILE %s %s", profile.name, line)
+            return None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{profile.name}.collapsed"
+        path.write_text("\n".join(lines)+"\n" if lines else "")
+        return path
+
+
+def get_profiler():
+    """ returns a profiler when this invocation must be profiled, otherwise None.
+    See SamplingProfiler for the environment keys """
+    enabled = os.environ.get("profile_enabled", "false").lower() == "true"
+    percent = 100 if enabled else float(os.environ.get("profile_sample_percent", 0))
+    if percent <= 0:
+        return None
+    profiler = SamplingProfiler(interval=float(os.environ.get("profile_interval_ms", 5))/1000, sample_percent=percent,
+                                output=os.environ.get("profile_output", "tmp"),
+                                directory=os.environ.get("profile_dir", "/tmp/profiles"))
+    return profiler if profiler.should_profile() else None
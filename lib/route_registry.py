@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class RouteRequest:
+    """
+    One routed request, as resolved by SocketHandleConnections.filter_route_key.
+
+    Attributes:
+        event (dict): lambda event
+        context (any): lambda context
+        route_key (str): route key, e.g. $connect or sendmessage
+        socket_id (str): websocket connection ID, "00000" for REST and SQS callers
+        body (dict): decoded body, or the query string parameters of a REST GET
+        caller_type (str): WEBSOCKET, REST or SQS
+    """
+
+    def __init__(self,event,context,route_key,socket_id,body,caller_type):
+        self.event=event
+        self.context=context
+        self.route_key=route_key
+        self.socket_id=socket_id
+        self.body=body
+        self.caller_type=caller_type
+
+
+class Route:
+    """
+    A registered route.
+
+    Attributes:
+        route_key (str): route key
+        handler (callable): handler(socket_handler, request) returning a response dict
+        caller_types (tuple or None): caller types accepted. None accepts all
+        read_only (bool): the route only reads, its unit of work can use a read replica
+        transactional (bool): the route runs in a unit of work. False for routes that
+                              usually do not touch the database, no connection is opened for them
+    """
+
+    def __init__(self,route_key,handler,caller_types=None,read_only=False,transactional=True):
+        self.route_key=route_key
+        self.handler=handler
+        self.caller_types=tuple(caller_types) if caller_types is not None else None
+        self.read_only=read_only
+        self.transactional=transactional
+
+    def accepts(self,caller_type):
+        return self.caller_types is None or caller_type in self.caller_types
+
+
+class RouteRegistry:
+    """
+    Maps route keys to handlers. New routes and middleware plug in with add_route and
+    add_middleware, without touching SocketHandleConnections.lambda_handler.
+
+    A middleware is a callable middleware(socket_handler, request, call_next) that
+    returns a response dict, usually the one of call_next(socket_handler, request).
+    The middleware chain of each route is composed once and reused until the
+    registry changes. Every dispatch records the route latency, see latency_report.
+    """
+
+    def __init__(self):
+        self._routes={}
+        self._rest_routes={}
+        self._middleware=[]
+        self._chains={}
+        self._stats={}
+        self._lock=threading.Lock()
+
+    def add_route(self,route_key,handler,caller_types=None,read_only=False,transactional=True):
+        """ registers or replaces the handler of route_key """
+        self._routes[route_key]=Route(route_key,handler,caller_types=caller_types,read_only=read_only
+                                      ,transactional=transactional)
+        self._chains.clear()
+        return self
+
+    def route(self,route_key,caller_types=None,read_only=False,transactional=True):
+        """ decorator version of add_route """
+        def decorator(handler):
+            self.add_route(route_key,handler,caller_types=caller_types,read_only=read_only
+                           ,transactional=transactional)
+            return handler
+        return decorator
+
+    def add_rest_route(self,resource_path,http_method,route_key):
+        """ maps a REST resource path and method to a route key. http_method None matches any method """
+        self._rest_routes[(resource_path,http_method)]=route_key
+        return self
+
+    def rest_route_key(self,resource_path,http_method):
+        """ route key of a REST request or None """
+        route_key=self._rest_routes.get((resource_path,http_method))
+        if route_key is None:
+            route_key=self._rest_routes.get((resource_path,None))
+        return route_key
+
+    def add_middleware(self,middleware,route_keys=None):
+        """ adds a middleware. The first one added is the outermost.
+
+        Args:
+            middleware (callable): middleware(socket_handler, request, call_next)
+            route_keys (list, optional): routes it applies to. Defaults to all routes.
+        """
+        self._middleware.append((middleware,set(route_keys) if route_keys is not None else None))
+        self._chains.clear()
+        return self
+
+    def get_route(self,route_key,caller_type):
+        """ the route for this key and caller type or None """
+        route=self._routes.get(route_key)
+        if route is None or not route.accepts(caller_type):
+            return None
+        return route
+
+    def _chain(self,route):
+        chain=self._chains.get(route.route_key)
+        if chain is None:
+            chain=route.handler
+            for middleware,route_keys in reversed(self._middleware):
+                if route_keys is None or route.route_key in route_keys:
+                    chain=self._wrap(middleware,chain)
+            self._chains[route.route_key]=chain
+        return chain
+
+    @staticmethod
+    def _wrap(middleware,call_next):
+        def call(socket_handler,request):
+            return middleware(socket_handler,request,call_next)
+        return call
+
+    def dispatch(self,socket_handler,request:RouteRequest):
+        """ runs the route of the request through its middleware. Unknown routes get a 404 """
+        route=self.get_route(request.route_key,request.caller_type)
+        if route is None:
+            return {'statusCode': 404}
+        start=time.perf_counter()
+        try:
+            return self._chain(route)(socket_handler,request)
+        finally:
+            elapsed_ms=(time.perf_counter()-start)*1000
+            self._record(route.route_key,elapsed_ms)
+            logger.info("route %s took %.1f ms", route.route_key, elapsed_ms)
+
+    def _record(self,route_key,elapsed_ms):
+        with self._lock:
+            stats=self._stats.setdefault(route_key,{"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"]+=1
+            stats["total_ms"]+=elapsed_ms
+            stats["max_ms"]=max(stats["max_ms"],elapsed_ms)
+
+    def latency_report(self):
+        """ latency of each route dispatched in this container
+
+        Returns:
+            dict: route key -> count, mean_ms and max_ms
+        """
+        with self._lock:
+            return {route_key: {"count": stats["count"],
+                                "mean_ms": stats["total_ms"]/stats["count"],
+                                "max_ms": stats["max_ms"]}
+                    for route_key,stats in self._stats.items()}
@@ -12,15 +12,25 @@
 """
 
 
-import json
 import logging
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
 import jwt
 import datetime as dt
 from lib import DBHelper
 from lib.di_db_helper import DIDBHelper
+from lib.idempotency import IdempotencyGuard
+from lib.fanout_queue import get_fanout_queue
+from lib.blob_store import get_blob_store
+from lib.route_registry import RouteRegistry, RouteRequest
+from lib.codec import get_codec, get_compression
+from lib.circuit_breaker import CircuitOpenError
+from lib.memory_tracker import get_memory_tracker
+from lib.last_seen import LastSeenBuffer
 
 
 logger = logging.getLogger()
@@ -29,6 +39,19 @@ debug_mode=False
 
 
 class SocketHandleConnections:
+
+    # API Gateway rejects websocket messages larger than this
+    MAX_MESSAGE_BYTES = 131072
+
+    # route registry of each class, built once by get_route_registry
+    _routes = None
+    # container wide management clients by endpoint and delivery pool
+    _management_clients = {}
+    _management_clients_lock = threading.Lock()
+    _executor = None
+    # space of the sockets connected through this container, for events that carry no space
+    _socket_spaces = OrderedDict()
+    _socket_spaces_lock = threading.Lock()
     
     def __init__(self):
         """
@@ -39,23 +62,153 @@ class SocketHandleConnections:
             log (logger): Logger
             event (dict or None): Initializes to None, set to the event passed by lambda later later.
             event (str): Initializes to "PUBLIC". Public is the default space.
+            message_id (str or None): id of the queue message being handled. Only set for SQS.
+            shared_conn (any): connection of the invocation unit of work, passed to every DB call.
+            _after_commit (list or None): work deferred until the unit of work commits, see after_commit.
+            route_key (str or None): route of the invocation, a profile label.
+            fanout_size (int): sockets addressed by the invocation, a profile label.
+            memory (MemoryTracker): peak allocation per stage, a no-op unless env memory_tracking is true.
         """     
         self.log = logging.getLogger(__name__)          
         self.event=None # event dict
         self.space="PUBLIC"
+        self.message_id=None
+        self.shared_conn=None
+        self._after_commit=None
+        self.route_key=None
+        self.fanout_size=0
+        self.memory=get_memory_tracker()
         
         
     def get_db_handler(self):
         return DIDBHelper.get_instance().resolve()
+
+    def get_idempotency_guard(self):
+        return IdempotencyGuard.get_instance()
+
+    def get_fanout_queue(self):
+        return get_fanout_queue()
+
+    def get_codec(self):
+        return get_codec()
+
+    def get_blob_store(self):
+        return get_blob_store()
+
+    def get_last_seen_buffer(self):
+        return LastSeenBuffer.get_instance()
+
+    def unit_of_work(self,route,request):
+        """ unit of work of one invocation of route. Queue invocations always write: the
+        processed mark of the message is part of it """
+        return self.get_db_handler().unit_of_work(read_only=route.read_only and request.caller_type!="SQS")
+
+    def claim_message(self,guard,route):
+        """ checks and marks the queue message in the unit of work, see IdempotencyGuard.claim.
+        False for a redelivered message """
+        return guard.claim(self.message_id,shared_conn=self.shared_conn)
+
+    def complete_message(self,guard,route):
+        """ marks the claimed queue message as done, in the unit of work when one is open """
+        guard.complete(self.message_id,shared_conn=self.shared_conn)
+
+    def after_commit(self,callback):
+        """ runs callback once the unit of work of the invocation is committed, or now
+        when there is none. Used for the deliveries, so no transaction and no row lock
+        is held while the posts are in flight. Dropped if the unit of work rolls back. """
+        if self._after_commit is None:
+            callback()
+        else:
+            self._after_commit.append(callback)
+
+    @classmethod
+    def get_executor(cls):
+        """ thread pool used to deliver to several endpoints at once. Size from env delivery_concurrency """
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=int(os.environ.get('delivery_concurrency', 16)))
+        return cls._executor
+
+    def get_management_client(self,endpoint):
+        """ API Gateway Management API client of an endpoint (https://domain/stage).
+        Clients are created once per endpoint and kept for the container """
+        client=SocketHandleConnections._management_clients.get(endpoint)
+        if client is None:
+            with SocketHandleConnections._management_clients_lock:
+                client=SocketHandleConnections._management_clients.get(endpoint)
+                if client is None:
+                    client=boto3.client('apigatewaymanagementapi', endpoint_url=endpoint)
+                    SocketHandleConnections._management_clients[endpoint]=client
+        return client
+
+    def get_event_endpoint(self,event):
+        """ management API url of the websocket API that sent the event, None for REST and SQS """
+        domain = event.get('requestContext', {}).get('domainName')
+        stage = event.get('requestContext', {}).get('stage')
+        if domain is None or stage is None:
+            return None
+        return f'https://{domain}/{stage}'
+
+    def get_event_space(self,event,socket_id=None):
+        """ space of the socket that sent the event, None when unknown. $disconnect and ping
+        carry no space: it is read from the authorizer context when a Lambda authorizer
+        sets it, else from the sockets connected through this container """
+        space=(event.get('requestContext', {}).get('authorizer') or {}).get('space')
+        if space is None and socket_id is not None:
+            with SocketHandleConnections._socket_spaces_lock:
+                space=SocketHandleConnections._socket_spaces.get(socket_id)
+        return space
+
+    def remember_socket_space(self,socket_id,space):
+        """ keeps the space of a socket for get_event_space. Only the newest
+        socket_space_cache_size (env, default 10000) sockets are kept """
+        limit=int(os.environ.get('socket_space_cache_size', 10000))
+        with SocketHandleConnections._socket_spaces_lock:
+            SocketHandleConnections._socket_spaces[socket_id]=space
+            SocketHandleConnections._socket_spaces.move_to_end(socket_id)
+            while len(SocketHandleConnections._socket_spaces)>limit:
+                SocketHandleConnections._socket_spaces.popitem(last=False)
+
+    def forget_socket_space(self,socket_id):
+        with SocketHandleConnections._socket_spaces_lock:
+            SocketHandleConnections._socket_spaces.pop(socket_id,None)
+
+    @classmethod
+    def get_route_registry(cls):
+        """ route registry of this class. Built on first use with register_routes; plugins
+        add routes and middleware to it, e.g. SocketHandleConnections.get_route_registry().add_route(...) """
+        if cls.__dict__.get('_routes') is None:
+            cls._routes=cls.register_routes(RouteRegistry())
+        return cls._routes
+
+    @classmethod
+    def register_routes(cls,routes:RouteRegistry):
+        """ registers the built-in routes. Subclasses extend it calling super """
+        routes.add_route('$connect',cls.route_connect)
+        routes.add_route('$disconnect',cls.route_disconnect)
+        routes.add_route('sendmessage',cls.route_send_message)
+        routes.add_route('subscribe',cls.route_subscribe,caller_types=("WEBSOCKET",))
+        routes.add_route('unsubscribe',cls.route_unsubscribe,caller_types=("WEBSOCKET",))
+        routes.add_route('connectioncount',cls.route_connection_count,caller_types=("REST",),read_only=True)
+        #resume from websocket clients, or from the queue when enqueued by $connect
+        routes.add_route('resume',cls.route_resume,caller_types=("WEBSOCKET","SQS"))
+        #keepalive, no unit of work: last_seen is written in batches by handle_ping
+        routes.add_route('ping',cls.route_ping,caller_types=("WEBSOCKET",),transactional=False)
+        #GET only reads counters, parameters come in the query string
+        routes.add_rest_route('/{participant_id+}','GET','connectioncount')
+        routes.add_rest_route('/{participant_id+}',None,'sendmessage')
+        return routes
         
 
-    def handle_connect_by_token(self,token,socket_id, space=None):
+    def handle_connect_by_token(self,token,socket_id, space=None,endpoint=None,last_seq=None,compression=None):
         """Handles new connections validating token by adding the connection ID and participant_id to the  store table.
 
         Args:
             token (str): token fo the user. Must include id_user and expiry date
             socket_id (any): The websocket connection ID of the new connection.
             space (str, optional): space. Defaults to None.
+            endpoint (str, optional): management API url of the socket. Defaults to None.
+            last_seq (int, optional): last message sequence seen by the client. Defaults to None.
+            compression (str, optional): frame compression accepted by the client. Defaults to None.
 
         Returns:
             int: An HTTP status code that indicates the result of adding the connection
@@ -70,7 +223,7 @@ class SocketHandleConnections:
                 return 401
             exp_date=payload['exp']
             now=dt.datetime.now(dt.timezone.utc)         
-            token_expiration_date =dt.datetime.fromtimestamp(exp_date)
+            token_expiration_date =dt.datetime.fromtimestamp(exp_date,tz=dt.timezone.utc)
             
             if token_expiration_date<now:
                 logger.exception("Couldn't add connection date expired for token %s %s %s", token ,token_expiration_date,now)
@@ -80,27 +233,48 @@ class SocketHandleConnections:
                 "Couldn't add connection  for token %s", token)
             return 401
 
-        return self.handle_connect(participant_id=participant_id,socket_id=socket_id,space=space)
+        return self.handle_connect(participant_id=participant_id,socket_id=socket_id,space=space,endpoint=endpoint
+                                   ,last_seq=last_seq,compression=compression)
 
 
-    def handle_connect(self,participant_id,socket_id,space="PUBLIC"):
+    def handle_connect(self,participant_id,socket_id,space="PUBLIC",endpoint=None,last_seq=None,compression=None):
         """Handles new connections adding the connection ID and participant_id to the  store table.
 
+        API Gateway does not accept posts to a socket before $connect returns, so when
+        the client sends last_seq the replay of missed messages is enqueued as a resume
+        work item, after the connection is committed and delayed resume_delay_seconds
+        (env, default 2) so the handshake is done before it runs. Without fan-out queue
+        the client must send the resume route itself.
+
+        Clients that can decompress frames pass compression (gzip or deflate, see
+        lib/codec.py). It is stored with the connection; unknown values are ignored.
+
         Args:
             participant_id (str): id_user used 
             socket_id (any): The websocket connection ID of the new connection.
             space (str, optional): space. Defaults to None.
+            endpoint (str, optional): management API url of the socket. Defaults to None.
+            last_seq (int, optional): last message sequence seen by the client. Defaults to None.
+            compression (str, optional): frame compression accepted by the client. Defaults to None.
 
         Returns:
             int: An HTTP status code that indicates the result of adding the connection
                 to the DynamoDB table.
         """ 
         status_code = 200
+        if compression is not None and get_compression(compression) is None:
+            logger.info("Unknown compression %s for %s, using plain frames.", compression, socket_id)
+            compression=None
         try:   
             db=self.get_db_handler()
-            db.insert_connection(participant_id=str(participant_id),socket_id=socket_id,space=space)
+            db.insert_connection(participant_id=str(participant_id),socket_id=socket_id,space=space,endpoint=endpoint
+                                 ,compression=compression,shared_conn=self.shared_conn)
             logger.debug(
                 "Added connection %s for %s. ", socket_id, participant_id)
+            self.remember_socket_space(socket_id,space)
+            if last_seq is not None:
+                self.after_commit(lambda: self.enqueue_resume(participant_id=participant_id,socket_id=socket_id,space=space
+                                                              ,endpoint=endpoint,last_seq=last_seq,compression=compression))
         except ClientError:
             logger.exception(
                 "Couldn't add connection %s for %s.", socket_id, participant_id)
@@ -108,10 +282,26 @@ class SocketHandleConnections:
         return status_code
 
 
-    def handle_disconnect(self,socket_id):
+    def enqueue_resume(self,participant_id,socket_id,space,endpoint,last_seq,compression=None):
+        """ enqueues a resume work item for a socket that is still connecting. The item is
+        delayed resume_delay_seconds (env, default 2) """
+        queue=self.get_fanout_queue()
+        if queue is None:
+            logger.debug("No fan-out queue, %s must send resume to get its missed messages.", socket_id)
+            return False
+        failed=queue.send_batch([{"action": "resume", "socket_id": socket_id, "participant_id": str(participant_id)
+                                  , "space": space, "endpoint": endpoint, "last_seq": int(last_seq)
+                                  , "compression": compression}]
+                                ,delay_seconds=int(os.environ.get('resume_delay_seconds', 2)))
+        if failed:
+            logger.warning("Couldn't enqueue resume of %s.", socket_id)
+        return not failed
+
+    def handle_disconnect(self,socket_id,space=None):
         """
         Handles disconnections by removing the connection record from the table.
         :param socket_id: The websocket connection ID of the connection to remove.
+        :param space: Space of the connection when known, limits the delete to its partition.
         :return: An HTTP status code that indicates the result of removing the connection
                 from the DynamoDB table.
         """
@@ -119,105 +309,583 @@ class SocketHandleConnections:
         logger.debug("Trying to disconnect %s.", socket_id)
         try:
             db=self.get_db_handler()
-            db.delete_connection_by_socket(socket_id=socket_id)
+            db.delete_connection_by_socket(socket_id=socket_id,space=space,shared_conn=self.shared_conn)
+            self.forget_socket_space(socket_id)
             logger.debug("Disconnected connection %s.", socket_id)
         except ClientError:
             logger.exception("Couldn't disconnect connection %s.", socket_id)
             status_code = 503
         return status_code
 
+    def handle_reap(self,max_age_seconds=7200,chunk_size=1000,context=None,idle_seconds=None
+                    ,processed_retention_seconds=None):
+        """
+        Removes connections older than max_age_seconds in chunks of chunk_size rows.
+        API Gateway closes websockets after 2 hours, so older rows are dead clients
+        that never sent $disconnect. Spaces are reaped one at a time, taken from the
+        connection counters, so each delete only touches one partition. Expired
+        buffered messages and old processed message ids are removed afterwards.
+
+        :param max_age_seconds: Age in seconds after which a connection is removed.
+        :param chunk_size: Max rows deleted per statement.
+        :param idle_seconds: When given, connections whose last ping (last_seen) is older
+                             are removed too. Connections that never pinged are kept.
+                             Pings are written late, see LastSeenBuffer, so it must be
+                             larger than last_seen_flush_seconds plus ping_interval_seconds
+                             (env, default 300, the keepalive period of the clients).
+        :param context: Lambda context. When given, the reaper stops before the
+                        invocation runs out of time and the next run continues.
+        :param processed_retention_seconds: Age after which processed queue message ids
+                        are forgotten. A redelivery arriving later is handled again, so it
+                        must be longer than the retention period of the queue plus its
+                        redrive window. Defaults to env processed_retention_seconds or
+                        1296000 (15 days; SQS keeps messages 14 days at most).
+        :return: The number of removed connections.
+        """
+        if processed_retention_seconds is None:
+            processed_retention_seconds=int(os.environ.get('processed_retention_seconds', 1296000))
+        if idle_seconds is not None:
+            ping_interval=float(os.environ.get('ping_interval_seconds', 300))
+            lag=self.get_last_seen_buffer().flush_seconds+ping_interval
+            if idle_seconds<=lag:
+                raise ValueError(f"idle_seconds {idle_seconds} must be larger than the last_seen lag of {lag} seconds"
+                                 " (last_seen_flush_seconds + ping_interval_seconds)")
+        now=dt.datetime.now(dt.timezone.utc)
+        cutoff=now-dt.timedelta(seconds=max_age_seconds)
+        idle_cutoff=now-dt.timedelta(seconds=idle_seconds) if idle_seconds is not None else None
+        db=self.get_db_handler()
+        deleted=0
+        timed_out=False
+        # from client_connections itself: a space whose counter row is missing still has rows to reap
+        for space in db.select_connection_spaces():
+            while not timed_out:
+                if context is not None and context.get_remaining_time_in_millis()<5000:
+                    logger.warning("Reaper stopped by timeout after removing %s connections.", deleted)
+                    timed_out=True
+                    break
+                chunk=db.delete_connections_before(cutoff=cutoff,limit=chunk_size,idle_cutoff=idle_cutoff
+                                                   ,space=space)
+                deleted+=chunk
+                if chunk<chunk_size:
+                    break
+        logger.info("Reaper removed %s connections older than %s.", deleted, cutoff)
+        expired=0
+        while context is None or context.get_remaining_time_in_millis()>=5000:
+            chunk=db.delete_expired_messages(limit=chunk_size)
+            expired+=chunk
+            if chunk<chunk_size:
+                break
+        logger.info("Reaper removed %s expired buffered messages.", expired)
+        processed_cutoff=now-dt.timedelta(seconds=processed_retention_seconds)
+        forgotten=0
+        while context is None or context.get_remaining_time_in_millis()>=5000:
+            chunk=db.delete_processed_messages_before(cutoff=processed_cutoff,limit=chunk_size)
+            forgotten+=chunk
+            if chunk<chunk_size:
+                break
+        logger.info("Reaper removed %s message ids processed before %s.", forgotten, processed_cutoff)
+        return deleted
+
+    def handle_connection_count(self,params):
+        """
+        Returns the connection counters. Reads the counters kept by the DB helper,
+        never client_connections, so dashboards can poll it.
+
+        :param params: dict with optional `space` and `participant_id`. Without
+                       space, the counters of all spaces are returned.
+        :return: A response dict with status code and a json body.
+        """
+        response = {'statusCode': 200}
+        space=params.get('space')
+        participant_id=params.get('participant_id')
+        try:
+            db=self.get_db_handler()
+            if space is None:
+                result={"spaces": db.select_connection_counts(shared_conn=self.shared_conn)}
+            else:
+                result={"space": space, "connections": db.select_connection_count_by_space(space=space,shared_conn=self.shared_conn)}
+                if participant_id is not None:
+                    result["participant_id"]=participant_id
+                    result["participant_connections"]=db.select_connection_count_by_participant(
+                        participant_id=str(participant_id),space=space,shared_conn=self.shared_conn)
+        except Exception:
+            logger.exception("Couldn't read connection counts for space %s.", space)
+            response['statusCode'] = 503
+            return response
+        response['headers']={"Content-Type": "application/json"}
+        response['body']=self.get_codec().dumps(result).decode('utf-8')
+        return response
+
     def get_connections_by_participant(self,participant_id,space="PUBLIC"):
+        """ recipients of a message. Read on a read-only connection of its own (a replica when
+        configured), not on the invocation unit of work """
         db=self.get_db_handler()
         connections=db.select_connections_by_participant(participant_id=str(participant_id),space=space)
         return connections
 
 
+    def get_connections_by_channel(self,channel):
+        """ subscribers of a channel, read like get_connections_by_participant """
+        db=self.get_db_handler()
+        connections=db.select_connections_by_channel(channel=str(channel))
+        return connections
+
+    def handle_subscribe(self,socket_id,event_body):
+        """
+        Subscribes the socket to the channel in `event_body['channel']`. A socket
+        can follow any number of channels besides its space.
+
+        :param socket_id: The websocket connection ID.
+        :param event_body: dict with a `channel` field.
+        :return: An HTTP status code.
+        """
+        channel=event_body.get('channel')
+        if not channel:
+            return 400
+        try:
+            db=self.get_db_handler()
+            db.insert_subscription(channel=str(channel),socket_id=socket_id,shared_conn=self.shared_conn)
+            logger.debug("Subscribed %s to channel %s.", socket_id, channel)
+        except Exception:
+            logger.exception("Couldn't subscribe %s to channel %s.", socket_id, channel)
+            return 503
+        return 200
+
+    def handle_unsubscribe(self,socket_id,event_body):
+        """
+        Removes the subscription of the socket to `event_body['channel']`.
+
+        :param socket_id: The websocket connection ID.
+        :param event_body: dict with a `channel` field.
+        :return: An HTTP status code.
+        """
+        channel=event_body.get('channel')
+        if not channel:
+            return 400
+        try:
+            db=self.get_db_handler()
+            db.delete_subscription(channel=str(channel),socket_id=socket_id,shared_conn=self.shared_conn)
+            logger.debug("Unsubscribed %s from channel %s.", socket_id, channel)
+        except Exception:
+            logger.exception("Couldn't unsubscribe %s from channel %s.", socket_id, channel)
+            return 503
+        return 200
+
     def handle_message(self,event_body, apig_management_client):
         """
-        Handles messages sent by a participant. Looks up all connections
-        currently tracked in the DynamoDB table, and uses the API Gateway Management API
-        to post the message to each other connection.
+        Handles messages sent by a participant. Looks up the connections addressed
+        by the message and uses the API Gateway Management API to post the message
+        to each of them. A message is addressed to a channel when the body has a
+        `channel` field, otherwise to `participant_id` in `space`.
 
         When posting to a connection results in a GoneException, the connection is
         considered disconnected and is removed from the table. This is necessary
         because disconnect messages are not always sent when a client disconnects.
 
+        The buffered message is written in the unit of work of the invocation and the
+        delivery runs after its commit (see after_commit), so a slow fan-out never holds
+        the sequence and counter rows. Recipients are read on a read-only connection.
+
         :param event_body: The body of the message sent from API Gateway. This is a
                         dict with a `msg` field that contains the message to send.
+        Messages to a participant are also stored in the offline buffer (see
+        buffer_message) and carry their sequence number in `seq`. When the participant
+        has no sockets the buffered message waits for a resume and 202 is returned.
+
+        Large payloads are stored once in the blob store and the recipients get a
+        `message_ref` with its url instead of `message`, see encode_content.
+
         :param apig_management_client: A Boto3 API Gateway Management API client.
         :return: An HTTP status code that indicates the result of posting the message
                 to all active connections.
         """
         status_code = 200
-        participant_id = event_body['participant_id']
-        space = event_body['space']
+        channel = event_body.get('channel')
+        participant_id = event_body.get('participant_id')
+        space = event_body.get('space')
 
-        logger.debug("search for participant %s.", participant_id)
-        sockets=[]
-        try:
-            connections = self.get_connections_by_participant(participant_id= str(participant_id),space=space)
-            for conn in connections:
-                socket_id=conn.get("socket_id")
-                if socket_id:                
-                    sockets.append(socket_id) 
-        except Exception as ex:
-            logger.exception("handle_message() Couldn't find participant using %s %s", participant_id , str(ex))
-            return 404
+        with self.memory.stage("payload"):
+            try:
+                content=self.encode_content(event_body['msg'])
+            except Exception:
+                logger.exception("Couldn't offload the payload for participant %s channel %s.", participant_id, channel)
+                return 503
+            if content is None:
+                return 413
 
-        if len(sockets)==0:
+            seq=None
+            if channel is None:
+                seq=self.buffer_message(participant_id=participant_id,space=space,content=content)
+
+        targets={}  # (endpoint, compression) -> sockets
+        with self.memory.stage("lookup"):
+            try:
+                if channel is not None:
+                    logger.debug("search for channel %s.", channel)
+                    connections = self.get_connections_by_channel(channel=channel)
+                else:
+                    logger.debug("search for participant %s.", participant_id)
+                    connections = self.get_connections_by_participant(participant_id= str(participant_id),space=space)
+                for conn in connections:
+                    socket_id=conn.get("socket_id")
+                    if socket_id:                
+                        targets.setdefault((conn.get("endpoint"),conn.get("compression")),[]).append(socket_id)
+                # only the socket ids are kept for the delivery
+                del connections
+            except CircuitOpenError:
+                raise
+            except Exception as ex:
+                logger.exception("handle_message() Couldn't find connections for participant %s channel %s %s", participant_id, channel, str(ex))
+                return 404
+
+        if len(targets)==0:
+            if seq is not None:
+                logger.info("No sockets for %s, message %s buffered.", participant_id, seq)
+                return 202
             logger.exception("There are no sockets available.")
             return 404
+        self.fanout_size=sum(len(sockets) for sockets in targets.values())
+
+        # encoded once, the same bytes are posted to every socket
+        with self.memory.stage("payload"):
+            message = self.build_message(event_body=event_body,content=content,seq=seq)
+        logger.debug("Message: %s", message)
+        # channel subscribers can be in any space
+        space=None if channel is not None else space
+        self.after_commit(lambda: self.deliver(targets=targets,message=message,apig_management_client=apig_management_client
+                                               ,space=space))
+        return status_code
+
+    def deliver(self,targets,message,apig_management_client,space=None):
+        """
+        Delivery stage of handle_message. Large recipient lists are scattered over the
+        fan-out queue and the rest is posted here.
+
+        :param targets: dict (endpoint, compression) -> list of websocket connection IDs.
+        :param message: The encoded message to send, bytes.
+        :param apig_management_client: A Boto3 API Gateway Management API client for
+                                       the sockets without endpoint.
+        :param space: Space of the sockets if they all share one.
+        """
+        with self.memory.stage("delivery"):
+            targets={(endpoint,compression): self.scatter(sockets=sockets,message=message,space=space,endpoint=endpoint
+                                                          ,compression=compression)
+                     for (endpoint,compression),sockets in targets.items()}
+            self.post_to_endpoints(targets=targets,message=message,apig_management_client=apig_management_client
+                                   ,space=space)
+
+    def encode_content(self,msg):
+        """
+        Encodes the payload of a message once. Payloads over payload_offload_bytes (env,
+        default 32768) are stored once in the blob store (see lib/blob_store.py) and
+        replaced by a reference, so a large document is not posted to every socket.
+
+        :param msg: The message payload.
+        :return: The content object, bytes: {"message": msg} or {"message_ref": {"url", "bytes", "sha256"}}.
+                 None when the payload is too large and there is no blob store.
+        """
+        payload=self.get_codec().dumps(msg)
+        if len(payload)<=int(os.environ.get('payload_offload_bytes', 32768)):
+            return b'{"message":'+payload+b'}'
+        store=self.get_blob_store()
+        if store is None:
+            if len(payload)>self.MAX_MESSAGE_BYTES:
+                logger.warning("Payload of %s bytes is too large and there is no blob store.", len(payload))
+                return None
+            return b'{"message":'+payload+b'}'
+        ref=store.put(payload)
+        logger.info("Payload of %s bytes offloaded as %s.", len(payload), ref["sha256"])
+        return b'{"message_ref":'+self.get_codec().dumps(ref)+b'}'
 
-        message = {"participant_id": participant_id, "message": event_body['msg'] }
-        message = json.dumps(message)
-        logger.debug("Message: %s", str(message))
-        # for each socket send a message
+    def build_message(self,event_body,content,seq=None):
+        """
+        Builds the frame posted to the recipients of a message from its encoded content.
+
+        :param event_body: dict with either `channel` or `participant_id`.
+        :param content: The content object returned by encode_content, bytes.
+        :param seq: sequence number of the buffered message, None when not buffered.
+        :return: The encoded frame, bytes.
+        """
+        channel = event_body.get('channel')
+        if channel is not None:
+            head = {"channel": channel}
+        else:
+            head = {"participant_id": event_body.get('participant_id')}
+            if seq is not None:
+                head["seq"]=seq
+        return self.get_codec().dumps(head)[:-1]+b','+content[1:]
+
+    def get_buffer_config(self):
+        """ message buffer settings: env message_buffer_size, messages kept per participant and
+        space (default 100, 0 disables the buffer), and message_buffer_ttl in seconds (default 300) """
+        return int(os.environ.get('message_buffer_size', 100)),int(os.environ.get('message_buffer_ttl', 300))
+
+    def buffer_message(self,participant_id,space,content):
+        """
+        Stores a participant message in the offline buffer, so clients that are not
+        connected get it when they resume. A failure is logged and the message is
+        still delivered to the connected sockets.
+
+        :param participant_id: The recipient.
+        :param space: Space of the recipient.
+        :param content: The content object returned by encode_content, bytes.
+        :return: The sequence number of the message or None when it was not buffered.
+        """
+        max_messages,ttl_seconds=self.get_buffer_config()
+        if max_messages<=0 or participant_id is None:
+            return None
+        try:
+            db=self.get_db_handler()
+            return db.insert_buffered_message(participant_id=str(participant_id),space=space or self.space
+                                              ,message=content.decode('utf-8')
+                                              ,ttl_seconds=ttl_seconds,max_messages=max_messages,shared_conn=self.shared_conn)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            logger.exception("Couldn't buffer message for %s.", participant_id)
+            return None
+
+    def build_replay_frames(self,participant_id,messages):
+        """
+        Batches buffered messages in replay frames of at most replay_max_frame_bytes
+        (env, default 32000, below the API Gateway frame size). The stored content objects
+        are already encoded and are copied into the frames without decoding them.
+
+        :param participant_id: The recipient.
+        :param messages: list of dicts with `seq` and the content object in `message`, in sequence order.
+        :return: list of frames, bytes. Each one is {"participant_id": .., "replay": [{"seq": .., "message": ..}, ..]},
+                 offloaded entries have `message_ref` instead of `message`.
+        """
+        max_bytes=int(os.environ.get('replay_max_frame_bytes', 32000))
+        head=b'{"participant_id":'+self.get_codec().dumps(participant_id)+b',"replay":['
+        frames=[]
+        entries=[]
+        size=len(head)+2
+        for buffered in messages:
+            entry=b'{"seq":%d,' % buffered["seq"]+buffered["message"].encode('utf-8')[1:]
+            if entries and size+len(entry)+1>max_bytes:
+                frames.append(head+b','.join(entries)+b']}')
+                entries=[]
+                size=len(head)+2
+            entries.append(entry)
+            size+=len(entry)+1
+        if entries:
+            frames.append(head+b','.join(entries)+b']}')
+        return frames
+
+    def handle_resume(self,socket_id,participant_id,space,last_seq,apig_management_client,compression=None):
+        """
+        Replays the buffered messages after last_seq to one socket, batched in as few
+        frames as possible. The buffer is read with a range query on its primary key.
+        A GoneException does not remove the socket: a replay enqueued by $connect can
+        run before the handshake is over. The client sends resume itself then.
+
+        :param socket_id: The websocket connection ID.
+        :param participant_id: The participant of the socket.
+        :param space: Space of the socket.
+        :param last_seq: last sequence number seen by the client, 0 for all.
+        :param apig_management_client: A Boto3 API Gateway Management API client.
+        :param compression: compression accepted by the socket.
+        :return: An HTTP status code.
+        """
+        max_messages,ttl_seconds=self.get_buffer_config()
+        try:
+            db=self.get_db_handler()
+            messages=db.select_buffered_messages(participant_id=str(participant_id),space=space,after_seq=int(last_seq)
+                                                 ,limit=max(max_messages,1),shared_conn=self.shared_conn)
+        except Exception:
+            logger.exception("Couldn't read buffered messages of %s.", participant_id)
+            return 503
+        frames=self.build_replay_frames(participant_id=participant_id,messages=messages)
+
+        def replay():
+            for frame in frames:
+                self.post_to_sockets(sockets=[socket_id],message=self.compress_message(frame,compression)
+                                     ,apig_management_client=apig_management_client,space=space,remove_gone=False)
+            logger.info("Replayed %s messages to %s in %s frames.", len(messages), socket_id, len(frames))
+        self.after_commit(replay)
+        return 200
+
+    def scatter(self,sockets,message,space=None,endpoint=None,compression=None):
+        """
+        Splits a large recipient list in chunks of fanout_chunk_size sockets (env,
+        default 500) and enqueues each chunk as a sendmessage work item, so parallel
+        invocations deliver them. Nothing is enqueued when the list is small or the
+        fan-out queue is not configured (env fanout_queue_url).
+
+        :param sockets: list of websocket connection IDs.
+        :param message: The encoded message to send, bytes.
+        :param space: Space of the sockets if they all share one.
+        :param endpoint: management API url of the sockets, None for the default one.
+        :param compression: compression accepted by the sockets. Each chunk compresses the message once.
+        :return: The sockets that must be delivered by this invocation.
+        """
+        chunk_size=int(os.environ.get('fanout_chunk_size', 500))
+        if len(sockets)<=chunk_size:
+            return sockets
+        queue=self.get_fanout_queue()
+        if queue is None:
+            return sockets
+        items=[{"action": "sendmessage", "sockets": sockets[start:start+chunk_size], "message": message.decode('utf-8')
+                , "space": space, "endpoint": endpoint, "compression": compression}
+               for start in range(0,len(sockets),chunk_size)]
+        failed=queue.send_batch(items)
+        logger.info("Scattered %s sockets in %s chunks, %s chunks delivered here.", len(sockets), len(items), len(failed))
+        return [socket_id for item in failed for socket_id in item["sockets"]]
+
+    def handle_fanout_chunk(self,event_body,apig_management_client):
+        """
+        Delivers one chunk enqueued by scatter. The message is already encoded, it is
+        only converted to bytes once for the whole chunk.
+
+        :param event_body: work item with `sockets`, `message`, `space`, `endpoint` and `compression`.
+        :param apig_management_client: A Boto3 API Gateway Management API client, used
+                                       when the chunk has no endpoint.
+        :return: An HTTP status code.
+        """
+        self.fanout_size=len(event_body['sockets'])
+        if event_body.get('endpoint'):
+            apig_management_client=self.get_management_client(event_body['endpoint'])
+        with self.memory.stage("payload"):
+            message=self.compress_message(event_body['message'].encode('utf-8'),event_body.get('compression'))
+
+        def deliver_chunk():
+            with self.memory.stage("delivery"):
+                self.post_to_sockets(sockets=event_body['sockets'],message=message
+                                     ,apig_management_client=apig_management_client,space=event_body.get('space'))
+        self.after_commit(deliver_chunk)
+        return 200
+
+    def compress_message(self,message,compression):
+        """
+        Compresses an encoded frame for the clients that negotiated compression.
+        Frames under compress_min_bytes (env, default 256) and frames that do not
+        shrink are returned as they are, clients accept both.
+
+        :param message: The encoded frame, bytes.
+        :param compression: compression name or None.
+        :return: The frame to post, bytes.
+        """
+        compressor=get_compression(compression)
+        if compressor is None or len(message)<int(os.environ.get('compress_min_bytes', 256)):
+            return message
+        compressed=compressor.compress(message)
+        return compressed if len(compressed)<len(message) else message
+
+    def post_to_endpoints(self,targets,message,apig_management_client,space=None):
+        """
+        Posts the message to sockets of several endpoints. Each endpoint and compression
+        is one delivery batch with its cached management client; the batches run
+        concurrently. The message is compressed once per compression.
+
+        :param targets: dict (endpoint, compression) -> list of websocket connection IDs.
+                        Sockets stored without endpoint are under None.
+        :param message: The encoded message to send, bytes shared by all the posts.
+        :param apig_management_client: A Boto3 API Gateway Management API client for
+                                       the sockets without endpoint.
+        :param space: Space of the sockets if they all share one.
+        """
+        frames={}
+        batches=[]
+        for (endpoint,compression),sockets in targets.items():
+            if not sockets:
+                continue
+            if compression not in frames:
+                frames[compression]=self.compress_message(message,compression)
+            batches.append((self.get_management_client(endpoint) if endpoint else apig_management_client
+                            ,sockets,frames[compression]))
+        if len(batches)==1:
+            client,sockets,frame=batches[0]
+            self.post_to_sockets(sockets=sockets,message=frame,apig_management_client=client,space=space)
+            return
+        futures=[self.get_executor().submit(self.post_to_sockets,sockets=sockets,message=frame
+                                            ,apig_management_client=client,space=space)
+                 for client,sockets,frame in batches]
+        for future in futures:
+            future.result()
+
+    def post_to_sockets(self,sockets,message,apig_management_client,space=None,remove_gone=True):
+        """
+        Posts the message to each socket. Gone sockets are removed from the table
+        once every post is done, see remove_gone_sockets.
+
+        :param sockets: list of websocket connection IDs.
+        :param message: The encoded message to send, bytes shared by all the posts.
+        :param apig_management_client: A Boto3 API Gateway Management API client.
+        :param space: Space of the sockets if they all share one. Limits the delete
+                      of gone sockets to that space.
+        :param remove_gone: remove the gone sockets. False when the socket may still be connecting.
+        """
+        gone=[]
         for participant_socket in sockets:
             try:        
                 send_response = apig_management_client.post_to_connection(
                     Data=message, ConnectionId=participant_socket)
                 logger.debug(
-                    "Posted message to connection %s, got response %s.", participant_id, send_response)
+                    "Posted message to connection %s, got response %s.", participant_socket, send_response)
+            # GoneException is a ClientError, it must be caught first
+            except apig_management_client.exceptions.GoneException:
+                logger.info("Connection %s is gone%s.", participant_socket, ", removing" if remove_gone else "")
+                gone.append(participant_socket)
             except ClientError as ex:
                 logger.exception("Couldn't post to connection %s. Error: %s", participant_socket,str(ex))
-            except apig_management_client.exceptions.GoneException:
-                logger.info("Connection %s is gone, removing.", participant_socket)
-                try:
-                    db=self.get_db_handler()
-                    db.delete_connection_by_socket(socket_id=participant_socket)
-                except ClientError:
-                    logger.exception("Couldn't remove connection %s.", participant_socket)
+        if remove_gone:
+            self.remove_gone_sockets(sockets=gone,space=space)
 
-        return status_code
+    def remove_gone_sockets(self,sockets,space=None):
+        """
+        Deletes sockets that API Gateway reported gone in one short transaction of their
+        own, never in the unit of work of the invocation, so a failed delete cannot roll
+        back a buffered message. A failure is logged; the reaper removes them later.
+
+        :param sockets: list of websocket connection IDs.
+        :param space: Space of the sockets if they all share one.
+        :return: The number of removed connections.
+        """
+        if not sockets:
+            return 0
+        try:
+            db=self.get_db_handler()
+            with db.unit_of_work() as shared_conn:
+                # sorted so concurrent batches lock the rows in the same order
+                return sum(db.delete_connection_by_socket(socket_id=socket_id,space=space,shared_conn=shared_conn)
+                           for socket_id in sorted(sockets))
+        except Exception:
+            logger.exception("Couldn't remove %s gone connections.", len(sockets))
+            return 0
 
     def broadcast(self,table,space,event_body,apig_management_client,broadcastby="ADMIN"):
         socket_ids = []
-        try:
-            scan_response = table.scan(ProjectionExpression='socket_id')
-            socket_ids = [item['socket_id'] for item in scan_response['Items']]
-            logger.info("Found %s active connections.", len(socket_ids))
-        except ClientError:
-            logger.exception("Couldn't get connections.")
-            status_code = 404
+        with self.memory.stage("lookup"):
+            try:
+                scan_response = table.scan(ProjectionExpression='socket_id')
+                socket_ids = [item['socket_id'] for item in scan_response['Items']]
+                logger.info("Found %s active connections.", len(socket_ids))
+            except ClientError:
+                logger.exception("Couldn't get connections.")
+                status_code = 404
+        self.fanout_size=len(socket_ids)
 
-        message = f"{broadcastby}: {event_body['msg']}".encode('utf-8')
+        with self.memory.stage("payload"):
+            message = self.get_codec().dumps({"broadcastby": broadcastby, "message": event_body['msg']})
         logger.info("Message: %s", message)
 
-        for other_conn_id in socket_ids:
-            try:
-                send_response = apig_management_client.post_to_connection(
-                    Data=message, ConnectionId=other_conn_id)
-                logger.info(
-                    "Posted message to connection %s, got response %s.",
-                    other_conn_id, send_response)
-            except ClientError:
-                logger.exception("Couldn't post to connection %s.", other_conn_id)
-            except apig_management_client.exceptions.GoneException:
-                logger.info("Connection %s is gone, removing.", other_conn_id)
+        with self.memory.stage("delivery"):
+            for other_conn_id in socket_ids:
                 try:
-                    table.delete_item(Key={'socket_id': other_conn_id})
+                    send_response = apig_management_client.post_to_connection(
+                        Data=message, ConnectionId=other_conn_id)
+                    logger.info(
+                        "Posted message to connection %s, got response %s.",
+                        other_conn_id, send_response)
                 except ClientError:
-                    logger.exception("Couldn't remove connection %s.", other_conn_id)
+                    logger.exception("Couldn't post to connection %s.", other_conn_id)
+                except apig_management_client.exceptions.GoneException:
+                    logger.info("Connection %s is gone, removing.", other_conn_id)
+                    try:
+                        table.delete_item(Key={'socket_id': other_conn_id})
+                    except ClientError:
+                        logger.exception("Couldn't remove connection %s.", other_conn_id)
 
     def decode_jwt_token(self,token,secret_key=None,algorithm=None):
         """decodes the token passed
@@ -264,18 +932,22 @@ class SocketHandleConnections:
             #WEBSOCKET URI
             socket_id = event.get('requestContext', {}).get('connectionId')
             body=event.get('body')
-            body = json.loads(body if body is not None else '{"msg": ""}')
+            body = self.get_codec().loads(body if body is not None else '{"msg": ""}')
             caller_type="WEBSOCKET"
             return "OK",route_key,socket_id,body,caller_type
 
         elif route_key is None:
-            #check POST in this case we check resourcePath and validate 
-            route_key = event.get('requestContext', {}).get('resourcePath')
-            if route_key=='/{participant_id+}':
-                route_key='sendmessage'
+            #REST, the resource path and method are mapped to a route by the registry
+            resource_path = event.get('requestContext', {}).get('resourcePath')
+            http_method = event.get('httpMethod')
+            route_key = self.get_route_registry().rest_route_key(resource_path,http_method)
+            if resource_path is not None and route_key is not None:
                 socket_id="00000"
-                body=event.get('body')
-                body = json.loads(body if body is not None else '{"msg": ""}')
+                if http_method=='GET':
+                    body=event.get('queryStringParameters') or {}
+                else:
+                    body=event.get('body')
+                    body = self.get_codec().loads(body if body is not None else '{"msg": ""}')
                 caller_type="REST"
                 return "OK",route_key,socket_id,body,caller_type
 
@@ -288,9 +960,10 @@ class SocketHandleConnections:
                     eventSource = message.get('eventSource')
                     if eventSource=="aws:sqs":
                         body=message.get('body') #BODY FOR EACH MESSAGE
-                        body = json.loads(body if body is not None else '{"msg": ""}')
+                        body = self.get_codec().loads(body if body is not None else '{"msg": ""}')
                         route_key=body["action"]
                         socket_id="00000"
+                        self.message_id=message.get('messageId')
                         caller_type="SQS"
                         return "OK",route_key,socket_id,body,caller_type
                     
@@ -302,8 +975,10 @@ class SocketHandleConnections:
 
     def lambda_handler(self,event, context):
         """
-        This function handles three routes: $connect, $disconnect, and sendmessage. Any
-        other route results in a 404 status code.
+        Resolves the route of the event and dispatches it through the route registry,
+        see register_routes. Unknown routes result in a 404 status code. Transactional
+        routes run in one unit of work; the work they defer with after_commit, mostly
+        deliveries, runs once it is committed.
 
         The $connect route accepts a query string `participant_id` parameter that is the id of
         the participant that originated the connection and space
@@ -317,39 +992,163 @@ class SocketHandleConnections:
 
         
         self.event=event    
+        DIDBHelper.get_instance().start_invocation()
         logger.info('Event: %s', event)
         if not debug_mode:
             logger.info('context.invoked_function_arn: %s context.aws_request_id: %s', context.invoked_function_arn, context.aws_request_id)
+        # pings of a quiet container wait for its next invocation, whatever the route
+        self.flush_last_seen()
 
         route_key = event.get('requestContext', {}).get('routeKey')
         socket_id = event.get('requestContext', {}).get('connectionId')
 
-        result,route_key,socket_id,body,caller_type=self.filter_route_key(event)
+        with self.memory.stage("parse"):
+            result,route_key,socket_id,body,caller_type=self.filter_route_key(event)
         logger.info('route_key: %s', route_key)
+        self.route_key=route_key
         
         if result!="OK":
             return {'statusCode': 400}
 
         if route_key is None or socket_id is None:
             return {'statusCode': 400}
-        
-        response = {'statusCode': 200}
 
-        if route_key == '$connect':
-            participant_token = event.get('queryStringParameters', {'participant_id': 'guest'}).get('participant_id')
-            space = event.get('queryStringParameters', {'space': 'public'}).get('space')
-            response['statusCode'] = self.handle_connect_by_token(token= participant_token, socket_id=socket_id,space=space)
+        routes=self.get_route_registry()
+        route=routes.get_route(route_key,caller_type)
+        if route is None:
+            return {'statusCode': 404}
+        request=RouteRequest(event=event,context=context,route_key=route_key,socket_id=socket_id
+                             ,body=body,caller_type=caller_type)
+        if not route.transactional:
+            return routes.dispatch(self,request)
+
+        # one connection and one commit for the writes of the invocation
+        guard=self.get_idempotency_guard() if caller_type=="SQS" else None
+        callbacks=[]
+        try:
+            with self.unit_of_work(route,request) as shared_conn:
+                self.shared_conn=shared_conn
+                self._after_commit=callbacks
+                try:
+                    # redelivered queue messages are skipped before any lookup or delivery. The
+                    # processed mark commits with the changes of the route, or not at all
+                    if guard is not None and not self.claim_message(guard,route):
+                        logger.info("Message %s already processed, skipping.", self.message_id)
+                        return {'statusCode': 200}
+                    response=routes.dispatch(self,request)
+                    if guard is not None and not callbacks:
+                        # nothing runs after the commit, the message is done with it
+                        self.complete_message(guard,route)
+                finally:
+                    self.shared_conn=None
+                    self._after_commit=None
+            # deliveries, with the transaction already committed. If the invocation dies
+            # here the claim stays unfinished and the redelivery is handled again
+            for callback in callbacks:
+                callback()
+            if guard is not None:
+                if callbacks:
+                    self.complete_message(guard,route)
+                guard.remember(self.message_id)
+        except CircuitOpenError:
+            # the database is failing, do not wait for it
+            logger.warning("Database circuit is open, route %s rejected.", route_key)
+            return {'statusCode': 503}
+
+        return response
+
+    def route_connect(self,request:RouteRequest):
+        """ $connect. The query string has the participant token in `participant_id` and the `space` """
+        query=request.event.get('queryStringParameters') or {'participant_id': 'guest', 'space': 'public'}
+        status_code=self.handle_connect_by_token(token=query.get('participant_id'),socket_id=request.socket_id
+                                                 ,space=query.get('space'),endpoint=self.get_event_endpoint(request.event)
+                                                 ,last_seq=query.get('last_seq'),compression=query.get('compression'))
+        return {'statusCode': status_code}
 
-        elif route_key == '$disconnect':
-            participant_token = event.get('queryStringParameters', {'participant_id': 'guest'}).get('participant_id')
-            response['statusCode'] = self.handle_disconnect(socket_id)
+    def route_disconnect(self,request:RouteRequest):
+        """ $disconnect """
+        return {'statusCode': self.handle_disconnect(request.socket_id
+                                                     ,space=self.get_event_space(request.event,request.socket_id))}
 
-        elif route_key == 'sendmessage':      
-            response['statusCode'] = self.handle_send_message(event=event,caller_type=caller_type,body=body)      
+    def route_send_message(self,request:RouteRequest):
+        """ sendmessage from websocket, REST or SQS """
+        return self.handle_send_message(event=request.event,caller_type=request.caller_type,body=request.body)
+
+    def route_resume(self,request:RouteRequest):
+        """ resume, replays the messages after `last_seq`. Websocket clients send it for their
+        own socket, work items enqueued by $connect carry the socket and participant """
+        body=request.body
+        if request.caller_type=="SQS":
+            connection={"participant_id": body.get('participant_id'), "space": body.get('space')
+                        , "endpoint": body.get('endpoint'), "compression": body.get('compression')}
+            socket_id=body.get('socket_id')
         else:
-            response['statusCode'] = 404
+            socket_id=request.socket_id
+            db=self.get_db_handler()
+            connection=db.select_connection_by_socket(socket_id=socket_id,shared_conn=self.shared_conn)
+            if connection is None:
+                return {'statusCode': 404}
+            connection["endpoint"]=connection.get("endpoint") or self.get_event_endpoint(request.event)
+        endpoint=connection.get("endpoint") or os.environ.get('socket_domain')
+        if not endpoint or not socket_id:
+            return {'statusCode': 400}
+        status_code=self.handle_resume(socket_id=socket_id,participant_id=connection["participant_id"]
+                                       ,space=connection["space"],last_seq=body.get('last_seq') or 0
+                                       ,apig_management_client=self.get_management_client(endpoint)
+                                       ,compression=connection.get("compression"))
+        return {'statusCode': status_code}
 
-        return response
+    def route_ping(self,request:RouteRequest):
+        """ ping, websocket keepalive. A space in the body is ignored, the client could name
+        any space and its socket would never be written. Unknown spaces are written by an
+        update over every partition """
+        space=self.get_event_space(request.event,request.socket_id)
+        return {'statusCode': self.handle_ping(request.socket_id,space=space)}
+
+    def handle_ping(self,socket_id,space=None):
+        """
+        Records the keepalive of a socket. No token is decoded and no client is built:
+        the time goes to the container LastSeenBuffer and the buffer is written with one
+        multi-row UPDATE per space when it is due. A failed write is retried by the next ping.
+
+        :param socket_id: The websocket connection ID.
+        :param space: Space of the socket when known, limits the UPDATE to its partition.
+        :return: An HTTP status code.
+        """
+        self.get_last_seen_buffer().touch(socket_id,space=space)
+        self.flush_last_seen()
+        return 200
+
+    def flush_last_seen(self):
+        """
+        Writes the container LastSeenBuffer when it is due. Runs at the start of every
+        invocation and after each ping, with its own connection, so pending times wait
+        at most flush_seconds after the next invocation of the container. A failed
+        write is logged and retried by the next invocation.
+
+        :return: The number of sockets written.
+        """
+        buffer=self.get_last_seen_buffer()
+        if not buffer.should_flush():
+            return 0
+        try:
+            return buffer.flush(self.get_db_handler())
+        except Exception:
+            logger.warning("Couldn't write last_seen of %s sockets, kept for the next invocation.", buffer.pending()
+                           , exc_info=True)
+            return 0
+
+    def route_subscribe(self,request:RouteRequest):
+        """ subscribe, websocket only """
+        return {'statusCode': self.handle_subscribe(socket_id=request.socket_id,event_body=request.body)}
+
+    def route_unsubscribe(self,request:RouteRequest):
+        """ unsubscribe, websocket only """
+        return {'statusCode': self.handle_unsubscribe(socket_id=request.socket_id,event_body=request.body)}
+
+    def route_connection_count(self,request:RouteRequest):
+        """ connectioncount, REST GET only """
+        return self.handle_connection_count(request.body)
     
     def handle_send_message(self,event,caller_type,body):
         response = {'statusCode': 200}
@@ -361,25 +1160,26 @@ class SocketHandleConnections:
             response['body'] = "Socket domain must be set in environment"
             return response
         
-        stage=os.environ.get('stage',"latest")
-        
         mydomain=socket_domain
         
         if caller_type=='WEBSOCKET':
-            domain = event.get('requestContext', {}).get('domainName')
-            stage = event.get('requestContext', {}).get('stage')
-            if domain is None or stage is None:
+            endpoint=self.get_event_endpoint(event)
+            if endpoint is None:
                 logger.warning(
                     "Couldn't send message. Bad endpoint in request: domain '%s', "
-                    "stage '%s'", domain, stage)
+                    "stage '%s'", event.get('requestContext', {}).get('domainName')
+                    , event.get('requestContext', {}).get('stage'))
                 response['statusCode'] = 400
             else:
-                #by sqs or similar
-                logger.debug("endpoint_url %s.", f'https://{domain}/{stage}')
-                mydomain=f'https://{domain}/{stage}'                
-            
-        apig_management_client = boto3.client(
-                    'apigatewaymanagementapi', endpoint_url=mydomain)
+                logger.debug("endpoint_url %s.", endpoint)
+                mydomain=endpoint
+
+        # sockets stored without endpoint are posted with this client
+        apig_management_client = self.get_management_client(mydomain)
+        # fan-out chunks are only accepted from the queue, never from clients
+        if caller_type=='SQS' and body.get('sockets') is not None:
+            response['statusCode'] = self.handle_fanout_chunk(body, apig_management_client)
+            return response
         response['statusCode'] = self.handle_message(body, apig_management_client)
         logger.debug('lambda_handler sent body: %s', body)   
         return response
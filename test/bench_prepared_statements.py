@@ -0,0 +1,90 @@
+"""
+Benchmark of the hot DBHelperPostgress statements with and without server side
+prepared statements. Needs the database configured in the environment
+(.envs/.env.apigateway.DEV) with the schema of lib/db_schema_postgress.py.
+
+    python -m test.bench_prepared_statements --rounds 2000
+
+Each round inserts a connection, selects it by participant and deletes it by
+socket. Rows are written in space BENCH and removed at the end. Two connection
+patterns are measured:
+
+    unit_of_work  one connection per round, like a handler invocation
+    long_lived    one connection for every round, like a pooled connection
+
+Statements are prepared the second time they run in a connection, so with
+unit_of_work the prepared column should match plain (nothing is prepared) and
+the saving only shows on long lived connections.
+"""
+import argparse
+import time
+import uuid
+from lib.db_helper_postgress import DBHelperPostgress
+from lib.load_env import load_env
+
+
+def run(db:DBHelperPostgress, conn, rounds):
+    """ runs the hot statements and returns the mean seconds per statement for each one.
+    With conn None every round opens and closes its own connection. """
+    timings={"insert_connection": 0.0, "select_connections_by_participant": 0.0, "delete_connection_by_socket": 0.0}
+    participant_id=str(uuid.uuid4())
+    for index in range(rounds):
+        socket_id=f"bench-{participant_id}-{index}"
+        if conn is None:
+            round_conn=db.connect()
+            try:
+                run_round(db,round_conn,participant_id,socket_id,timings)
+            finally:
+                round_conn.close()
+        else:
+            run_round(db,conn,participant_id,socket_id,timings)
+    return {name: total/rounds for name,total in timings.items()}
+
+
+def run_round(db:DBHelperPostgress, conn, participant_id, socket_id, timings):
+    """ one insert, select and delete on conn, adding the seconds of each one to timings """
+    start=time.perf_counter()
+    db.insert_connection(participant_id=participant_id,socket_id=socket_id,space="BENCH",shared_conn=conn)
+    timings["insert_connection"]+=time.perf_counter()-start
+
+    start=time.perf_counter()
+    db.select_connections_by_participant(participant_id=participant_id,space="BENCH",shared_conn=conn)
+    timings["select_connections_by_participant"]+=time.perf_counter()-start
+
+    start=time.perf_counter()
+    db.delete_connection_by_socket(socket_id=socket_id,shared_conn=conn)
+    timings["delete_connection_by_socket"]+=time.perf_counter()-start
+    # a shared connection is not committed by the helper
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare plain and prepared hot statements.")
+    parser.add_argument('--rounds', type=int, default=1000)
+    args = parser.parse_args()
+
+    load_env(env_file_name="apigateway")
+    for pattern in ('unit_of_work', 'long_lived'):
+        results={}
+        for prepare in (False, True):
+            db=DBHelperPostgress()
+            db.prepare_statements=prepare
+            conn=db.connect() if pattern=='long_lived' else None
+            try:
+                # warm up the connection and the prepared statements
+                run(db,conn,rounds=10)
+                results[prepare]=run(db,conn,rounds=args.rounds)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+        print(f"\n{pattern}")
+        print(f"{'statement':40} {'plain us':>10} {'prepared us':>12} {'saving':>8}")
+        for name in results[False]:
+            plain=results[False][name]*1e6
+            prepared=results[True][name]*1e6
+            print(f"{name:40} {plain:10.1f} {prepared:12.1f} {100*(plain-prepared)/plain:7.1f}%")
+
+
+if __name__ == '__main__':
+    main()
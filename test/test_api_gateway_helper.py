@@ -0,0 +1,235 @@
+"""
+Unit tests for ApiGatewayHelper.py. The AWS clients are stubbed with botocore's Stubber.
+"""
+
+import json
+import threading
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import ANY, Stubber
+
+from ApiGatewayHelper import ApiGatewayHelper
+
+ROUTES = ['$connect', '$disconnect', 'sendmessage', 'subscribe', 'unsubscribe']
+LAMBDA_FUNC = {'FunctionName': 'chat-handler',
+               'FunctionArn': 'arn:aws:lambda:us-east-1:123456789012:function:chat-handler'}
+
+
+@pytest.fixture
+def clients():
+    apig2_client = boto3.client('apigatewayv2', region_name='us-east-1',
+                                aws_access_key_id='test', aws_secret_access_key='test')
+    lambda_client = boto3.client('lambda', region_name='us-east-1',
+                                 aws_access_key_id='test', aws_secret_access_key='test')
+    with Stubber(apig2_client) as apig2_stub, Stubber(lambda_client) as lambda_stub:
+        yield apig2_client, apig2_stub, lambda_client, lambda_stub
+        apig2_stub.assert_no_pending_responses()
+        lambda_stub.assert_no_pending_responses()
+
+
+def make_helper(apig2_client, **kwargs):
+    helper = ApiGatewayHelper('chat', apig2_client, **kwargs)
+    helper.api_id = 'api-1'
+    helper.api_arn = 'arn:aws:execute-api:us-east-1:123456789012:api-1/*'
+    helper.sleeps = []
+    helper._sleep = helper.sleeps.append
+    return helper
+
+
+def stub_routes(apig2_stub, lambda_stub, routes, throttled=0):
+    integration_params = {'ApiId': 'api-1', 'IntegrationType': 'AWS_PROXY', 'IntegrationMethod': 'POST',
+                          'IntegrationUri': ANY}
+    for _ in range(throttled):
+        apig2_stub.add_client_error('create_integration', service_error_code='TooManyRequestsException',
+                                    http_status_code=429, expected_params=integration_params)
+    for index, _ in enumerate(routes):
+        apig2_stub.add_response('create_integration', {'IntegrationId': f'int-{index}'}, integration_params)
+    for index, _ in enumerate(routes):
+        apig2_stub.add_response('create_route', {'RouteId': f'route-{index}'},
+                                {'ApiId': 'api-1', 'RouteKey': ANY, 'Target': ANY})
+    for _ in routes:
+        lambda_stub.add_response('add_permission', {'Statement': '{}'},
+                                 {'FunctionName': 'chat-handler', 'StatementId': ANY, 'Action': 'lambda:InvokeFunction',
+                                  'Principal': 'apigateway.amazonaws.com', 'SourceArn': ANY})
+
+
+def test_routes_are_provisioned_concurrently(clients, monkeypatch):
+    apig2_client, apig2_stub, lambda_client, lambda_stub = clients
+    stub_routes(apig2_stub, lambda_stub, ROUTES)
+    helper = make_helper(apig2_client, max_workers=3)
+    # the first two integrations only finish if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    threads = []
+    create_integration = helper.create_integration
+
+    def concurrent_create_integration(lambda_func):
+        threads.append(threading.get_ident())
+        if len(threads) <= 2:
+            barrier.wait()
+        return create_integration(lambda_func)
+    monkeypatch.setattr(helper, 'create_integration', concurrent_create_integration)
+
+    route_ids = helper.add_routes_and_integrations(ROUTES, LAMBDA_FUNC, lambda_client)
+
+    assert sorted(route_ids) == sorted(ROUTES)
+    assert sorted(route_ids.values()) == [f'route-{index}' for index in range(len(ROUTES))]
+    assert 1 < len(set(threads)) <= 3
+    assert helper.sleeps == []
+
+
+def test_throttled_calls_are_retried_with_backoff(clients):
+    apig2_client, apig2_stub, lambda_client, lambda_stub = clients
+    stub_routes(apig2_stub, lambda_stub, ['sendmessage'], throttled=3)
+    helper = make_helper(apig2_client, retry_base=0.5, retry_cap=1)
+
+    assert helper.add_routes_and_integrations(['sendmessage'], LAMBDA_FUNC, lambda_client) == {'sendmessage': 'route-0'}
+    assert len(helper.sleeps) == 3
+    assert helper.sleeps[0] <= 0.5 and all(delay <= 1 for delay in helper.sleeps)
+
+
+def test_retries_give_up_and_other_errors_are_raised(clients):
+    apig2_client, apig2_stub, lambda_client, lambda_stub = clients
+    helper = make_helper(apig2_client, max_attempts=2)
+    for _ in range(2):
+        apig2_stub.add_client_error('create_route', service_error_code='TooManyRequestsException', http_status_code=429)
+    apig2_stub.add_client_error('create_route', service_error_code='ConflictException', http_status_code=409)
+
+    with pytest.raises(ClientError, match='TooManyRequestsException'):
+        helper.create_route('sendmessage', 'int-0')
+    with pytest.raises(ClientError, match='ConflictException'):
+        helper.create_route('sendmessage', 'int-0')
+    assert len(helper.sleeps) == 1
+
+
+def test_only_policy_conflicts_are_retried(clients):
+    apig2_client, apig2_stub, lambda_client, lambda_stub = clients
+    helper = make_helper(apig2_client)
+    lambda_stub.add_client_error('add_permission', service_error_code='ResourceConflictException',
+                                 service_message='The operation cannot be performed at this time. '
+                                                 'An update is in progress for resource: chat-handler',
+                                 http_status_code=409)
+    lambda_stub.add_response('add_permission', {'Statement': '{}'})
+    apig2_stub.add_client_error('update_stage', service_error_code='ConflictException', http_status_code=409)
+
+    helper.add_route_permission('sendmessage', LAMBDA_FUNC, lambda_client)
+    with pytest.raises(ClientError, match='ConflictException'):
+        helper._call_with_retry(apig2_client.update_stage, ApiId='api-1', StageName='latest', AutoDeploy=True)
+    assert len(helper.sleeps) == 1
+
+
+def test_existing_permission_statement_is_kept(clients):
+    apig2_client, _, lambda_client, lambda_stub = clients
+    helper = make_helper(apig2_client)
+    lambda_stub.add_client_error('add_permission', service_error_code='ResourceConflictException',
+                                 service_message='The statement id (chat-sendmessage-invoke) provided already exists. '
+                                                 'Please provide a new statement id, or remove the existing statement.',
+                                 http_status_code=409)
+
+    helper.add_route_permission('sendmessage', LAMBDA_FUNC, lambda_client)
+    assert helper.sleeps == []
+
+
+def test_rest_api_permission_runs_with_the_resources(clients):
+    apig2_client, _, lambda_client, lambda_stub = clients
+    apig_client = boto3.client('apigateway', region_name='us-east-1',
+                               aws_access_key_id='test', aws_secret_access_key='test')
+    helper = make_helper(apig2_client)
+    with Stubber(apig_client) as apig_stub:
+        apig_stub.add_response('create_rest_api', {'id': 'rest-1'})
+        apig_stub.add_response('get_resources', {'items': [{'id': 'root', 'path': '/'}]}, {'restApiId': 'rest-1'})
+        apig_stub.add_response('create_resource', {'id': 'base'},
+                               {'restApiId': 'rest-1', 'parentId': 'root', 'pathPart': '{participant_id+}'})
+        apig_stub.add_response('put_method', {}, {'restApiId': 'rest-1', 'resourceId': 'base', 'httpMethod': 'ANY',
+                                                  'authorizationType': 'NONE'})
+        apig_stub.add_client_error('put_integration', service_error_code='TooManyRequestsException', http_status_code=429)
+        apig_stub.add_response('put_integration', {})
+        apig_stub.add_response('create_deployment', {}, {'restApiId': 'rest-1', 'stageName': 'latest'})
+        lambda_stub.add_response('add_permission', {'Statement': '{}'})
+
+        api_id = helper.create_rest_api(apig_client, 'chat', '{participant_id+}', 'latest', '123456789012',
+                                        lambda_client, LAMBDA_FUNC['FunctionArn'])
+
+        apig_stub.assert_no_pending_responses()
+    assert api_id == 'rest-1'
+    assert len(helper.sleeps) == 1
+
+
+INTEGRATION_URI = ('arn:aws:apigateway:us-east-1:lambda:path/2015-03-31/functions/'
+                   f'{LAMBDA_FUNC["FunctionArn"]}/invocations')
+
+
+def stub_state(apig2_stub, lambda_stub, routes, permissions, auto_deploy=True):
+    apig2_stub.add_response('get_apis', {'Items': [
+        {'Name': 'other', 'ApiId': 'api-0', 'ProtocolType': 'WEBSOCKET', 'RouteSelectionExpression': 'x'},
+        {'Name': 'chat', 'ApiId': 'api-1', 'ApiEndpoint': 'wss://api-1', 'ProtocolType': 'WEBSOCKET',
+         'RouteSelectionExpression': '$request.body.action'}]})
+    # a second page checks the paginator is used
+    apig2_stub.add_response('get_routes', {'Items': [
+        {'RouteKey': route_key, 'RouteId': f'route-{route_key}', 'Target': target}
+        for route_key, target in list(routes.items())[:2]], 'NextToken': 'page-2'}, {'ApiId': 'api-1'})
+    apig2_stub.add_response('get_routes', {'Items': [
+        {'RouteKey': route_key, 'RouteId': f'route-{route_key}', 'Target': target}
+        for route_key, target in list(routes.items())[2:]]}, {'ApiId': 'api-1', 'NextToken': 'page-2'})
+    apig2_stub.add_response('get_integrations', {'Items': [
+        {'IntegrationId': 'int-0', 'IntegrationUri': INTEGRATION_URI},
+        {'IntegrationId': 'int-old', 'IntegrationUri': 'arn:old'}]}, {'ApiId': 'api-1'})
+    apig2_stub.add_response('get_stages', {'Items': [
+        {'StageName': 'latest', 'AutoDeploy': auto_deploy}]}, {'ApiId': 'api-1'})
+    lambda_stub.add_response('get_policy', {'Policy': json.dumps({'Statement': [
+        {'Sid': f'chat-{route.lstrip("$")}-invoke',
+         'Condition': {'ArnLike': {'AWS:SourceArn': f'arn:aws:execute-api:us-east-1:123456789012:{api}/*/{route}'}}}
+        for route, api in permissions.items()]})}, {'FunctionName': 'chat-handler'})
+
+
+def test_reconcile_of_a_deployed_api_changes_nothing(clients):
+    apig2_client, apig2_stub, lambda_client, lambda_stub = clients
+    stub_state(apig2_stub, lambda_stub, {route: 'integrations/int-0' for route in ROUTES},
+               {route: 'api-1' for route in ROUTES})
+    helper = ApiGatewayHelper('chat', apig2_client)
+
+    plan = helper.reconcile_websocket_api('$request.body.action', ROUTES, LAMBDA_FUNC, lambda_client,
+                                          '123456789012', 'latest')
+
+    assert plan == []
+    assert helper.api_id == 'api-1' and helper.api_endpoint == 'wss://api-1'
+
+
+def test_reconcile_applies_only_the_differences(clients):
+    apig2_client, apig2_stub, lambda_client, lambda_stub = clients
+    routes = {'$connect': 'integrations/int-0', '$disconnect': 'integrations/int-old',
+              'sendmessage': 'integrations/int-0', 'obsolete': 'integrations/int-0'}
+    permissions = {'$connect': 'api-1', '$disconnect': 'api-1', 'sendmessage': 'api-old'}
+    stub_state(apig2_stub, lambda_stub, routes, permissions, auto_deploy=False)
+    helper = ApiGatewayHelper('chat', apig2_client, max_workers=1)
+    desired = ['$connect', '$disconnect', 'sendmessage', 'subscribe']
+
+    plan = helper.reconcile_websocket_api('$request.body.action', desired, LAMBDA_FUNC, lambda_client,
+                                          '123456789012', 'latest', dry_run=True)
+    assert sorted((change['action'], change.get('route', change.get('stage'))) for change in plan) == [
+        ('add_permission', 'subscribe'), ('create_route', 'subscribe'), ('replace_permission', 'sendmessage'),
+        ('update_route', '$disconnect'), ('update_stage', 'latest')]
+
+    stub_state(apig2_stub, lambda_stub, routes, permissions, auto_deploy=False)
+    apig2_stub.add_response('create_route', {'RouteId': 'route-subscribe'},
+                            {'ApiId': 'api-1', 'RouteKey': 'subscribe', 'Target': 'integrations/int-0'})
+    apig2_stub.add_response('update_route', {}, {'ApiId': 'api-1', 'RouteId': 'route-$disconnect',
+                                                 'Target': 'integrations/int-0'})
+    apig2_stub.add_response('delete_route', {}, {'ApiId': 'api-1', 'RouteId': 'route-obsolete'})
+    lambda_stub.add_response('add_permission', {'Statement': '{}'},
+                             {'FunctionName': 'chat-handler', 'StatementId': 'chat-subscribe-invoke',
+                              'Action': 'lambda:InvokeFunction', 'Principal': 'apigateway.amazonaws.com',
+                              'SourceArn': 'arn:aws:execute-api:us-east-1:123456789012:api-1/*/subscribe'})
+    lambda_stub.add_response('remove_permission', {},
+                             {'FunctionName': 'chat-handler', 'StatementId': 'chat-sendmessage-invoke'})
+    lambda_stub.add_response('add_permission', {'Statement': '{}'},
+                             {'FunctionName': 'chat-handler', 'StatementId': 'chat-sendmessage-invoke',
+                              'Action': 'lambda:InvokeFunction', 'Principal': 'apigateway.amazonaws.com',
+                              'SourceArn': 'arn:aws:execute-api:us-east-1:123456789012:api-1/*/sendmessage'})
+    apig2_stub.add_response('update_stage', {}, {'ApiId': 'api-1', 'StageName': 'latest', 'AutoDeploy': True})
+
+    plan = helper.reconcile_websocket_api('$request.body.action', desired, LAMBDA_FUNC, lambda_client,
+                                          '123456789012', 'latest', prune=True)
+
+    assert len(plan) == 6
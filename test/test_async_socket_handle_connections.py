@@ -0,0 +1,105 @@
+"""
+Unit tests for lib/async_socket_handle_connections.py using the in-memory DB backend.
+"""
+
+import contextlib
+import json
+import pytest
+
+from lib.async_db_helper_memory import AsyncDBHelperMemory
+from lib.async_socket_handle_connections import AsyncSocketHandleConnections
+from lib.circuit_breaker import CircuitOpenError
+from lib.db_helper_memory import DBHelperMemory
+from lib.idempotency import IdempotencyGuard, MemoryIdempotencyStore
+from lib.socket_handle_connections import SocketHandleConnections
+from test_socket_handle_connections import FakeManagementClient
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    DBHelperMemory.reset()
+    monkeypatch.setattr(AsyncSocketHandleConnections, 'get_async_db_handler', lambda self: AsyncDBHelperMemory())
+    return AsyncSocketHandleConnections()
+
+
+@pytest.mark.parametrize('body,expected_sockets', [
+    ({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'}, ['s0', 's2']),
+    ({'channel': 'team:1', 'msg': 'hello'}, ['s0', 's3'])])
+def test_handle_message_async(handler, body, expected_sockets):
+    db = DBHelperMemory()
+    for socket_id, participant_id in (('s0', 'p1'), ('s1', 'p1'), ('s2', 'p1'), ('s3', 'p2')):
+        db.insert_connection(participant_id=participant_id, socket_id=socket_id, space='TEST')
+    for socket_id in ('s0', 's1', 's3'):
+        db.insert_subscription(channel='team:1', socket_id=socket_id)
+    client = FakeManagementClient(gone=['s1'])
+
+    status_code = handler.handle_message(body, client)
+
+    assert status_code == 200
+    assert sorted(socket_id for socket_id, _ in client.posted) == expected_sockets
+    assert all(json.loads(data)['message'] == 'hello' for _, data in client.posted)
+    assert db.select_connection_by_socket('s1') is None
+
+
+def test_handle_message_async_without_sockets(handler, monkeypatch):
+    client = FakeManagementClient()
+    assert handler.handle_message({'participant_id': 'nobody', 'space': 'TEST', 'msg': 'hello'}, client) == 202
+    assert DBHelperMemory().select_buffered_messages('nobody', 'TEST') == [{'seq': 1, 'message': '{"message":"hello"}'}]
+    monkeypatch.setenv('message_buffer_size', '0')
+    assert handler.handle_message({'participant_id': 'nobody', 'space': 'TEST', 'msg': 'hello'}, client) == 404
+    assert client.posted == []
+
+
+def test_open_breaker_of_async_helper_answers_503(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setenv('socket_domain', 'https://example.com/latest')
+    monkeypatch.setattr(AsyncSocketHandleConnections, 'get_db_handler', lambda self: DBHelperMemory())
+    monkeypatch.setattr(SocketHandleConnections, '_management_clients', {'https://example.com/latest': FakeManagementClient()})
+
+    async def circuit_open(self, **kwargs):
+        raise CircuitOpenError('Circuit db is open')
+    monkeypatch.setattr(AsyncDBHelperMemory, 'select_connections_by_participant', circuit_open)
+    event = {'requestContext': {'routeKey': 'sendmessage', 'connectionId': 's0',
+                                'domainName': 'example.com', 'stage': 'latest'},
+             'body': json.dumps({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'})}
+
+    assert handler.lambda_handler(event, None) == {'statusCode': 503}
+
+
+def test_sendmessage_runs_in_an_async_unit_of_work(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setenv('socket_domain', 'https://example.com/latest')
+    client = FakeManagementClient()
+    monkeypatch.setattr(SocketHandleConnections, '_management_clients', {'https://example.com/latest': client})
+    monkeypatch.setattr(AsyncSocketHandleConnections, 'get_db_handler',
+                        lambda self: pytest.fail('psycopg2 helper used by sendmessage'))
+    events = []
+
+    class TransactionalAsyncMemory(AsyncDBHelperMemory):
+        @contextlib.asynccontextmanager
+        async def unit_of_work(self, read_only=False):
+            events.append('begin')
+            yield 'async-conn'
+            events.append('commit')
+
+        async def insert_processed_message(self, message_id, done=True, shared_conn=None):
+            events.append(('processed', shared_conn, done))
+            return await super().insert_processed_message(message_id, done=done)
+
+        async def insert_buffered_message(self, *args, shared_conn=None, **kwargs):
+            events.append(('buffer', shared_conn))
+            return await super().insert_buffered_message(*args, **kwargs)
+    monkeypatch.setattr(AsyncSocketHandleConnections, 'get_async_db_handler', lambda self: TransactionalAsyncMemory())
+    guard = IdempotencyGuard(store=MemoryIdempotencyStore())
+    monkeypatch.setattr(AsyncSocketHandleConnections, 'get_idempotency_guard', lambda self: guard)
+    DBHelperMemory().insert_connection(participant_id='p1', socket_id='s0', space='TEST')
+    body = json.dumps({'action': 'sendmessage', 'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'})
+    event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': body}]}
+
+    for _ in range(2):
+        assert handler.lambda_handler(event, None)['statusCode'] == 200
+
+    # claimed in the unit of work, done once delivered
+    assert events == ['begin', ('processed', 'async-conn', False), ('buffer', 'async-conn'), 'commit',
+                      ('processed', None, True), 'begin', 'commit']
+    assert [socket_id for socket_id, _ in client.posted] == ['s0']
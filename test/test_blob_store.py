@@ -0,0 +1,61 @@
+"""
+Unit tests for lib/blob_store.py.
+"""
+
+import hashlib
+import io
+
+import lib.blob_store
+from lib.blob_store import LocalBlobStore, S3BlobStore, get_blob_store
+
+
+def test_local_store_keeps_each_payload_once(tmp_path):
+    store = LocalBlobStore(tmp_path / 'blobs')
+    data = b'{"doc":"' + b'x' * 1000 + b'"}'
+
+    ref = store.put(data)
+
+    assert ref['sha256'] == hashlib.sha256(data).hexdigest()
+    assert ref['bytes'] == len(data)
+    assert ref['url'].startswith('file://')
+    assert store.get(ref['sha256']) == data
+    assert store.put(data) == ref
+    assert [path.name for path in (tmp_path / 'blobs').iterdir()] == [ref['sha256']]
+    assert LocalBlobStore(tmp_path, base_url='https://cdn.example.com/p/').url('k') == 'https://cdn.example.com/p/k'
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def generate_presigned_url(self, method, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?expires={ExpiresIn}"
+
+
+def test_s3_store_uploads_and_presigns():
+    client = FakeS3Client()
+    store = S3BlobStore('bucket', url_expires=60, client=client)
+
+    ref = store.put(b'payload')
+
+    assert list(client.objects) == [('bucket', 'payloads/' + ref['sha256'])]
+    assert ref['url'] == f"https://bucket.s3.amazonaws.com/payloads/{ref['sha256']}?expires=60"
+    assert store.get(ref['sha256']) == b'payload'
+
+
+def test_get_blob_store_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setattr(lib.blob_store, '_stores', {})
+    monkeypatch.delenv('blob_store_bucket', raising=False)
+    monkeypatch.delenv('blob_store_dir', raising=False)
+    assert get_blob_store() is None
+
+    monkeypatch.setenv('blob_store_dir', str(tmp_path))
+    store = get_blob_store()
+    assert isinstance(store, LocalBlobStore)
+    assert get_blob_store() is store
@@ -0,0 +1,79 @@
+"""
+Unit tests for lib/circuit_breaker.py.
+"""
+
+import json
+import pytest
+
+import lib.circuit_breaker
+from lib.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(lib.circuit_breaker.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def fail(breaker, times):
+    for _ in range(times):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('db', failure_threshold=3, reset_timeout=30)
+    fail(breaker, 2)
+    breaker.before_call()
+    breaker.record_success()
+    fail(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    fail(breaker, 1)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.metrics()['rejected'] == 1
+
+
+@pytest.mark.parametrize('probe_succeeds,expected', [
+    (True, CircuitBreaker.CLOSED),
+    (False, CircuitBreaker.OPEN)])
+def test_half_open_lets_one_probe_through(clock, probe_succeeds, expected):
+    breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=30)
+    fail(breaker, 1)
+    clock.now += 30
+
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    if probe_succeeds:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+    assert breaker.state == expected
+    assert breaker.opened == (1 if probe_succeeds else 2)
+
+
+def test_state_changes_emit_metrics(clock, capsys):
+    breaker = CircuitBreaker('db', failure_threshold=1, reset_timeout=30)
+    fail(breaker, 1)
+
+    record = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+
+    assert record['circuit'] == 'db'
+    assert record['CircuitState'] == CircuitBreaker.STATE_VALUES[CircuitBreaker.OPEN]
+    assert record['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['circuit']]
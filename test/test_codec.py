@@ -0,0 +1,63 @@
+"""
+Unit tests for lib/codec.py.
+"""
+
+import pytest
+
+import lib.codec
+from lib.codec import DeflateCompression, GzipCompression, JsonCodec, OrjsonCodec, get_codec, get_compression
+
+needs_orjson = pytest.mark.skipif(lib.codec.orjson is None, reason='orjson is not installed')
+
+
+@pytest.mark.parametrize('codec', [JsonCodec(), pytest.param(OrjsonCodec(), marks=needs_orjson)])
+@pytest.mark.parametrize('obj', [
+    {'participant_id': 'p1', 'message': 'hello'},
+    {'channel': 'team:1', 'message': {'text': 'ñandú €', 'n': [1, 2.5, None, True]}}])
+def test_round_trip(codec, obj):
+    encoded = codec.dumps(obj)
+
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == obj
+    assert codec.loads(encoded.decode('utf-8')) == obj
+
+
+@needs_orjson
+def test_codecs_are_interchangeable():
+    obj = {'participant_id': 'p1', 'message': 'ñ'}
+    assert JsonCodec().loads(OrjsonCodec().dumps(obj)) == OrjsonCodec().loads(JsonCodec().dumps(obj))
+
+
+@pytest.mark.parametrize('installed,env,expected', [
+    pytest.param(True, None, 'orjson', marks=needs_orjson),
+    (True, 'json', 'json'),
+    (False, None, 'json'),
+    (False, 'orjson', 'json')])
+def test_get_codec_falls_back_to_json(monkeypatch, installed, env, expected):
+    monkeypatch.setattr(lib.codec, '_codec', None)
+    if not installed:
+        monkeypatch.setattr(lib.codec, 'orjson', None)
+    if env is None:
+        monkeypatch.delenv('json_codec', raising=False)
+    else:
+        monkeypatch.setenv('json_codec', env)
+
+    assert get_codec().name == expected
+
+
+@pytest.mark.parametrize('compression', [GzipCompression(), DeflateCompression()])
+def test_compression_round_trip(compression):
+    data = JsonCodec().dumps({'participant_id': 'p1', 'message': ['ñ'] * 200})
+
+    compressed = compression.compress(data)
+
+    assert len(compressed) < len(data)
+    assert compression.decompress(compressed) == data
+    assert compression.compress(data) == compressed
+
+
+def test_get_compression():
+    assert isinstance(get_compression('gzip'), GzipCompression)
+    assert get_compression('gzip') is get_compression('gzip')
+    assert get_compression(None) is None
+    assert get_compression('brotli') is None
@@ -0,0 +1,370 @@
+"""
+Unit tests for lib/db_helper_postgress.py. psycopg2.connect is replaced by a fake,
+no database is used.
+"""
+
+import asyncio
+import datetime as dt
+import io
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.async_db_helper_postgress import AsyncDBHelperPostgress
+from lib.circuit_breaker import CircuitBreaker, CircuitOpenError
+from lib.db_helper_postgress import DBHelperPostgress, ReplicaRouter
+from lib.idempotency import DBIdempotencyStore, IdempotencyGuard
+from lib.socket_handle_connections import SocketHandleConnections
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.connection = conn
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.connection.execute(sql)
+
+    def copy_expert(self, sql, file):
+        self.connection.execute(sql)
+        if 'TO STDOUT' in sql:
+            file.write(b'participant_id,socket_id,space,connected\n')
+        else:
+            self.connection.copied = file.read()
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, name, session=None):
+        self.name = name
+        self.statements = []
+        self.closed = False
+        self.in_transaction = False
+        self.commits = 0
+        # prepared statement names of the server session, shared to fake a pooler
+        self.session = session if session is not None else set()
+
+    def execute(self, sql):
+        self.statements.append(sql)
+        self.in_transaction = True
+        words = sql.split()
+        if words[0] == 'PREPARE':
+            if words[1] in self.session:
+                raise psycopg2.errors.DuplicatePreparedStatement()
+            self.session.add(words[1])
+        elif words[0] == 'EXECUTE' and words[1].split('(')[0] not in self.session:
+            raise psycopg2.errors.InvalidSqlStatementName()
+
+    def get_transaction_status(self):
+        if self.in_transaction:
+            return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.in_transaction = False
+        self.commits += 1
+
+    def rollback(self):
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = True
+
+
+PRIMARY = {'host': 'primary', 'port': 5432, 'database': 'db', 'user': 'u', 'password': 'p'}
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Connections opened, in order. Hosts starting with 'down' fail."""
+    opened = []
+
+    def fake_connect(dsn=None, **kwargs):
+        name = dsn if dsn is not None else kwargs['host']
+        if name.startswith('down'):
+            raise psycopg2.OperationalError(f'{name} is down')
+        opened.append(FakeConnection(name))
+        return opened[-1]
+
+    monkeypatch.setattr(psycopg2, 'connect', fake_connect)
+    monkeypatch.setattr(psycopg2.extras, 'execute_values', lambda cur, sql, rows: cur.execute(sql, rows))
+    ReplicaRouter._routers.clear()
+    CircuitBreaker._breakers.clear()
+    monkeypatch.setattr(DBHelperPostgress, '_prepared_disabled', False)
+    DBHelperPostgress.start_invocation()
+    return opened
+
+
+def names(connections):
+    return [conn.name for conn in connections]
+
+
+def make_db(replicas, read_your_writes=False):
+    return DBHelperPostgress(dict(PRIMARY, replicas=replicas, read_your_writes=read_your_writes))
+
+
+def test_reads_round_robin_over_replicas(connections):
+    db = make_db([{'host': 'replica1'}, 'replica2'])
+    for _ in range(4):
+        db.select_connections_by_space('TEST')
+
+    assert names(connections) == ['replica1', 'replica2', 'replica1', 'replica2']
+
+
+def test_writes_go_to_primary(connections):
+    db = make_db(['replica1'])
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    db.delete_connection_by_socket('s1')
+
+    assert names(connections) == ['primary', 'primary']
+
+
+def test_failed_replica_is_skipped(connections):
+    db = make_db(['down1', 'replica2'])
+    for _ in range(3):
+        db.select_connections_by_space('TEST')
+
+    assert names(connections) == ['replica2', 'replica2', 'replica2']
+
+
+def test_all_replicas_down_reads_primary(connections):
+    db = make_db(['down1'])
+    db.select_connections_by_space('TEST')
+
+    assert names(connections) == ['primary']
+
+
+@pytest.mark.parametrize('read_your_writes,expected', [
+    (False, ['primary', 'replica1']),
+    (True, ['primary', 'primary'])])
+def test_read_your_writes(connections, read_your_writes, expected):
+    db = make_db(['replica1'], read_your_writes=read_your_writes)
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    make_db(['replica1'], read_your_writes=read_your_writes).select_connections_by_space('TEST')
+
+    assert names(connections) == expected
+
+
+def test_read_your_writes_is_seen_by_worker_threads(connections):
+    db = make_db(['replica1'], read_your_writes=True)
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(db.select_connections_by_space, 'TEST').result()
+
+    DBHelperPostgress.start_invocation()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(db.delete_connection_by_socket, 's1').result()
+    db.select_connections_by_space('TEST')
+
+    assert names(connections) == ['primary', 'primary', 'primary', 'primary']
+
+
+def test_unit_of_work_uses_one_connection_and_commits_once(connections):
+    db = make_db(['replica1'])
+    with db.unit_of_work() as conn:
+        db.select_connections_by_participant(participant_id='p1', space='TEST', shared_conn=conn)
+        db.delete_connection_by_socket('s1', shared_conn=conn)
+        db.insert_connection(participant_id='p1', socket_id='s2', space='TEST', shared_conn=conn)
+
+    assert names(connections) == ['primary']
+    assert connections[0].commits == 1
+    assert connections[0].closed
+
+
+def test_unit_of_work_rolls_back_on_error(connections):
+    db = DBHelperPostgress(PRIMARY)
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work() as conn:
+            db.insert_connection(participant_id='p1', socket_id='s1', space='TEST', shared_conn=conn)
+            raise RuntimeError('boom')
+
+    assert connections[0].commits == 0
+    assert connections[0].closed
+
+
+def prepared_db():
+    return DBHelperPostgress(dict(PRIMARY, prepare_statements=True))
+
+
+def test_statements_not_prepared_by_default(connections, monkeypatch):
+    monkeypatch.delenv('DDBB_PREPARE_STATEMENTS', raising=False)
+    db = DBHelperPostgress(PRIMARY)
+    conn = FakeConnection('primary')
+    for index in range(3):
+        db.select_connections_by_participant(participant_id='p1', space='TEST', shared_conn=conn)
+
+    assert [sql.split()[0] for sql in conn.statements] == ['select'] * 3
+    assert AsyncDBHelperPostgress(PRIMARY).prepare_statements is True
+
+
+def test_connection_used_once_does_not_prepare(connections):
+    prepared_db().select_connections_by_participant(participant_id='p1', space='TEST')
+
+    assert [sql.split()[0] for sql in connections[0].statements] == ['select']
+
+
+def test_hot_statement_prepared_once_per_reused_connection(connections):
+    db = prepared_db()
+    conn = FakeConnection('primary')
+    for index in range(3):
+        db.select_connections_by_participant(participant_id='p1', space='TEST', shared_conn=conn)
+
+    assert [sql.split()[0] for sql in conn.statements] == ['select', 'PREPARE', 'EXECUTE', 'EXECUTE']
+    assert '$1' in conn.statements[1] and '$2' in conn.statements[1]
+
+
+def test_threads_sharing_a_connection_prepare_once(connections):
+    db = prepared_db()
+    conn = FakeConnection('primary')
+    db.select_connections_by_participant(participant_id='p1', space='TEST', shared_conn=conn)
+    threads = [threading.Thread(target=db.select_connections_by_participant,
+                                kwargs={'participant_id': 'p1', 'space': 'TEST', 'shared_conn': conn})
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [sql.split()[0] for sql in conn.statements].count('PREPARE') == 1
+    assert DBHelperPostgress._prepared_disabled is False
+
+
+def test_prepared_statement_lost_falls_back_to_plain_sql(connections):
+    db = prepared_db()
+    conn = FakeConnection('primary')
+    for index in range(2):
+        db.select_connections_by_participant(participant_id='p1', space='TEST', shared_conn=conn)
+    conn.commit()
+    # next transaction lands on another server session, like PgBouncer in transaction mode
+    conn.session = set()
+
+    db.select_connections_by_participant(participant_id='p1', space='TEST', shared_conn=conn)
+
+    assert DBHelperPostgress._prepared_disabled is True
+    assert conn.statements[-1].startswith('select participant_id')
+
+
+def test_reaper_and_last_seen_are_limited_to_a_space(connections):
+    db = DBHelperPostgress(PRIMARY)
+    conn = FakeConnection('primary')
+    now = dt.datetime.now(dt.timezone.utc)
+
+    db.delete_connections_before(cutoff=now, idle_cutoff=now, space='TEST', shared_conn=conn)
+    db.update_last_seen({'s1': now}, space='TEST', shared_conn=conn)
+
+    delete, update = conn.statements
+    assert delete.count('space=%s') == 2
+    assert 'c.space=%s' in update
+
+
+@pytest.mark.parametrize('format,options', [
+    ('csv', 'FORMAT csv, HEADER'),
+    ('binary', 'FORMAT binary')])
+def test_export_connections_streams_copy(connections, format, options):
+    db = DBHelperPostgress(PRIMARY)
+    conn = FakeConnection('primary')
+    file = io.BytesIO()
+
+    db.export_connections(file, format=format, shared_conn=conn)
+
+    assert conn.statements[0].startswith(
+        f'COPY (select {DBHelperPostgress.COPY_COLUMNS} from client_connections) TO STDOUT')
+    assert options in conn.statements[0]
+    assert file.getvalue()
+
+
+def test_import_connections_stages_and_moves(connections, monkeypatch):
+    monkeypatch.setattr(FakeCursor, 'fetchone', lambda self: (2,))
+    db = DBHelperPostgress(PRIMARY)
+    conn = FakeConnection('primary')
+
+    imported = db.import_connections(io.BytesIO(b'rows'), shared_conn=conn)
+
+    assert imported == 2
+    assert conn.copied == b'rows'
+    assert [sql.split()[0] for sql in conn.statements] == ['CREATE', 'COPY', 'WITH']
+    assert f'client_connections_import ({DBHelperPostgress.COPY_COLUMNS}) FROM STDIN' in conn.statements[1]
+    assert f'INSERT INTO client_connections ({DBHelperPostgress.COPY_COLUMNS})' in conn.statements[2]
+    assert f'select {DBHelperPostgress.COPY_COLUMNS} from client_connections_import' in conn.statements[2]
+
+
+def test_copy_unknown_format(connections):
+    with pytest.raises(ValueError):
+        DBHelperPostgress(PRIMARY).export_connections(io.BytesIO(), format='xml')
+
+
+@pytest.mark.parametrize('statement_timeout,options', [
+    (0, None),
+    (2500, '-c statement_timeout=2500')])
+def test_connect_timeouts(monkeypatch, statement_timeout, options):
+    calls = []
+    monkeypatch.setattr(psycopg2, 'connect', lambda **kwargs: calls.append(kwargs) or FakeConnection('primary'))
+    CircuitBreaker._breakers.clear()
+    db = DBHelperPostgress(dict(PRIMARY, connect_timeout=2, statement_timeout=statement_timeout))
+
+    db.connect()
+
+    assert calls[0]['connect_timeout'] == 2
+    assert calls[0].get('options') == options
+
+
+def test_open_breaker_fails_fast_with_503(connections, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    config = dict(PRIMARY, host='downprimary', breaker_failures=2)
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: DBHelperPostgress(config))
+    event = {'requestContext': {'routeKey': '$disconnect', 'connectionId': 's1'}}
+
+    for _ in range(2):
+        with pytest.raises(psycopg2.OperationalError):
+            SocketHandleConnections().lambda_handler(event, None)
+
+    assert SocketHandleConnections().lambda_handler(event, None) == {'statusCode': 503}
+    assert DBHelperPostgress(config).get_breaker().metrics()['rejected'] == 1
+
+
+def test_open_breaker_rejects_sqs_redelivery_check_with_503(connections, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    config = dict(PRIMARY, host='downprimary', breaker_failures=1)
+    store = DBIdempotencyStore()
+    monkeypatch.setattr(store, 'get_db_handler', lambda: DBHelperPostgress(config))
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard', lambda self: IdempotencyGuard(store=store))
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: DBHelperPostgress(config))
+    event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': 'm1',
+                          'body': '{"action": "sendmessage", "participant_id": "p1", "space": "TEST", "msg": "hi"}'}]}
+    with pytest.raises(psycopg2.OperationalError):
+        DBHelperPostgress(config).connect()
+
+    assert SocketHandleConnections().lambda_handler(event, None) == {'statusCode': 503}
+
+
+def test_async_pool_acquisition_uses_the_breaker(connections, monkeypatch):
+    db = AsyncDBHelperPostgress(dict(PRIMARY, breaker_failures=2))
+
+    async def unreachable():
+        raise OSError('primary is down')
+    monkeypatch.setattr(db, 'get_pool', unreachable)
+
+    async def fetch_twice():
+        for _ in range(2):
+            with pytest.raises(OSError):
+                await db.select_connections_by_space('TEST')
+        await db.select_connections_by_space('TEST')
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(fetch_twice())
+    assert db.get_breaker() is DBHelperPostgress(PRIMARY).get_breaker()
@@ -0,0 +1,129 @@
+"""
+Unit tests for lib/db_helper_sharded.py. Each shard is a DBHelperMemory subclass with
+its own tables, no database is used.
+"""
+
+import threading
+from collections import Counter
+
+import pytest
+
+from lib.db_helper_memory import DBHelperMemory
+from lib.db_helper_sharded import DBHelperShardedPostgress, HashRing
+
+
+def memory_shard(name):
+    """ DBHelperMemory keeps its tables at class level, each shard gets its own class """
+    return type(f'Memory{name}', (DBHelperMemory,), {
+        '_lock': threading.RLock(), '_connections': {}, '_processed_messages': {}, '_unfinished_messages': set(),
+        '_space_counts': Counter(), '_participant_counts': Counter(), '_subscriptions': {},
+        '_message_seqs': Counter(), '_message_buffers': {}})()
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    monkeypatch.delenv('DDBB_SHARD_REBALANCING', raising=False)
+    return DBHelperShardedPostgress(shards={name: memory_shard(name) for name in ('a', 'b', 'c')})
+
+
+def test_ring_moves_about_one_nth_of_the_keys_when_a_shard_is_added():
+    keys = [f'participant-{index}' for index in range(10000)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+
+    owners = Counter(before.get_shard(key) for key in keys)
+    moved = [key for key in keys if before.get_shard(key) != after.get_shard(key)]
+
+    assert all(2500 < count < 4200 for count in owners.values())
+    assert all(after.get_shard(key) == 'd' for key in moved)
+    assert 1800 < len(moved) < 3200
+
+
+def test_participant_rows_live_in_one_shard(sharded):
+    for index in range(30):
+        sharded.insert_connection(participant_id=f'p{index}', socket_id=f's{index}', space='TEST')
+        sharded.insert_buffered_message(participant_id=f'p{index}', space='TEST', message='{"message":"hi"}')
+
+    for index in range(30):
+        owner = sharded.shards[sharded.get_shard(f'p{index}')]
+        assert [row['socket_id'] for row in owner.select_connections_by_participant(f'p{index}', 'TEST')] == [f's{index}']
+        assert sharded.select_connections_by_participant(f'p{index}', 'TEST')[0]['socket_id'] == f's{index}'
+        assert sharded.select_buffered_messages(f'p{index}', 'TEST')[0]['seq'] == 1
+    assert all(shard._connections for shard in sharded.shards.values())
+
+
+def test_space_socket_and_channel_calls_scatter_gather(sharded):
+    for index in range(20):
+        sharded.insert_connection(participant_id=f'p{index}', socket_id=f's{index}', space='TEST',
+                                  endpoint='https://example.com/latest')
+    sharded.insert_subscription(channel='news', socket_id='s3')
+    sharded.insert_subscription(channel='news', socket_id='s7')
+
+    assert sorted(row['socket_id'] for row in sharded.select_connections_by_space('TEST')) == sorted(
+        f's{index}' for index in range(20))
+    assert sharded.select_connection_count_by_space('TEST') == 20
+    assert sharded.select_connection_counts() == [{'space': 'TEST', 'connections': 20}]
+    assert sharded.select_connection_spaces() == ['TEST']
+    assert sharded.select_connection_by_socket('s5')['participant_id'] == 'p5'
+    shard = sharded.shards[sharded.get_shard('p3')]
+    assert 's3' in shard._subscriptions['news']
+    assert sorted(row['socket_id'] for row in sharded.select_connections_by_channel('news')) == ['s3', 's7']
+
+    assert sharded.delete_connection_by_socket('s5') == 1
+    assert sharded.select_connection_by_socket('s5') is None
+    assert sharded.select_connection_count_by_space('TEST') == 19
+
+
+def test_unit_of_work_only_opens_the_shards_it_uses(sharded, monkeypatch):
+    opened = []
+    for name, shard in sharded.shards.items():
+        monkeypatch.setattr(shard, 'unit_of_work', lambda read_only=False, name=name, shard=shard: opened.append(name) or
+                            DBHelperMemory.unit_of_work(shard, read_only=read_only))
+
+    with sharded.unit_of_work() as shared_conn:
+        sharded.insert_connection(participant_id='p1', socket_id='s1', shared_conn=shared_conn)
+        sharded.select_connections_by_participant('p1', 'PUBLIC', shared_conn=shared_conn)
+    assert opened == [sharded.get_shard('p1')]
+
+    with sharded.unit_of_work() as shared_conn:
+        sharded.select_connections_by_space('PUBLIC', shared_conn=shared_conn)
+    assert sorted(opened[1:]) == ['a', 'b', 'c']
+
+
+def test_connect_routes_to_a_shard(sharded, monkeypatch):
+    for name, shard in sharded.shards.items():
+        monkeypatch.setattr(shard, 'connect', lambda name=name: f'conn-{name}')
+
+    assert sharded.connect() == 'conn-a'
+    assert sharded.connect(sharded.get_shard('p1')) == f'conn-{sharded.get_shard("p1")}'
+    assert sharded._connection_get(name='c') == (True, 'conn-c')
+    with sharded.unit_of_work() as shared_conn:
+        assert sharded._connection_get(shared_conn, name='b') == (False, None)
+
+
+def test_rebalancing_reads_gather_every_shard(sharded):
+    owner = sharded.get_shard('p1')
+    other = next(name for name in sharded.shards if name != owner)
+    # rows still in the old shard
+    sharded.shards[other].insert_connection(participant_id='p1', socket_id='old', space='TEST')
+    sharded.shards[other].insert_buffered_message(participant_id='p1', space='TEST', message='{"message":"old"}')
+    sharded.insert_connection(participant_id='p1', socket_id='new', space='TEST')
+
+    assert [row['socket_id'] for row in sharded.select_connections_by_participant('p1', 'TEST')] == ['new']
+    sharded.rebalancing = True
+
+    assert sorted(row['socket_id'] for row in sharded.select_connections_by_participant('p1', 'TEST')) == ['new', 'old']
+    assert sharded.select_connection_count_by_participant('p1', 'TEST') == 2
+    assert [message['seq'] for message in sharded.select_buffered_messages('p1', 'TEST')] == [1]
+
+
+def test_shards_from_environment(monkeypatch):
+    monkeypatch.setenv('DDBB_SHARDS', '[{"host": "db1", "port": 5432, "database": "ws", "user": "u", "password": "p"},'
+                                      ' {"name": "extra", "host": "db2", "port": 5432, "database": "ws", "user": "u",'
+                                      ' "password": "p"}]')
+    monkeypatch.setenv('DDBB_SHARD_REBALANCING', 'true')
+
+    sharded = DBHelperShardedPostgress()
+
+    assert {name: shard.host for name, shard in sharded.shards.items()} == {'shard0': 'db1', 'extra': 'db2'}
+    assert sharded.rebalancing
@@ -0,0 +1,113 @@
+"""
+Unit tests for lib/db_rebalance_postgress.py. The shards are fakes that answer
+the statements of move_participant from lists, no database is used.
+"""
+
+import datetime as dt
+
+from lib.db_rebalance_postgress import move_participant
+
+
+EXPIRES = dt.datetime(2030, 1, 1, tzinfo=dt.timezone.utc)
+LAST_SEEN = dt.datetime(2026, 10, 19, tzinfo=dt.timezone.utc)
+
+
+class FakeShardCursor:
+    def __init__(self, shard):
+        self.shard = shard
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        statement = ' '.join(sql.split())
+        shard = self.shard
+        self.rows = []
+        if statement.startswith('select participant_id,socket_id'):
+            self.rows = list(shard.connections)
+        elif statement.startswith('select last_seq'):
+            self.rows = [(shard.last_seq,)] if shard.last_seq is not None else []
+        elif statement.startswith('select seq,message,expires'):
+            self.rows = [(seq, message, expires) for seq, (message, expires) in sorted(shard.messages.items())]
+        elif statement.startswith('INSERT INTO client_connections'):
+            shard.connections.append(params)
+            self.rows = [(params[0], params[2])]
+        elif statement.startswith('INSERT INTO participant_message_seqs'):
+            shard.last_seq = max(shard.last_seq or 0, params[2])
+        elif statement.startswith('UPDATE participant_message_seqs'):
+            shard.last_seq += 1
+            self.rows = [(shard.last_seq,)]
+        elif statement.startswith('INSERT INTO participant_messages'):
+            assert params[2] not in shard.messages
+            shard.messages[params[2]] = (params[3], params[4])
+        elif statement.startswith('delete from participant_messages'):
+            shard.messages.clear()
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def close(self):
+        pass
+
+
+class FakeShardConnection:
+    def __init__(self, shard):
+        self.shard = shard
+
+    def cursor(self):
+        return FakeShardCursor(self.shard)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeShard:
+    def __init__(self, connections=(), last_seq=None, messages=None):
+        self.connections = list(connections)
+        self.last_seq = last_seq
+        self.messages = dict(messages or {})
+
+    def _connection_get(self, shared_conn=None, read_only=False):
+        return True, FakeShardConnection(self)
+
+    def _connection_close(self, myconn, shared_conn):
+        pass
+
+    def _update_connection_counts(self, cur, rows, delta):
+        pass
+
+    def _connections_deleted(self, cur, rows):
+        pass
+
+
+def test_move_copies_last_seen():
+    source = FakeShard(connections=[('p1', 's1', 'TEST', LAST_SEEN, 'https://example.com', 'gzip', LAST_SEEN)])
+    target = FakeShard()
+
+    assert move_participant(source, target, 'p1', 'TEST') == 1
+    assert target.connections == [('p1', 's1', 'TEST', LAST_SEEN, 'https://example.com', 'gzip', LAST_SEEN)]
+
+
+def test_move_renumbers_messages_whose_seq_is_taken():
+    source = FakeShard(last_seq=2, messages={1: ('old-1', EXPIRES), 2: ('old-2', EXPIRES)})
+    target = FakeShard(last_seq=1, messages={1: ('new-1', EXPIRES)})
+
+    move_participant(source, target, 'p1', 'TEST')
+
+    assert target.messages == {1: ('new-1', EXPIRES), 3: ('old-1', EXPIRES), 4: ('old-2', EXPIRES)}
+    assert target.last_seq == 4
+    assert source.messages == {}
+
+
+def test_move_again_skips_messages_copied_before():
+    source = FakeShard(last_seq=1, messages={1: ('old-1', EXPIRES)})
+    target = FakeShard(last_seq=2, messages={1: ('new-1', EXPIRES), 2: ('old-1', EXPIRES)})
+
+    move_participant(source, target, 'p1', 'TEST')
+
+    assert target.messages == {1: ('new-1', EXPIRES), 2: ('old-1', EXPIRES)}
+    assert target.last_seq == 2
@@ -0,0 +1,39 @@
+"""
+Unit tests for lib/db_schema_postgress.py. Only the generated DDL is checked, no database is used.
+"""
+
+import pytest
+
+from lib import db_schema_postgress as schema
+
+
+@pytest.mark.parametrize('partition_by,expected', [
+    (None, 'PRIMARY KEY (socket_id)'),
+    ('list', 'PARTITION BY LIST (space)'),
+    ('hash', 'PARTITION BY HASH (space)')])
+def test_client_connections_statements(partition_by, expected):
+    statements = schema.client_connections_statements(partition_by=partition_by, partitions=4)
+
+    assert expected in statements[0]
+    assert 'endpoint' in statements[0]
+    assert schema.CLIENT_CONNECTIONS_ENDPOINT_DDL in statements
+    assert schema.CLIENT_CONNECTIONS_COMPRESSION_DDL in statements
+    assert schema.CLIENT_CONNECTIONS_LAST_SEEN_DDL in statements
+    if partition_by == 'list':
+        assert any(schema.PARTITION_DEFAULT in sql and 'DEFAULT;' in sql for sql in statements)
+    if partition_by == 'hash':
+        assert sum('MODULUS 4' in sql for sql in statements) == 4
+
+
+def test_unknown_partition_method():
+    with pytest.raises(ValueError):
+        schema.client_connections_statements(partition_by='range')
+
+
+def test_partition_name_is_a_stable_identifier():
+    name = schema.partition_name('Big Tenant!')
+
+    assert name == schema.partition_name('Big Tenant!')
+    assert name != schema.partition_name('big-tenant')
+    assert name.startswith('client_connections_big_tenant_')
+    assert len(name) < 64
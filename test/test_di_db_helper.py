@@ -0,0 +1,130 @@
+"""
+Unit tests for lib/di_db_helper.py.
+"""
+
+import threading
+import pytest
+
+import lib.di_db_helper
+from lib.async_db_helper_memory import AsyncDBHelperMemory
+from lib.db_helper_memory import DBHelperMemory
+from lib.di_db_helper import DIDBHelper
+
+
+@pytest.fixture
+def container(monkeypatch):
+    monkeypatch.setenv('db_handler', 'DBHelperMemory')
+    monkeypatch.setenv('async_db_handler', 'AsyncDBHelperMemory')
+    monkeypatch.setattr(DIDBHelper, 'db_helper_classes', dict(DIDBHelper.db_helper_classes))
+    DIDBHelper.reset()
+    yield
+    DIDBHelper.reset()
+
+
+class FakeEntryPoint:
+    def __init__(self, name, loaded):
+        self.name = name
+        self.value = f'plugin:{name}'
+        self.loaded = loaded
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.loaded
+
+
+class PluginHelper(DBHelperMemory):
+    pass
+
+
+@pytest.mark.parametrize('scope,same_after_invocation', [
+    ('singleton', True),
+    ('invocation', False)])
+def test_scopes(container, monkeypatch, scope, same_after_invocation):
+    monkeypatch.setenv('db_handler_scope', scope)
+    di = DIDBHelper.get_instance()
+    helper = di.resolve()
+    async_helper = di.resolve_async()
+
+    assert isinstance(helper, DBHelperMemory) and isinstance(async_helper, AsyncDBHelperMemory)
+    assert di.resolve() is helper
+
+    di.start_invocation()
+
+    assert (di.resolve() is helper) == same_after_invocation
+    assert (di.resolve_async() is async_helper) == same_after_invocation
+
+
+def test_unknown_scope(container, monkeypatch):
+    monkeypatch.setenv('db_handler_scope', 'request')
+    with pytest.raises(ValueError):
+        DIDBHelper.get_instance()
+
+
+def test_get_instance_is_thread_safe(container, monkeypatch):
+    created = []
+    init = DIDBHelper.__init__
+
+    def counting_init(self):
+        created.append(self)
+        init(self)
+
+    monkeypatch.setattr(DIDBHelper, '__init__', counting_init)
+    barrier = threading.Barrier(8)
+    instances = []
+
+    def get():
+        barrier.wait()
+        instances.append(DIDBHelper.get_instance())
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(created) == 1
+    assert all(instance is instances[0] for instance in instances)
+
+
+def test_backend_from_entry_point(container, monkeypatch):
+    entry_point = FakeEntryPoint('PluginHelper', PluginHelper)
+    groups = []
+
+    def entry_points(group):
+        groups.append(group)
+        return [entry_point]
+
+    monkeypatch.setattr(lib.di_db_helper, '_entry_points', entry_points)
+    monkeypatch.setenv('db_handler', 'PluginHelper')
+
+    assert isinstance(DIDBHelper.get_instance().resolve(), PluginHelper)
+    # built-in async helper, no scan
+    assert groups == [DIDBHelper.ENTRY_POINT_GROUP]
+
+    DIDBHelper.reset()
+    DIDBHelper.get_instance()
+    assert entry_point.loads == 1
+
+
+class MinimalHelper:
+    """ third party helper that does not extend DBHelper """
+
+
+def test_entry_point_helper_without_start_invocation(container, monkeypatch):
+    monkeypatch.setattr(lib.di_db_helper, '_entry_points', lambda group: [FakeEntryPoint('MinimalHelper', MinimalHelper)])
+    monkeypatch.setenv('db_handler', 'MinimalHelper')
+    monkeypatch.setenv('db_handler_scope', 'invocation')
+    di = DIDBHelper.get_instance()
+    helper = di.resolve()
+
+    di.start_invocation()
+
+    assert isinstance(di.resolve(), MinimalHelper) and di.resolve() is not helper
+
+
+def test_unknown_backend(container, monkeypatch):
+    monkeypatch.setattr(lib.di_db_helper, '_entry_points', lambda group: [])
+    monkeypatch.setenv('db_handler', 'Missing')
+    with pytest.raises(ValueError):
+        DIDBHelper.get_instance()
@@ -0,0 +1,117 @@
+"""
+Unit tests for lib/idempotency.py.
+"""
+
+import contextlib
+import json
+
+import pytest
+
+from lib.idempotency import IdempotencyGuard, MemoryIdempotencyStore, DBIdempotencyStore
+from lib.db_helper_memory import DBHelperMemory
+from lib.socket_handle_connections import SocketHandleConnections
+
+
+class CountingStore(MemoryIdempotencyStore):
+    def __init__(self):
+        super().__init__()
+        self.lookups = 0
+
+    def is_processed(self, message_id):
+        self.lookups += 1
+        return super().is_processed(message_id)
+
+
+def make_sqs_event(message_id):
+    body = {'participant_id': 'id1', 'space': 'TEST', 'action': 'sendmessage', 'msg': 'hello'}
+    return {'Records': [{'eventSource': 'aws:sqs', 'messageId': message_id, 'body': json.dumps(body)}]}
+
+
+def test_guard_uses_cache_before_store():
+    store = CountingStore()
+    guard = IdempotencyGuard(store=store, max_size=10)
+
+    assert guard.is_duplicate('m1') is False
+    assert store.lookups == 1
+    guard.mark_processed('m1')
+    assert guard.is_duplicate('m1') is True
+    assert store.lookups == 1
+
+
+def test_guard_falls_back_to_store_after_eviction():
+    store = CountingStore()
+    guard = IdempotencyGuard(store=store, max_size=2)
+    for message_id in ('m1', 'm2', 'm3'):
+        guard.mark_processed(message_id)
+
+    assert len(guard._cache) == 2
+    assert guard.is_duplicate('m1') is True
+    assert store.lookups == 1
+
+
+def test_guard_ignores_missing_id():
+    guard = IdempotencyGuard(store=MemoryIdempotencyStore(), max_size=2)
+    guard.mark_processed(None)
+    assert guard.is_duplicate(None) is False
+
+
+def test_db_store_with_memory_backend(monkeypatch):
+    DBHelperMemory.reset()
+    store = DBIdempotencyStore()
+    monkeypatch.setattr(store, 'get_db_handler', DBHelperMemory)
+
+    assert store.is_processed('m1') is False
+    store.mark_processed('m1')
+    assert store.is_processed('m1') is True
+
+
+def test_sqs_redelivery_is_skipped(monkeypatch):
+    guard = IdempotencyGuard(store=MemoryIdempotencyStore(), max_size=10)
+    sent = []
+
+    def fake_send(self, event, caller_type, body):
+        sent.append(body)
+        return {'statusCode': 200}
+
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard', lambda self: guard)
+    monkeypatch.setattr(SocketHandleConnections, 'handle_send_message', fake_send)
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: DBHelperMemory())
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+
+    for _ in range(2):
+        response = SocketHandleConnections().lambda_handler(make_sqs_event('m1'), None)
+        assert response['statusCode'] is not None
+
+    assert len(sent) == 1
+
+
+def test_processed_mark_is_written_in_the_route_transaction(monkeypatch):
+    DBHelperMemory.reset()
+    marks = []
+
+    class TransactionalMemory(DBHelperMemory):
+        @contextlib.contextmanager
+        def unit_of_work(self, read_only=False):
+            yield 'uow-conn'
+
+        def insert_processed_message(self, message_id, done=True, shared_conn=None):
+            marks.append(shared_conn)
+            return super().insert_processed_message(message_id, done=done, shared_conn=shared_conn)
+
+    def failing_send(self, event, caller_type, body):
+        raise RuntimeError('commit failed')
+
+    store = DBIdempotencyStore()
+    monkeypatch.setattr(store, 'get_db_handler', TransactionalMemory)
+    guard = IdempotencyGuard(store=store, max_size=10)
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard', lambda self: guard)
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: TransactionalMemory())
+    monkeypatch.setattr(SocketHandleConnections, 'handle_send_message', failing_send)
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+
+    with pytest.raises(RuntimeError):
+        SocketHandleConnections().lambda_handler(make_sqs_event('m1'), None)
+
+    assert marks == ['uow-conn']
+    # only cached once committed, a redelivery after a rollback reaches the store again
+    assert 'm1' not in guard._cache
@@ -0,0 +1,75 @@
+"""
+Memory budgets of a fan-out, measured per stage with lib/memory_tracker.py and the
+in-memory DB backend. Budgets are a fixed allowance plus bytes per socket, so a
+stage that starts copying the recipients or the payload per socket fails them.
+"""
+
+import json
+
+import pytest
+
+from lib.db_helper_memory import DBHelperMemory
+from lib.memory_tracker import MemoryTracker
+from lib.socket_handle_connections import SocketHandleConnections
+
+KB = 1024
+# stage -> (fixed bytes, bytes per socket)
+BUDGETS = {
+    'parse': (16*KB, 0),
+    'payload': (64*KB, 0),
+    # one dict per connection row and the socket ids grouped by endpoint
+    'lookup': (64*KB, 256),
+    'delivery': (64*KB, 0),
+}
+
+
+class CountingManagementClient:
+    """Counts the posts without keeping them."""
+
+    class exceptions:
+        GoneException = type('GoneException', (Exception,), {})
+
+    def __init__(self):
+        self.posted = 0
+
+    def post_to_connection(self, Data, ConnectionId):
+        self.posted += 1
+        return {}
+
+
+@pytest.mark.parametrize('sockets', [1000, 10000, 100000])
+def test_fanout_memory_budget(monkeypatch, sockets):
+    DBHelperMemory.reset()
+    db = DBHelperMemory()
+    for index in range(sockets):
+        db.insert_connection(participant_id='p1', socket_id=f'socket-{index:06d}-connection', space='TEST')
+    client = CountingManagementClient()
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setenv('socket_domain', 'https://example.com/latest')
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: db)
+    monkeypatch.setattr(SocketHandleConnections, 'get_management_client', lambda self, endpoint: client)
+    handler = SocketHandleConnections()
+    handler.memory = MemoryTracker()
+    event = {'requestContext': {'routeKey': 'sendmessage', 'connectionId': 'sender',
+                                'domainName': 'example.com', 'stage': 'latest'},
+             'body': json.dumps({'participant_id': 'p1', 'space': 'TEST', 'msg': 'x'*2048})}
+
+    with handler.memory.tracing():
+        assert handler.lambda_handler(event, None)['statusCode'] == 200
+
+    assert client.posted == sockets
+    assert handler.fanout_size == sockets
+    assert sorted(handler.memory.stages) == sorted(BUDGETS)
+    for stage, (fixed, per_socket) in BUDGETS.items():
+        assert handler.memory.stages[stage] <= fixed+per_socket*sockets, stage
+
+
+def test_memory_tracker_is_off_by_default(monkeypatch):
+    monkeypatch.delenv('memory_tracking', raising=False)
+    handler = SocketHandleConnections()
+
+    with handler.memory.stage('lookup'):
+        pass
+
+    assert not handler.memory.enabled
+    assert handler.memory.stages == {}
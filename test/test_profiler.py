@@ -0,0 +1,59 @@
+"""
+Unit tests for lib/profiler.py.
+"""
+
+import time
+
+import pytest
+
+from lib.profiler import SamplingProfiler, fanout_bucket, get_profiler
+
+
+def busy_loop(seconds):
+    end = time.perf_counter()+seconds
+    while time.perf_counter() < end:
+        pass
+
+
+@pytest.mark.parametrize('size,bucket', [
+    (0, '0'), (1, '1-9'), (42, '10-99'), (999, '100-999'), (1000, '1k-9k'), (25000, '10k-99k')])
+def test_fanout_bucket(size, bucket):
+    assert fanout_bucket(size) == bucket
+
+
+def test_profile_writes_labeled_collapsed_stacks(tmp_path):
+    profiler = SamplingProfiler(interval=0.001, directory=tmp_path)
+
+    with profiler.profile('request-1') as profile:
+        busy_loop(0.1)
+        profile.labels.update(route='sendmessage', fanout=fanout_bucket(1500))
+
+    lines = (tmp_path / 'request-1.collapsed').read_text().splitlines()
+    assert profile.samples > 0
+    assert all(line.startswith('route:sendmessage;fanout:1k-9k;main;') for line in lines)
+    assert any('test_profiler:busy_loop' in line for line in lines)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) >= profile.samples
+
+
+def test_profile_is_written_when_the_handler_fails(tmp_path):
+    profiler = SamplingProfiler(interval=0.001, directory=tmp_path)
+
+    with pytest.raises(ValueError):
+        with profiler.profile('request-2'):
+            raise ValueError()
+
+    assert (tmp_path / 'request-2.collapsed').exists()
+
+
+@pytest.mark.parametrize('env,profiled', [
+    ({}, False),
+    ({'profile_enabled': 'true'}, True),
+    ({'profile_sample_percent': '100'}, True),
+    ({'profile_sample_percent': '0'}, False)])
+def test_get_profiler_from_environment(monkeypatch, env, profiled):
+    for key in ('profile_enabled', 'profile_sample_percent'):
+        monkeypatch.delenv(key, raising=False)
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+
+    assert (get_profiler() is not None) == profiled
@@ -0,0 +1,84 @@
+"""
+Unit tests for lib/route_registry.py and the routes of SocketHandleConnections.
+"""
+
+import json
+import pytest
+
+from lib.db_helper_memory import DBHelperMemory
+from lib.route_registry import RouteRegistry, RouteRequest
+from lib.socket_handle_connections import SocketHandleConnections
+
+
+def make_request(route_key, caller_type='WEBSOCKET'):
+    return RouteRequest(event={}, context=None, route_key=route_key, socket_id='s1', body={}, caller_type=caller_type)
+
+
+def test_middleware_wraps_routes_in_order():
+    calls = []
+
+    def middleware(name):
+        def call(socket_handler, request, call_next):
+            calls.append(name)
+            return call_next(socket_handler, request)
+        return call
+
+    routes = RouteRegistry()
+    routes.add_route('ping', lambda socket_handler, request: {'statusCode': 200, 'body': 'pong'})
+    routes.add_route('admin', lambda socket_handler, request: {'statusCode': 200})
+    routes.add_middleware(middleware('timing'))
+    routes.add_middleware(middleware('auth'), route_keys=['admin'])
+
+    assert routes.dispatch(None, make_request('ping')) == {'statusCode': 200, 'body': 'pong'}
+    assert routes.dispatch(None, make_request('admin')) == {'statusCode': 200}
+    assert calls == ['timing', 'timing', 'auth']
+
+
+def test_middleware_can_short_circuit():
+    routes = RouteRegistry()
+    routes.add_route('admin', lambda socket_handler, request: {'statusCode': 200})
+    routes.dispatch(None, make_request('admin'))
+    # added after the chain was composed, the chain is rebuilt
+    routes.add_middleware(lambda socket_handler, request, call_next: {'statusCode': 401})
+
+    assert routes.dispatch(None, make_request('admin')) == {'statusCode': 401}
+
+
+@pytest.mark.parametrize('route_key,caller_type,expected', [
+    ('subscribe', 'WEBSOCKET', 200),
+    ('subscribe', 'REST', 404),
+    ('missing', 'WEBSOCKET', 404)])
+def test_dispatch_checks_caller_type(route_key, caller_type, expected):
+    routes = RouteRegistry()
+    routes.route('subscribe', caller_types=('WEBSOCKET',))(lambda socket_handler, request: {'statusCode': 200})
+
+    assert routes.dispatch(None, make_request(route_key, caller_type))['statusCode'] == expected
+
+
+def test_latency_report():
+    routes = RouteRegistry()
+    routes.add_route('ping', lambda socket_handler, request: {'statusCode': 200})
+    for _ in range(3):
+        routes.dispatch(None, make_request('ping'))
+
+    report = routes.latency_report()
+
+    assert list(report) == ['ping']
+    assert report['ping']['count'] == 3
+    assert 0 <= report['ping']['mean_ms'] <= report['ping']['max_ms']
+
+
+def test_plugin_route_through_lambda_handler(monkeypatch):
+    DBHelperMemory.reset()
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: DBHelperMemory())
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+
+    class PluginHandler(SocketHandleConnections):
+        pass
+
+    PluginHandler.get_route_registry().add_route(
+        'echo', lambda socket_handler, request: {'statusCode': 200, 'body': json.dumps(request.body)})
+    event = {'requestContext': {'routeKey': 'echo', 'connectionId': 's1'}, 'body': json.dumps({'msg': 'hi'})}
+
+    assert PluginHandler().lambda_handler(event, None) == {'statusCode': 200, 'body': '{"msg": "hi"}'}
+    assert SocketHandleConnections().lambda_handler(event, None) == {'statusCode': 404}
@@ -0,0 +1,655 @@
+"""
+Unit tests for lib/socket_handle_connections.py using the in-memory DB backend.
+"""
+
+import contextlib
+import datetime as dt
+import gzip
+import json
+import pytest
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+from lib.blob_store import LocalBlobStore
+from lib.codec import GzipCompression
+from lib.db_helper_memory import DBHelperMemory
+from lib.fanout_queue import MemoryFanoutQueue, SQSFanoutQueue
+from lib.idempotency import DBIdempotencyStore, IdempotencyGuard, MemoryIdempotencyStore
+from lib.last_seen import LastSeenBuffer
+from lib.socket_handle_connections import SocketHandleConnections
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    DBHelperMemory.reset()
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: DBHelperMemory())
+    monkeypatch.setattr(SocketHandleConnections, '_management_clients', {})
+    monkeypatch.setattr(SocketHandleConnections, '_socket_spaces', OrderedDict())
+    return SocketHandleConnections()
+
+
+class GoneException(ClientError):
+    def __init__(self):
+        super().__init__({'Error': {'Code': 'GoneException'}}, 'PostToConnection')
+
+
+class FakeManagementClient:
+    """Records posted messages. Sockets in `gone` raise GoneException."""
+
+    class exceptions:
+        GoneException = GoneException
+
+    def __init__(self, gone=()):
+        self.gone = set(gone)
+        self.posted = []
+
+    def post_to_connection(self, Data, ConnectionId):
+        if ConnectionId in self.gone:
+            raise GoneException()
+        self.posted.append((ConnectionId, Data))
+        return {}
+
+
+def websocket_event(route_key, socket_id, body):
+    return {'requestContext': {'routeKey': route_key, 'connectionId': socket_id},
+            'body': json.dumps(body)}
+
+
+def age_connection(socket_id, seconds):
+    DBHelperMemory._connections[socket_id]['connected'] -= dt.timedelta(seconds=seconds)
+
+
+@pytest.mark.parametrize('stale,fresh,chunk_size', [
+    (0, 3, 2),
+    (5, 2, 2),
+    (4, 1, 4),
+    (3, 0, 10)])
+def test_handle_reap(handler, stale, fresh, chunk_size):
+    db = DBHelperMemory()
+    for index in range(stale + fresh):
+        db.insert_connection(participant_id=f'p{index}', socket_id=f's{index}', space='TEST')
+    for index in range(stale):
+        age_connection(f's{index}', 3600)
+
+    deleted = handler.handle_reap(max_age_seconds=1800, chunk_size=chunk_size)
+
+    assert deleted == stale
+    assert len(db.select_connections_by_space('TEST')) == fresh
+
+
+def test_connection_counts_follow_inserts_and_deletes(handler):
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    db.insert_connection(participant_id='p1', socket_id='s2', space='TEST')
+    db.insert_connection(participant_id='p2', socket_id='s3', space='TEST')
+    db.insert_connection(participant_id='p2', socket_id='s4', space='OTHER')
+
+    assert db.select_connection_count_by_space('TEST') == 3
+    assert db.select_connection_count_by_participant('p1', 'TEST') == 2
+
+    db.delete_connection_by_socket('s1')
+    db.delete_connection_by_participant('p2', space='TEST')
+
+    assert db.select_connection_count_by_space('TEST') == 1
+    assert db.select_connection_count_by_participant('p2', 'TEST') == 0
+    assert db.select_connection_counts() == [
+        {'space': 'OTHER', 'connections': 1}, {'space': 'TEST', 'connections': 1}]
+
+
+@pytest.mark.parametrize('params,expected', [
+    ({'space': 'TEST'}, {'space': 'TEST', 'connections': 2}),
+    ({'space': 'TEST', 'participant_id': 'p1'},
+     {'space': 'TEST', 'connections': 2, 'participant_id': 'p1', 'participant_connections': 1}),
+    (None, {'spaces': [{'space': 'TEST', 'connections': 2}]})])
+def test_connection_count_route(handler, monkeypatch, params, expected):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    db.insert_connection(participant_id='p2', socket_id='s2', space='TEST')
+    event = {
+        'httpMethod': 'GET',
+        'requestContext': {'resourcePath': '/{participant_id+}'},
+        'queryStringParameters': params}
+
+    response = handler.lambda_handler(event, None)
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == expected
+
+
+def test_channel_subscribe_and_publish(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    db = DBHelperMemory()
+    for index in range(3):
+        db.insert_connection(participant_id=f'p{index}', socket_id=f's{index}', space='TEST')
+    for socket_id in ('s0', 's1', 's2'):
+        event = websocket_event('subscribe', socket_id, {'action': 'subscribe', 'channel': 'team:1'})
+        assert handler.lambda_handler(event, None)['statusCode'] == 200
+    event = websocket_event('unsubscribe', 's2', {'action': 'unsubscribe', 'channel': 'team:1'})
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+
+    client = FakeManagementClient(gone=['s1'])
+    status_code = handler.handle_message({'channel': 'team:1', 'msg': 'hello'}, client)
+
+    assert status_code == 200
+    assert [(socket_id, json.loads(data)) for socket_id, data in client.posted] == [
+        ('s0', {'channel': 'team:1', 'message': 'hello'})]
+    assert db.select_connection_by_socket('s1') is None
+    assert db.select_connections_by_channel('team:1') == [{'channel': 'team:1', 'socket_id': 's0', 'endpoint': None,
+                                                            'compression': None}]
+
+
+def test_message_encoded_once_for_all_sockets(handler):
+    db = DBHelperMemory()
+    for index in range(3):
+        db.insert_connection(participant_id='p1', socket_id=f's{index}', space='TEST')
+    client = FakeManagementClient()
+
+    handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hola ñ'}, client)
+
+    payloads = [data for _, data in client.posted]
+    assert len(payloads) == 3
+    assert isinstance(payloads[0], bytes)
+    assert all(data is payloads[0] for data in payloads)
+    assert json.loads(payloads[0]) == {'participant_id': 'p1', 'message': 'hola ñ', 'seq': 1}
+
+
+def test_connect_stores_endpoint_and_fanout_groups_by_endpoint(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'decode_jwt_token',
+                        lambda self, token: {'id_user': 'p1', 'exp': 4102444800})
+    clients = {}
+    monkeypatch.setattr('lib.socket_handle_connections.boto3.client',
+                        lambda service, endpoint_url: clients.setdefault(endpoint_url, FakeManagementClient()))
+    for socket_id, domain, stage in (('s0', 'a.example.com', 'prod'), ('s1', 'a.example.com', 'prod'),
+                                     ('s2', 'b.example.com', 'dev')):
+        event = {'requestContext': {'routeKey': '$connect', 'connectionId': socket_id,
+                                    'domainName': domain, 'stage': stage},
+                 'queryStringParameters': {'participant_id': 'token', 'space': 'TEST'}}
+        assert handler.lambda_handler(event, None)['statusCode'] == 200
+    DBHelperMemory().insert_connection(participant_id='p1', socket_id='s3', space='TEST')
+    default_client = FakeManagementClient()
+
+    handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'}, default_client)
+
+    assert DBHelperMemory().select_connection_by_socket('s2')['endpoint'] == 'https://b.example.com/dev'
+    assert [socket_id for socket_id, _ in clients['https://a.example.com/prod'].posted] == ['s0', 's1']
+    assert [socket_id for socket_id, _ in clients['https://b.example.com/dev'].posted] == ['s2']
+    assert [socket_id for socket_id, _ in default_client.posted] == ['s3']
+    assert handler.get_management_client('https://a.example.com/prod') is clients['https://a.example.com/prod']
+
+
+def test_large_fanout_is_scattered_and_chunks_delivered(handler, monkeypatch):
+    monkeypatch.setenv('fanout_chunk_size', '2')
+    monkeypatch.setenv('socket_domain', 'https://example.com/latest')
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    queue = MemoryFanoutQueue()
+    monkeypatch.setattr(SocketHandleConnections, 'get_fanout_queue', lambda self: queue)
+    guard = IdempotencyGuard(store=MemoryIdempotencyStore())
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard', lambda self: guard)
+    db = DBHelperMemory()
+    for index in range(5):
+        db.insert_connection(participant_id='p1', socket_id=f's{index}', space='TEST')
+
+    client = FakeManagementClient(gone=['s3'])
+    assert handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'}, client) == 200
+
+    assert client.posted == []
+    assert [item['sockets'] for item in queue.items] == [['s0', 's1'], ['s2', 's3'], ['s4']]
+
+    monkeypatch.setattr('lib.socket_handle_connections.boto3.client', lambda *args, **kwargs: client)
+    for index, item in enumerate(queue.items):
+        event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': f'm{index}', 'body': json.dumps(item)}]}
+        handler.lambda_handler(event, None)
+
+    assert sorted(socket_id for socket_id, _ in client.posted) == ['s0', 's1', 's2', 's4']
+    assert db.select_connection_by_socket('s3') is None
+
+
+
+class TransactionLog(DBHelperMemory):
+    """DBHelperMemory that records its units of work and the connection of each call."""
+
+    events = []
+
+    @contextlib.contextmanager
+    def unit_of_work(self, read_only=False):
+        self.events.append('begin')
+        yield 'uow-conn'
+        self.events.append('commit')
+
+    def insert_buffered_message(self, *args, shared_conn=None, **kwargs):
+        self.events.append(('buffer', shared_conn))
+        return super().insert_buffered_message(*args, **kwargs)
+
+    def select_connections_by_participant(self, *args, shared_conn=None, **kwargs):
+        self.events.append(('lookup', shared_conn))
+        return super().select_connections_by_participant(*args, **kwargs)
+
+    def delete_connection_by_socket(self, socket_id, space=None, shared_conn=None):
+        self.events.append(('delete', socket_id, shared_conn))
+        return super().delete_connection_by_socket(socket_id, space=space)
+
+
+def test_delivery_runs_after_the_unit_of_work_commits(handler, monkeypatch):
+    monkeypatch.setenv('socket_domain', 'https://example.com/latest')
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(TransactionLog, 'events', [])
+    monkeypatch.setattr(SocketHandleConnections, 'get_db_handler', lambda self: TransactionLog())
+    db = DBHelperMemory()
+    for index in range(3):
+        db.insert_connection(participant_id='p1', socket_id=f's{index}', space='TEST')
+
+    class LoggingClient(FakeManagementClient):
+        def post_to_connection(self, Data, ConnectionId):
+            TransactionLog.events.append(('post', ConnectionId))
+            return super().post_to_connection(Data, ConnectionId)
+    client = LoggingClient(gone=['s1'])
+    monkeypatch.setattr(SocketHandleConnections, '_management_clients', {'https://example.com/latest': client})
+    event = {'requestContext': {'routeKey': 'sendmessage', 'connectionId': 'sender',
+                                'domainName': 'example.com', 'stage': 'latest'},
+             'body': json.dumps({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'})}
+
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+
+    assert TransactionLog.events == [
+        'begin', ('buffer', 'uow-conn'), ('lookup', None), 'commit',
+        ('post', 's0'), ('post', 's1'), ('post', 's2'),
+        # gone sockets in a short transaction of their own
+        'begin', ('delete', 's1', 'uow-conn'), 'commit']
+
+
+def test_failed_gone_delete_keeps_the_buffered_message(handler, monkeypatch):
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s0', space='TEST')
+
+    def fail(self, socket_id, space=None, shared_conn=None):
+        raise ConnectionError('database down')
+    monkeypatch.setattr(DBHelperMemory, 'delete_connection_by_socket', fail)
+    client = FakeManagementClient(gone=['s0'])
+
+    assert handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'}, client) == 200
+    assert [message['seq'] for message in db.select_buffered_messages('p1', 'TEST')] == [1]
+
+
+def test_buffered_messages_are_replayed_on_resume(handler, monkeypatch):
+    monkeypatch.setenv('message_buffer_size', '3')
+    monkeypatch.setenv('replay_max_frame_bytes', '120')
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    client = FakeManagementClient()
+    monkeypatch.setattr('lib.socket_handle_connections.boto3.client', lambda *args, **kwargs: client)
+    for index in range(5):
+        assert handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': {'n': index}}, client) == 202
+    DBHelperMemory().insert_connection(participant_id='p1', socket_id='s1', space='TEST',
+                                       endpoint='https://example.com/latest')
+
+    response = handler.lambda_handler(websocket_event('resume', 's1', {'last_seq': 3}), None)
+
+    assert response['statusCode'] == 200
+    # only the last 3 messages are kept, the ones after seq 3 are replayed in frames of <= 120 bytes
+    frames = [json.loads(data) for _, data in client.posted]
+    assert [entry for frame in frames for entry in frame['replay']] == [
+        {'seq': 4, 'message': {'n': 3}}, {'seq': 5, 'message': {'n': 4}}]
+    assert all(len(data) <= 120 for _, data in client.posted)
+    assert handler.lambda_handler(websocket_event('resume', 'unknown', {'last_seq': 0}), None)['statusCode'] == 404
+
+
+def test_connect_with_last_seq_enqueues_resume(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'decode_jwt_token',
+                        lambda self, token: {'id_user': 'p1', 'exp': 4102444800})
+    queue = MemoryFanoutQueue()
+    monkeypatch.setattr(SocketHandleConnections, 'get_fanout_queue', lambda self: queue)
+    guard = IdempotencyGuard(store=MemoryIdempotencyStore())
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard', lambda self: guard)
+    client = FakeManagementClient()
+    monkeypatch.setattr('lib.socket_handle_connections.boto3.client', lambda *args, **kwargs: client)
+    handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': 'missed'}, client)
+    event = {'requestContext': {'routeKey': '$connect', 'connectionId': 's1',
+                                'domainName': 'example.com', 'stage': 'prod'},
+             'queryStringParameters': {'participant_id': 'token', 'space': 'TEST', 'last_seq': '0'}}
+
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+    assert queue.items == [{'action': 'resume', 'socket_id': 's1', 'participant_id': 'p1', 'space': 'TEST',
+                            'endpoint': 'https://example.com/prod', 'last_seq': 0, 'compression': None}]
+    assert queue.delays == [2]
+
+    sqs_event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': json.dumps(queue.items[0])}]}
+    assert handler.lambda_handler(sqs_event, None)['statusCode'] == 200
+    assert [json.loads(data) for _, data in client.posted] == [
+        {'participant_id': 'p1', 'replay': [{'seq': 1, 'message': 'missed'}]}]
+
+
+def test_resume_before_the_handshake_keeps_the_socket(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'decode_jwt_token',
+                        lambda self, token: {'id_user': 'p1', 'exp': 4102444800})
+    queue = MemoryFanoutQueue()
+    monkeypatch.setattr(SocketHandleConnections, 'get_fanout_queue', lambda self: queue)
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard',
+                        lambda self: IdempotencyGuard(store=MemoryIdempotencyStore()))
+    DBHelperMemory().insert_buffered_message('p1', 'TEST', '{"message":"missed"}')
+
+    def fail_connect(self, participant_id, socket_id, space="PUBLIC", endpoint=None, compression=None, shared_conn=None):
+        raise RuntimeError('commit failed')
+    event = {'requestContext': {'routeKey': '$connect', 'connectionId': 's1',
+                                'domainName': 'example.com', 'stage': 'prod'},
+             'queryStringParameters': {'participant_id': 'token', 'space': 'TEST', 'last_seq': '0'}}
+    with monkeypatch.context() as patched:
+        patched.setattr(DBHelperMemory, 'insert_connection', fail_connect)
+        with pytest.raises(RuntimeError):
+            handler.lambda_handler(event, None)
+    # nothing is enqueued for a connection that was not committed
+    assert queue.items == []
+
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+    client = FakeManagementClient(gone=['s1'])
+    monkeypatch.setattr('lib.socket_handle_connections.boto3.client', lambda *args, **kwargs: client)
+    sqs_event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': json.dumps(queue.items[0])}]}
+
+    assert handler.lambda_handler(sqs_event, None)['statusCode'] == 200
+    assert DBHelperMemory().select_connection_by_socket('s1') is not None
+
+
+def test_reaper_removes_expired_messages(handler):
+    db = DBHelperMemory()
+    db.insert_buffered_message('p1', 'TEST', '"old"', ttl_seconds=-1)
+    db.insert_buffered_message('p1', 'TEST', '"new"', ttl_seconds=60)
+
+    handler.handle_reap(max_age_seconds=1800, chunk_size=10)
+
+    assert [buffered['message'] for buffered in db.select_buffered_messages('p1', 'TEST')] == ['"new"']
+    assert db.delete_expired_messages() == 0
+
+
+def test_ping_is_buffered_without_a_unit_of_work(handler, monkeypatch):
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    buffer = LastSeenBuffer(max_pending=2, flush_seconds=600)
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'get_last_seen_buffer', lambda self: buffer)
+    monkeypatch.setattr(DBHelperMemory, 'unit_of_work', lambda self, read_only=False: pytest.fail('unit of work opened'))
+    updates = []
+    monkeypatch.setattr(DBHelperMemory, 'update_last_seen',
+                        lambda self, last_seen, space=None, shared_conn=None: updates.append((space, dict(last_seen))))
+    handler.remember_socket_space('s1', 'TEST')
+    handler.remember_socket_space('s2', 'TEST')
+
+    for socket_id in ('s1', 's1', 's1'):
+        assert handler.lambda_handler(websocket_event('ping', socket_id, {'action': 'ping'}),
+                                      None)['statusCode'] == 200
+    assert updates == []
+    assert buffer.pending() == 1
+
+    assert handler.lambda_handler(websocket_event('ping', 's2', {'action': 'ping'}),
+                                  None)['statusCode'] == 200
+    assert [(space, sorted(batch)) for space, batch in updates] == [('TEST', ['s1', 's2'])]
+    assert buffer.pending() == 0
+
+
+def test_ping_ignores_the_space_sent_by_the_client(handler, monkeypatch):
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    buffer = LastSeenBuffer(max_pending=1, flush_seconds=600)
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'get_last_seen_buffer', lambda self: buffer)
+
+    assert handler.lambda_handler(websocket_event('ping', 's1', {'action': 'ping', 'space': 'OTHER'}),
+                                  None)['statusCode'] == 200
+    assert buffer.pending() == 0
+    assert DBHelperMemory._connections['s1']['last_seen'] is not None
+
+
+def test_last_seen_is_written_once_per_space(monkeypatch):
+    db = DBHelperMemory()
+    updates = []
+    monkeypatch.setattr(DBHelperMemory, 'update_last_seen',
+                        lambda self, last_seen, space=None, shared_conn=None: updates.append((space, sorted(last_seen))))
+    buffer = LastSeenBuffer(max_pending=10, flush_seconds=600)
+    buffer.touch('s1', space='A')
+    buffer.touch('s2', space='A')
+    buffer.touch('s3', space='B')
+    buffer.touch('s4')
+
+    assert buffer.flush(db) == 4
+    assert sorted(updates, key=str) == sorted([('A', ['s1', 's2']), ('B', ['s3']), (None, ['s4'])], key=str)
+
+
+def test_last_seen_update_is_limited_to_its_space(handler):
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='A')
+    now = dt.datetime.now(dt.timezone.utc)
+
+    assert db.update_last_seen({'s1': now}, space='B') == 0
+    assert db.update_last_seen({'s1': now}, space='A') == 1
+
+
+def test_disconnect_deletes_in_the_space_of_the_socket(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    db = DBHelperMemory()
+    deletes = []
+    delete = DBHelperMemory.delete_connection_by_socket
+    monkeypatch.setattr(DBHelperMemory, 'delete_connection_by_socket',
+                        lambda self, socket_id, space=None, shared_conn=None:
+                        deletes.append(space) or delete(self, socket_id, space=space))
+    assert handler.handle_connect(participant_id='p1', socket_id='s1', space='TEST') == 200
+
+    assert handler.lambda_handler(websocket_event('$disconnect', 's1', {}), None)['statusCode'] == 200
+    event = websocket_event('$disconnect', 's2', {})
+    event['requestContext']['authorizer'] = {'space': 'OTHER'}
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+    assert handler.lambda_handler(websocket_event('$disconnect', 's3', {}), None)['statusCode'] == 200
+
+    assert deletes == ['TEST', 'OTHER', None]
+    assert db.select_connection_by_socket('s1') is None
+
+
+def test_reaper_deletes_one_space_at_a_time(handler, monkeypatch):
+    db = DBHelperMemory()
+    for space in ('A', 'B'):
+        db.insert_connection(participant_id='p1', socket_id=f's{space}', space=space)
+    spaces = []
+    delete = DBHelperMemory.delete_connections_before
+    monkeypatch.setattr(DBHelperMemory, 'delete_connections_before',
+                        lambda self, cutoff, limit=1000, idle_cutoff=None, space=None, shared_conn=None:
+                        spaces.append(space) or delete(self, cutoff, limit=limit, idle_cutoff=idle_cutoff, space=space))
+
+    assert handler.handle_reap(max_age_seconds=-60, chunk_size=10) == 2
+    assert spaces == ['A', 'B']
+
+
+def test_reaper_removes_stale_rows_of_a_space_without_counter(handler):
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='LOST')
+    DBHelperMemory._space_counts.clear()
+    assert db.select_connection_counts() == []
+
+    assert handler.handle_reap(max_age_seconds=-60, chunk_size=10) == 1
+    assert db.select_connection_by_socket('s1') is None
+
+
+def test_failed_last_seen_flush_is_kept_for_the_next_ping(handler, monkeypatch):
+    buffer = LastSeenBuffer(max_pending=1, flush_seconds=600)
+    monkeypatch.setattr(SocketHandleConnections, 'get_last_seen_buffer', lambda self: buffer)
+
+    def fail(self, last_seen, space=None, shared_conn=None):
+        raise ConnectionError('database down')
+    monkeypatch.setattr(DBHelperMemory, 'update_last_seen', fail)
+
+    assert handler.handle_ping('s1') == 200
+    assert buffer.pending() == 1
+
+
+def test_due_last_seen_is_flushed_by_any_invocation(handler, monkeypatch):
+    now = [0.0]
+    buffer = LastSeenBuffer(max_pending=100, flush_seconds=60, clock=lambda: now[0])
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'get_last_seen_buffer', lambda self: buffer)
+    db = DBHelperMemory()
+    db.insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    buffer.touch('s1', space='TEST')
+    now[0] = 61.0
+
+    handler.lambda_handler(websocket_event('$disconnect', 'other', {}), None)
+
+    assert buffer.pending() == 0
+
+
+def test_reaper_rejects_idle_seconds_within_the_last_seen_lag(handler, monkeypatch):
+    monkeypatch.setenv('ping_interval_seconds', '300')
+    monkeypatch.setattr(SocketHandleConnections, 'get_last_seen_buffer',
+                        lambda self: LastSeenBuffer(max_pending=100, flush_seconds=60))
+
+    with pytest.raises(ValueError):
+        handler.handle_reap(max_age_seconds=7200, chunk_size=10, idle_seconds=360)
+    assert handler.handle_reap(max_age_seconds=7200, chunk_size=10, idle_seconds=361) == 0
+
+
+def test_redelivery_after_a_failure_in_the_middle_of_the_fanout_resumes(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setenv('socket_domain', 'https://example.com/latest')
+    client = FakeManagementClient()
+    monkeypatch.setattr(SocketHandleConnections, '_management_clients', {'https://example.com/latest': client})
+    store = DBIdempotencyStore()
+    monkeypatch.setattr(store, 'get_db_handler', DBHelperMemory)
+    guard = IdempotencyGuard(store=store, max_size=10)
+    monkeypatch.setattr(SocketHandleConnections, 'get_idempotency_guard', lambda self: guard)
+    db = DBHelperMemory()
+    for index in range(3):
+        db.insert_connection(participant_id='p1', socket_id=f's{index}', space='TEST')
+    body = json.dumps({'action': 'sendmessage', 'participant_id': 'p1', 'space': 'TEST', 'msg': 'hello'})
+    event = {'Records': [{'eventSource': 'aws:sqs', 'messageId': 'm1', 'body': body}]}
+    post = client.post_to_connection
+
+    def crash_on_s1(Data, ConnectionId):
+        if ConnectionId == 's1':
+            raise TimeoutError('invocation timed out')
+        return post(Data=Data, ConnectionId=ConnectionId)
+    monkeypatch.setattr(client, 'post_to_connection', crash_on_s1)
+
+    with pytest.raises(TimeoutError):
+        handler.lambda_handler(event, None)
+    assert not db.select_processed_message('m1')
+
+    monkeypatch.setattr(client, 'post_to_connection', post)
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+    assert 's1' in [socket_id for socket_id, _ in client.posted]
+    assert db.select_processed_message('m1')
+
+    posted = len(client.posted)
+    assert handler.lambda_handler(event, None)['statusCode'] == 200
+    assert len(client.posted) == posted
+
+
+def test_reaper_forgets_old_processed_message_ids(handler):
+    db = DBHelperMemory()
+    db.insert_processed_message('old')
+    db.insert_processed_message('recent')
+    DBHelperMemory._processed_messages['old'] -= dt.timedelta(days=16)
+    DBHelperMemory._processed_messages['recent'] -= dt.timedelta(days=14)
+
+    handler.handle_reap(max_age_seconds=7200, chunk_size=1, processed_retention_seconds=15 * 86400)
+
+    assert not db.select_processed_message('old')
+    assert db.select_processed_message('recent')
+
+
+def test_reaper_removes_idle_sockets(handler):
+    db = DBHelperMemory()
+    now = dt.datetime.now(dt.timezone.utc)
+    for socket_id in ('idle', 'alive', 'never'):
+        db.insert_connection(participant_id=socket_id, socket_id=socket_id, space='TEST')
+    db.update_last_seen({'idle': now-dt.timedelta(seconds=1200), 'alive': now})
+
+    assert handler.handle_reap(max_age_seconds=7200, chunk_size=10) == 0
+    assert handler.handle_reap(max_age_seconds=7200, chunk_size=10, idle_seconds=900) == 1
+    assert sorted(row['socket_id'] for row in db.select_connections_by_space('TEST')) == ['alive', 'never']
+
+
+def test_large_payload_is_offloaded_once(handler, monkeypatch, tmp_path):
+    monkeypatch.setenv('payload_offload_bytes', '100')
+    store = LocalBlobStore(tmp_path)
+    monkeypatch.setattr(SocketHandleConnections, 'get_blob_store', lambda self: store)
+    db = DBHelperMemory()
+    for index in range(3):
+        db.insert_connection(participant_id='p1', socket_id=f's{index}', space='TEST')
+    client = FakeManagementClient()
+    document = {'text': 'x' * 1000}
+
+    assert handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': document}, client) == 200
+
+    frames = [json.loads(data) for _, data in client.posted]
+    assert len(frames) == 3
+    assert all(len(data) < 300 for _, data in client.posted)
+    ref = frames[0]['message_ref']
+    assert frames[0] == {'participant_id': 'p1', 'seq': 1, 'message_ref': ref}
+    assert json.loads(store.get(ref['sha256'])) == document
+    assert len(list(tmp_path.iterdir())) == 1
+    # the buffer keeps the reference, replay frames stay small too
+    replay = handler.build_replay_frames('p1', db.select_buffered_messages('p1', 'TEST'))
+    assert [json.loads(frame) for frame in replay] == [{'participant_id': 'p1', 'replay': [{'seq': 1, 'message_ref': ref}]}]
+
+
+def test_too_large_payload_without_blob_store(handler, monkeypatch):
+    monkeypatch.setattr(SocketHandleConnections, 'get_blob_store', lambda self: None)
+    DBHelperMemory().insert_connection(participant_id='p1', socket_id='s1', space='TEST')
+    client = FakeManagementClient()
+
+    msg = 'x' * (SocketHandleConnections.MAX_MESSAGE_BYTES + 1)
+    assert handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': msg}, client) == 413
+    assert client.posted == []
+
+
+def test_compression_negotiated_at_connect(handler, monkeypatch):
+    monkeypatch.setattr('lib.socket_handle_connections.debug_mode', True)
+    monkeypatch.setattr(SocketHandleConnections, 'decode_jwt_token',
+                        lambda self, token: {'id_user': 'p1', 'exp': 4102444800})
+    compress_calls = []
+    compress = GzipCompression.compress
+    monkeypatch.setattr(GzipCompression, 'compress', lambda self, data: compress_calls.append(data) or compress(self, data))
+    for socket_id, compression in (('s0', 'gzip'), ('s1', 'gzip'), ('s2', None), ('s3', 'brotli')):
+        event = {'requestContext': {'routeKey': '$connect', 'connectionId': socket_id},
+                 'queryStringParameters': {'participant_id': 'token', 'space': 'TEST', 'compression': compression}}
+        assert handler.lambda_handler(event, None)['statusCode'] == 200
+    assert DBHelperMemory().select_connection_by_socket('s3')['compression'] is None
+    client = FakeManagementClient()
+    document = {'items': [{'id': index, 'status': 'delivered'} for index in range(50)]}
+
+    handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': document}, client)
+
+    posted = dict(client.posted)
+    assert len(compress_calls) == 1
+    assert posted['s0'] is posted['s1']
+    assert len(posted['s0']) * 5 < len(posted['s2'])
+    assert json.loads(gzip.decompress(posted['s0'])) == json.loads(posted['s2']) == json.loads(posted['s3'])
+    # small frames are not worth compressing
+    client.posted.clear()
+    handler.handle_message({'participant_id': 'p1', 'space': 'TEST', 'msg': 'hi'}, client)
+    assert json.loads(dict(client.posted)['s0'])['message'] == 'hi'
+
+
+class FakeSQSClient:
+    def __init__(self, fail_ids=()):
+        self.fail_ids = set(fail_ids)
+        self.batches = []
+        self.entries = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append([entry['Id'] for entry in Entries])
+        self.entries.extend(Entries)
+        return {'Failed': [{'Id': entry['Id'], 'Code': 'x'} for entry in Entries if entry['Id'] in self.fail_ids]}
+
+
+def test_sqs_fanout_queue_batches_and_returns_failed_items():
+    client = FakeSQSClient(fail_ids=['1'])
+    queue = SQSFanoutQueue('https://sqs/queue', client=client)
+    items = [{'sockets': [f's{index}']} for index in range(12)]
+
+    failed = queue.send_batch(items)
+
+    assert [len(batch) for batch in client.batches] == [10, 2]
+    assert failed == [items[1], items[11]]
+    assert 'DelaySeconds' not in client.entries[0]
+
+    queue.send_batch(items[:1], delay_seconds=2)
+    assert client.entries[-1]['DelaySeconds'] == 2